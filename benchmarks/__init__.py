@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+'''
+Benchmarks for python-keepass.
+
+Run them with:
+
+  PYTHONPATH=python python -m benchmarks -o results.json
+
+See benchmarks.synth for the synthetic databases they operate on and
+benchmarks.run for the scenarios.
+'''
+
+# This file is part of python-keepass and is Copyright (C) 2012 Brett Viren.
+#
+# This code is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any
+# later version.
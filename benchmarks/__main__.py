@@ -0,0 +1,4 @@
+import sys
+from benchmarks import run
+
+sys.exit(run.main(sys.argv[1:]))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+'''
+Throughput of the payload cipher backends.
+
+Encrypts and decrypts a buffer with every installed backend of
+keepass.cipher and reports the best of several runs in MB/s.  A plain
+copy of the same buffer is timed too as the bound set by memory.
+
+  PYTHONPATH=python python -m benchmarks.ciphers --size 64
+'''
+
+# This file is part of python-keepass and is Copyright (C) 2012 Brett Viren.
+#
+# This code is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any
+# later version.
+
+import os
+import sys
+import json
+import time
+
+from keepass import cipher
+
+def best(func, repeat):
+    'Return the best wall time of calling func repeat times'
+    times = []
+    for ind in xrange(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+        continue
+    return min(times)
+
+def measure(cls, data, repeat, chunk):
+    'Return a result dictionary for one backend class'
+    key, iv = os.urandom(32), os.urandom(16)
+    ciphertext = cls(key, iv).encrypt(data)
+    def decrypt():
+        out = bytearray(len(ciphertext))
+        view, source = memoryview(out), memoryview(ciphertext)
+        backend = cls(key, iv)
+        for start in xrange(0, len(ciphertext), chunk):
+            backend.decrypt_into(source[start:start+chunk], view[start:start+chunk])
+            continue
+        assert out == data
+    mbytes = len(data) / float(1 << 20)
+    return dict(backend=cls.__name__, cipher=cls.name,
+                encrypt=mbytes / best(lambda: cls(key, iv).encrypt(data), repeat),
+                decrypt=mbytes / best(decrypt, repeat))
+
+def main(argv):
+    from optparse import OptionParser
+    op = OptionParser(usage='python -m benchmarks.ciphers [options]')
+    op.add_option('-s','--size',type='int',default=64,
+                  help='Set MiB of data per run, default: 64')
+    op.add_option('-n','--repeat',type='int',default=3,
+                  help='Set number of runs, best is kept, default: 3')
+    op.add_option('-c','--chunk',type='int',default=cipher.CHUNK,
+                  help='Set bytes decrypted per call, default: %d' % cipher.CHUNK)
+    op.add_option('-o','--output',type='string',default=None,
+                  help='Write JSON results to this file')
+    opts,args = op.parse_args(argv)
+
+    data = os.urandom(opts.size << 20)
+    mbytes = len(data) / float(1 << 20)
+    copy = mbytes / best(lambda: bytearray(data), opts.repeat)
+    results = []
+    for flag,classes in sorted(cipher.backends.iteritems()):
+        for cls in classes:
+            if not cls.available():
+                sys.stderr.write('%-12s %-10s not installed (%s)\n' %
+                                 (cls.__name__, cls.name, cls.library.split('.')[0]))
+                continue
+            # pure Python chaining is slow, keep its runs short
+            size = len(data) if cls is not cipher.Twofish else min(len(data), 1 << 20)
+            results.append(measure(cls, data[:size], opts.repeat,
+                                   opts.chunk - opts.chunk % cipher.BLOCK))
+            continue
+        continue
+
+    sys.stderr.write('%-12s %-10s %10.1f MB/s\n' % ('copy', '', copy))
+    for res in results:
+        sys.stderr.write('%-12s %-10s %10.1f MB/s encrypt %10.1f MB/s decrypt\n' %
+                         (res['backend'], res['cipher'], res['encrypt'], res['decrypt']))
+        continue
+    if opts.output:
+        with open(opts.output, 'w') as fp:
+            json.dump(dict(copy=copy, results=results), fp, indent=2, sort_keys=True)
+    return 0
+
+if '__main__' == __name__:
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+'''
+Timed scenarios over synthetic databases of increasing size.
+
+Each scenario is run against a database of each requested size and
+the best of several repeats is kept.  Results are written as JSON and
+can be compared against an earlier run to catch scaling regressions.
+'''
+
+# This file is part of python-keepass and is Copyright (C) 2012 Brett Viren.
+#
+# This code is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any
+# later version.
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+from copy import copy
+
+from keepass import kpdb
+from benchmarks import synth
+
+MASTERKEY = 'benchmark'
+
+def clone(db):
+    'Return a copy of the database whose lists can be changed freely'
+    ret = copy(db)
+    ret.groups = [copy(g) for g in db.groups]
+    ret.entries = [copy(e) for e in db.entries]
+    return ret
+
+# Each scenario(db, path) does any untimed setup and returns the
+# callable to time.
+
+def final_key(db, path):
+    hdr = db.header
+    return lambda: db.final_key(MASTERKEY, hdr.master_seed, hdr.master_seed2,
+                                hdr.key_enc_rounds)
+
+def write(db, path):
+    return lambda: db.write(path, MASTERKEY)
+
+def read(db, path):
+    db.write(path, MASTERKEY)
+    def run():
+        work = kpdb.Database(masterkey=MASTERKEY)
+        work.pipeline_threshold = None
+        work.read(path)
+    return run
+
+def read_pipelined(db, path):
+    from keepass import pipeline
+    db.write(path, MASTERKEY)
+    def run():
+        work = kpdb.Database(masterkey=MASTERKEY)
+        with open(path, 'rb') as fp:
+            pipeline.read(work, fp, os.path.getsize(path))
+    return run
+
+def _parser(db, threshold, workers=None):
+    payload = db.encode_payload()
+    work = kpdb.Database()
+    work.header = copy(db.header)
+    work.header.ngroups = len(db.groups)
+    work.header.nentries = len(db.entries)
+    work.parallel_threshold = threshold
+    work.parallel_workers = workers
+    return lambda: work.parse_payload(payload)
+
+def parse(db, path):
+    return _parser(db, None)
+
+def parse_parallel(db, path):
+    import multiprocessing
+    # at least two workers, which parse_payload() does not use on one CPU
+    return _parser(db, 0, max(2, multiprocessing.cpu_count()))
+
+def hierarchy(db, path):
+    return db.hierarchy
+
+def add_entry(db, path):
+    work = clone(db)
+    def run():
+        for ind in xrange(10):
+            work.add_entry('group0/new', 'new%d' % ind, 'user', 'secret')
+    return run
+
+def update_entry(db, path):
+    work = clone(db)
+    ents = work.entries[-10:]
+    def run():
+        for ent in ents:
+            work.update_entry(ent.title, ent.username, ent.url, new_password='changed')
+    return run
+
+def remove_group(db, path):
+    work = clone(db)
+    last = work.groups[-1].group_name
+    def run():
+        work.remove_group(last)
+    return run
+
+def search(db, path):
+    return lambda: db.search('host1')
+
+scenarios = [final_key, read, read_pipelined, write, parse, parse_parallel, hierarchy,
+             add_entry, update_entry, remove_group, search]
+
+def timeit(func, repeat):
+    'Return the best wall time of calling func repeat times'
+    best = None
+    for ind in xrange(repeat):
+        start = time.time()
+        func()
+        took = time.time() - start
+        if best is None or took < best: best = took
+        continue
+    return best
+
+def run(sizes, rounds=1000, repeat=3, names=None, seed=0):
+    'Run the scenarios, return the list of result dictionaries'
+    results = []
+    tempdir = tempfile.mkdtemp()
+    path = os.path.join(tempdir, 'bench.kdb')
+    try:
+        for nentries in sizes:
+            db = synth.generate(ngroups=max(1, nentries // 20), depth=4,
+                                nentries=nentries, rounds=rounds, seed=seed)
+            for scenario in scenarios:
+                name = scenario.__name__
+                if names and name not in names: continue
+                # some scenarios change their database so set up each repeat
+                best = min(timeit(scenario(db, path), 1) for ind in xrange(repeat))
+                results.append(dict(scenario=name, nentries=nentries,
+                                    ngroups=len(db.groups), rounds=rounds,
+                                    seconds=best))
+                continue
+            continue
+    finally:
+        shutil.rmtree(tempdir)
+    return results
+
+def compare(old, new, threshold=1.5, floor=0.001):
+    '''Return lines describing results in new that are slower than in
+    old by more than the threshold factor.  Results faster than floor
+    seconds are too noisy to compare and are skipped.'''
+    before = dict(((r['scenario'], r['nentries']), r['seconds']) for r in old)
+    ret = []
+    for res in new:
+        key = (res['scenario'], res['nentries'])
+        if key not in before or max(before[key], res['seconds']) < floor: continue
+        ratio = res['seconds'] / before[key]
+        if ratio > threshold:
+            ret.append('%s with %d entries: %.2fx slower (%.4fs -> %.4fs)' %
+                       (key[0], key[1], ratio, before[key], res['seconds']))
+        continue
+    return ret
+
+def main(argv):
+    from optparse import OptionParser
+    op = OptionParser(usage='python -m benchmarks [options]')
+    op.add_option('-s','--sizes',type='string',default='100,1000,5000',
+                  help='Set comma separated numbers of entries, default: 100,1000,5000')
+    op.add_option('-r','--rounds',type='int',default=1000,
+                  help='Set key transformation rounds, default: 1000')
+    op.add_option('-n','--repeat',type='int',default=3,
+                  help='Set number of repeats, best is kept, default: 3')
+    op.add_option('-k','--scenario',action='append',default=None,
+                  help='Run only this scenario, may be repeated')
+    op.add_option('-o','--output',type='string',default=None,
+                  help='Write JSON results to this file, default: stdout')
+    op.add_option('-c','--compare',type='string',default=None,
+                  help='Compare against the JSON results in this file')
+    opts,args = op.parse_args(argv)
+
+    sizes = [int(size) for size in opts.sizes.split(',')]
+    results = run(sizes, opts.rounds, opts.repeat, opts.scenario)
+    doc = dict(python=platform.python_version(), platform=platform.platform(),
+               time=time.strftime('%Y-%m-%dT%H:%M:%S'), results=results)
+    text = json.dumps(doc, indent=2, sort_keys=True)
+    if opts.output:
+        with open(opts.output,'w') as fp:
+            fp.write(text + '\n')
+    else:
+        print text
+
+    for res in results:
+        sys.stderr.write('%-14s %8d entries %10.4fs\n' %
+                         (res['scenario'], res['nentries'], res['seconds']))
+
+    if opts.compare:
+        with open(opts.compare) as fp:
+            old = json.load(fp)['results']
+        slower = compare(old, results)
+        for line in slower:
+            sys.stderr.write('REGRESSION: %s\n' % line)
+        if slower: return 1
+    return 0
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+'''
+Start-up cost of the keepassc command line.
+
+Runs "keepassc help" and "keepassc open ... dump" in fresh
+interpreters and reports the median wall time and the modules each
+one imported.  The time of each import statement which loaded new
+modules, including the modules it loaded in turn, is saved as well.
+Exits non-zero if a command takes longer than its budget or if "help"
+imports the crypto modules.
+
+  PYTHONPATH=python python -m benchmarks.startup --budget 0.2
+'''
+
+# This file is part of python-keepass and is Copyright (C) 2012 Brett Viren.
+#
+# This code is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any
+# later version.
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+from benchmarks import synth
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KEEPASSC = os.path.join(TOP, 'keepassc.py')
+
+# Run keepassc in this interpreter, timing the imports which load new
+# modules, and save those and the modules it imported.
+WRAPPER = '''
+import sys, time, atexit, __builtin__
+imports = []
+real_import = __builtin__.__import__
+def timed_import(name, *args, **kwds):
+    before = len(sys.modules)
+    start = time.time()
+    try:
+        return real_import(name, *args, **kwds)
+    finally:
+        if len(sys.modules) > before:
+            imports.append((name, time.time() - start))
+__builtin__.__import__ = timed_import
+def dump():
+    modules = sorted(m for m in sys.modules if sys.modules[m])
+    import json
+    with open(%r, 'w') as fp:
+        json.dump(dict(modules=modules,
+                       imports=sorted(imports, key=lambda imp: -imp[1])), fp)
+atexit.register(dump)
+sys.argv = [%r] + %r
+exec(compile(open(sys.argv[0]).read(), sys.argv[0], 'exec'), {'__name__': '__main__'})
+'''
+
+def environment():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.join(TOP, 'python'), TOP] +
+                                        env.get('PYTHONPATH', '').split(os.pathsep))
+    env.pop('KEEPASS_AGENT_SOCK', None)
+    return env
+
+def measure(args, repeat, tempdir):
+    'Return a result dictionary for running keepassc with args'
+    env = environment()
+    devnull = open(os.devnull, 'w')
+    times = []
+    for ind in xrange(repeat):
+        start = time.time()
+        subprocess.check_call([sys.executable, KEEPASSC] + args, env=env,
+                              stdout=devnull)
+        times.append(time.time() - start)
+        continue
+    times.sort()
+
+    listing = os.path.join(tempdir, 'modules.json')
+    subprocess.check_call([sys.executable, '-c', WRAPPER % (listing, KEEPASSC, args)],
+                          env=env, stdout=devnull)
+    devnull.close()
+    with open(listing) as fp:
+        loaded = json.load(fp)
+    modules = loaded['modules']
+    return dict(command=' '.join(args), median=times[len(times)//2], best=times[0],
+                nmodules=len(modules), modules=modules, imports=loaded['imports'])
+
+def main(argv):
+    from optparse import OptionParser
+    op = OptionParser(usage='python -m benchmarks.startup [options]')
+    op.add_option('-n','--repeat',type='int',default=10,
+                  help='Set number of runs per command, default: 10')
+    op.add_option('-b','--budget',type='float',default=None,
+                  help='Fail if a command median exceeds this many seconds')
+    op.add_option('-o','--output',type='string',default=None,
+                  help='Write JSON results to this file')
+    opts,args = op.parse_args(argv)
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        kdb = os.path.join(tempdir, 'startup.kdb')
+        synth.generate(ngroups=5, nentries=20, rounds=1000).write(kdb, 'startup')
+        results = [measure(['help'], opts.repeat, tempdir),
+                   measure(['open', '-m', 'startup', kdb, 'dump'], opts.repeat, tempdir)]
+    finally:
+        shutil.rmtree(tempdir)
+
+    status = 0
+    for res in results:
+        crypto = [m for m in res['modules'] if m.split('.')[0] == 'Crypto']
+        sys.stderr.write('%-40s median %.4fs best %.4fs %4d modules %3d crypto\n' %
+                         (res['command'][:40], res['median'], res['best'],
+                          res['nmodules'], len(crypto)))
+        if opts.budget and res['median'] > opts.budget:
+            sys.stderr.write('OVER BUDGET: %s\n' % res['command'])
+            status = 1
+        if res['command'] == 'help' and crypto:
+            sys.stderr.write('"help" imported crypto modules: %s\n' % ' '.join(crypto))
+            status = 1
+        continue
+    if opts.output:
+        with open(opts.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    return status
+
+if '__main__' == __name__:
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+'''
+Deterministic generator of synthetic databases.
+
+The same arguments (including the seed) always give the same groups
+and entries, so results can be compared across releases.
+'''
+
+# This file is part of python-keepass and is Copyright (C) 2012 Brett Viren.
+#
+# This code is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any
+# later version.
+
+import random
+import datetime
+
+from keepass import kpdb
+from keepass.infoblock import GroupInfo, EntryInfo
+
+EPOCH = datetime.datetime(2012, 1, 1)
+NEVER = datetime.datetime(2999, 12, 28, 23, 59, 59)
+
+def text(rng, size):
+    'Return printable text of the given size'
+    letters = 'abcdefghijklmnopqrstuvwxyz     '
+    return ''.join(rng.choice(letters) for ind in xrange(size))
+
+def generate(ngroups=10, depth=3, nentries=100, notes_size=(0, 200),
+             binary_size=(0, 0), binary_fraction=0.0, rounds=1000, seed=0):
+    '''
+    Return a kpdb.Database with ngroups groups nested up to depth
+    levels and nentries entries spread over them.
+
+    Notes have a size drawn uniformly from the notes_size range.  A
+    binary_fraction of the entries get an attachment with a size drawn
+    from the binary_size range.  The header uses the given number of
+    key transformation rounds.
+    '''
+    rng = random.Random(seed)
+    db = kpdb.Database()
+    db.header.key_enc_rounds = rounds
+    def when():
+        return EPOCH + datetime.timedelta(seconds=rng.randint(0, 10*365*86400))
+
+    level = -1
+    for ind in xrange(ngroups):
+        group = GroupInfo()
+        group.groupid = ind + 1
+        group.group_name = 'group%d' % ind
+        group.creation_time = group.last_mod_time = group.last_acc_time = when()
+        group.expiration_time = NEVER
+        group.imageid = 1
+        level = rng.randint(0, min(level + 1, depth - 1))
+        group.level = level
+        group.flags = 0
+        group.update_order()
+        db.groups.append(group)
+        continue
+
+    for ind in xrange(nentries):
+        entry = EntryInfo()
+        entry.uuid = '%032x' % rng.getrandbits(128)
+        entry.groupid = rng.randint(1, ngroups)
+        entry.imageid = 1
+        entry.title = 'title%d' % ind
+        entry.url = 'https://host%d.example.org/' % rng.randint(0, nentries)
+        entry.username = 'user%d' % rng.randint(0, nentries)
+        entry.password = text(rng, 16)
+        entry.notes = text(rng, rng.randint(*notes_size))
+        entry.creation_time = entry.last_mod_time = entry.last_acc_time = when()
+        entry.expiration_time = rng.random() < 0.1 and when() or NEVER
+        entry.binary_desc = ''
+        entry.binary_data = None
+        if binary_fraction and rng.random() < binary_fraction:
+            entry.binary_desc = 'attachment%d.bin' % ind
+            size = rng.randint(*binary_size)
+            entry.binary_data = ''.join(chr(rng.getrandbits(8)) for b in xrange(size))
+        entry.update_order()
+        db.entries.append(entry)
+        continue
+    return db
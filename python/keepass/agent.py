@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+'''
+An agent which keeps unlocked databases in memory and answers
+requests over a Unix domain socket.
+
+Opening a database pays for the master key transformation and a full
+decryption and parse.  The agent pays this once per file and then
+serves any number of clients.  Clients find the agent through the
+KEEPASS_AGENT_SOCK environment variable, much like ssh-agent.
+
+The protocol is one JSON object per line in each direction.  Each
+request holds an "op" and its arguments.  Each reply holds "ok" and
+either the result values or an "error" message.  Except for "ping"
+and "stop", every request names the database "path" and must give
+the "masterkey" it was opened with.
+
+Each vault has its own reader/writer lock, so requests about other
+vaults, and reading requests about the same one, go on while a vault
+is opened or saved.  A vault whose file changed on disk is read again
+on the next request.  If it also has unsaved changes every request but
+"save", which merges the file in, and "close" fails until then.
+
+  ping                          -> {}
+  stop                          -> {} and the agent exits
+  open    path masterkey        -> {ngroups, nentries}
+  close   path masterkey        -> {}
+  load    path masterkey        -> {header, payload} (base64)
+  lookup  path masterkey [uuid] [title] [show_passwords] -> {entries}
+  search  path masterkey text [show_passwords]           -> {entries}
+  add     path masterkey entry  -> {uuid}
+  save    path masterkey [filename] [newkey]             -> {}
+'''
+
+# This file is part of python-keepass and is Copyright (C) 2012 Brett Viren.
+#
+# This code is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any
+# later version.
+
+import os
+import sys
+import json
+import time
+import socket
+import hashlib
+import threading
+import SocketServer
+from base64 import b64encode, b64decode
+from contextlib import contextmanager
+
+def default_socket():
+    'Return the agent socket path from the environment or None'
+    return os.environ.get('KEEPASS_AGENT_SOCK') or None
+
+def _str(value):
+    'JSON gives unicode, the database holds UTF-8 encoded strings'
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def keyhash(masterkey):
+    'Return the digest used to check a master key against an open vault'
+    return hashlib.sha256('keepass-agent\0' + masterkey).digest()
+
+def entry_dict(entry, group_path=None, show_passwords=False):
+    'Return a JSON-friendly dictionary for the entry'
+    ret = {}
+    for name,value in entry.fields().iteritems():
+        if name == 'binary_data':
+            value = len(value or '')
+            name = 'binary_size'
+        elif hasattr(value,'isoformat'):
+            value = value.isoformat()
+        ret[name] = value
+        continue
+    if not show_passwords:
+        ret['password'] = '****'
+    if group_path is not None:
+        ret['group_path'] = '/'.join(group_path)
+    return ret
+
+
+class Vault(object):
+    '''
+    One database held open by the agent along with its indexes.  The
+    database is read by open().  The lock is held for reading while a
+    request uses the vault and for writing while one changes it.
+    '''
+
+    def __init__(self, path):
+        import locking
+        self.path = path
+        self.keyhash = None
+        self.db = None
+        self.dirty = False
+        self.closed = False
+        self.lock = locking.RWLock()
+        return
+
+    def open(self, masterkey):
+        'Read the file with the master key the vault then requires'
+        self.load(masterkey)
+        self.keyhash = keyhash(masterkey)
+        return
+
+    def ready(self, masterkey, stale_ok=False):
+        '''Open the file if not yet open, check the master key and read
+        the file again if it changed on disk.  Raise ValueError if it
+        changed and this vault has unsaved changes, unless stale_ok.'''
+        if self.closed:
+            raise ValueError, '"%s" was closed' % self.path
+        if self.db is None:
+            self.open(masterkey)
+            return
+        self.check_key(masterkey)
+        if not self.stale():
+            return
+        if not self.dirty:
+            self.load(masterkey)
+            return
+        if not stale_ok:
+            raise ValueError, '"%s" changed on disk and has unsaved changes, ' \
+                'save to merge them or close to drop them' % self.path
+        return
+
+    def load(self, masterkey):
+        'Read the file and build the indexes'
+        from kpdb import Database
+        self.db = Database(self.path, masterkey)
+        self.stamp = self.file_stamp()
+        self.reindex()
+        return
+
+    def file_stamp(self):
+        'Return what is needed to notice the file changing on disk'
+        st = os.stat(self.path)
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def stale(self):
+        'Return True if the file changed on disk since it was read'
+        try:
+            return self.file_stamp() != self.stamp
+        except OSError:
+            return False
+
+    def reindex(self):
+        'Rebuild the lookup indexes'
+        self.by_uuid = {}
+        self.by_title = {}
+        for ent in self.db.entries:
+            self.by_uuid[ent.uuid] = ent
+            self.by_title.setdefault(ent.title,[]).append(ent)
+            continue
+        self.paths = self.db.group_paths()
+        return
+
+    def check_key(self, masterkey):
+        'Raise ValueError unless masterkey is the one this vault was opened with'
+        import hmac
+        if not hmac.compare_digest(self.keyhash, keyhash(masterkey)):
+            raise ValueError, 'Wrong master key for "%s"' % self.path
+        return
+
+    def entries(self, entries, show_passwords=False):
+        'Return the entries as dictionaries'
+        return [entry_dict(ent, self.paths.get(ent.groupid), show_passwords)
+                for ent in entries]
+
+    def wipe(self):
+        'Drop references to all decrypted data'
+        self.closed = True
+        db = self.db
+        if db:
+            del db.groups[:]
+            del db.entries[:]
+            db.masterkey = db.finalkey = None
+        self.db = None
+        self.by_uuid = self.by_title = self.paths = None
+        return
+
+    pass
+
+
+class Agent(object):
+    '''
+    Dispatch requests against a set of vaults.
+    '''
+
+    def __init__(self):
+        self.vaults = {}
+        self.lock = threading.Lock()
+        self.server = None
+        return
+
+    @contextmanager
+    def vault(self, req, write=False, stale_ok=False):
+        '''Return a context giving the vault a request is about, opened
+        or read again if needed, holding its lock for writing if write
+        and for reading otherwise.  See Vault.ready() for stale_ok.'''
+        path = os.path.realpath(_str(req['path']))
+        masterkey = _str(req.get('masterkey',''))
+        with self.lock:
+            vault = self.vaults.get(path)
+            if vault is None:
+                vault = self.vaults[path] = Vault(path)
+        with vault.lock.reading():
+            ready = vault.db is not None and not vault.stale()
+            if ready:
+                vault.check_key(masterkey)
+        if not ready:
+            # opening or reading again, other vaults are not held up
+            with vault.lock.writing():
+                try:
+                    vault.ready(masterkey, stale_ok)
+                except:
+                    if vault.db is None:
+                        self._forget(vault)
+                    raise
+        with (vault.lock.writing() if write else vault.lock.reading()):
+            if vault.closed:
+                raise ValueError, '"%s" was closed' % path
+            yield vault
+
+    def _forget(self, vault):
+        'Remove the vault, which may no longer be used'
+        vault.closed = True
+        with self.lock:
+            if self.vaults.get(vault.path) is vault:
+                del self.vaults[vault.path]
+        return
+
+    def __call__(self, req):
+        'Handle one request dictionary, return the reply dictionary'
+        op = req.get('op')
+        meth = getattr(self, '_op_%s' % op, None)
+        if not meth:
+            return dict(ok=False, error='Unknown operation: "%s"' % op)
+        try:
+            ret = meth(req) or {}
+        except Exception, err:
+            return dict(ok=False, error=str(err))
+        ret['ok'] = True
+        return ret
+
+    def _op_ping(self, req):
+        return dict(vaults=len(self.vaults))
+
+    def _op_stop(self, req):
+        if self.server:
+            threading.Thread(target=self.server.shutdown).start()
+        return
+
+    def _op_open(self, req):
+        with self.vault(req) as vault:
+            return dict(ngroups=len(vault.db.groups), nentries=len(vault.db.entries))
+
+    def _op_close(self, req):
+        with self.vault(req, write=True, stale_ok=True) as vault:
+            self._forget(vault)
+            vault.wipe()
+        return
+
+    def _op_load(self, req):
+        from copy import copy
+        with self.vault(req) as vault:
+            db = vault.db
+            header = copy(db.header)
+            header.ngroups = len(db.groups)
+            header.nentries = len(db.entries)
+            return dict(header=b64encode(header.encode()),
+                        payload=b64encode(db.encode_payload()))
+
+    def _op_lookup(self, req):
+        with self.vault(req) as vault:
+            found = []
+            if req.get('uuid'):
+                ent = vault.by_uuid.get(_str(req['uuid']))
+                if ent: found.append(ent)
+            if req.get('title'):
+                found += vault.by_title.get(_str(req['title']),[])
+            return dict(entries=vault.entries(found, req.get('show_passwords')))
+
+    def _op_search(self, req):
+        with self.vault(req) as vault:
+            found = vault.db.search(_str(req['text']))
+            return dict(entries=vault.entries(found, req.get('show_passwords')))
+
+    def _op_add(self, req):
+        ent = dict((str(k),_str(v)) for k,v in req['entry'].iteritems())
+        with self.vault(req, write=True) as vault:
+            db = vault.db
+            before = set(vault.by_uuid)
+            db.add_entry(ent.get('path','/'), ent.get('title') or ent['username'],
+                         ent['username'], ent.get('password',''), ent.get('url',''),
+                         ent.get('notes',''), ent.get('imageid',1), ent.get('append',True))
+            vault.dirty = True
+            vault.reindex()
+            added = [u for u in vault.by_uuid if u not in before]
+            return dict(uuid=added and added[0] or None)
+
+    def _op_save(self, req):
+        with self.vault(req, write=True, stale_ok=True) as vault:
+            filename = _str(req.get('filename') or vault.path)
+            # a file changed on disk is merged in, see Database.write()
+            vault.db.write(filename, _str(req.get('newkey') or req.get('masterkey','')))
+            if os.path.realpath(filename) == vault.path:
+                vault.dirty = False
+                vault.stamp = vault.file_stamp()
+                vault.reindex()
+        return
+
+    def wipe(self):
+        'Forget all vaults'
+        with self.lock:
+            vaults,self.vaults = self.vaults.values(),{}
+        for vault in vaults:
+            with vault.lock.writing():
+                vault.wipe()
+            continue
+        return
+
+    pass
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    'Serve one client connection, one request per line'
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line: break
+            self.server.touch()
+            try:
+                req = json.loads(line)
+            except ValueError:
+                reply = dict(ok=False, error='Malformed request')
+            else:
+                reply = self.server.agent(req)
+            self.wfile.write(json.dumps(reply) + '\n')
+            self.wfile.flush()
+            continue
+        return
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    '''
+    The agent's socket server.  Each client is served in its own
+    thread.  The server shuts itself down once no request has arrived
+    for idle_timeout seconds (if not None) and wipes the vaults when it
+    stops.
+    '''
+    daemon_threads = True
+
+    def __init__(self, sockpath, agent=None, idle_timeout=None):
+        self.sockpath = sockpath
+        self.agent = agent or Agent()
+        self.agent.server = self
+        self.idle_timeout = idle_timeout
+        self.touch()
+        if os.path.exists(sockpath):
+            os.unlink(sockpath)
+        umask = os.umask(0177)  # socket is for our user only
+        try:
+            SocketServer.UnixStreamServer.__init__(self, sockpath, _Handler)
+        finally:
+            os.umask(umask)
+        return
+
+    def touch(self):
+        'Record activity for the idle timeout'
+        self.last_activity = time.time()
+        return
+
+    def _watchdog(self):
+        while not self._stopped.wait(1.0):
+            if time.time() - self.last_activity > self.idle_timeout:
+                self.shutdown()
+                break
+            continue
+        return
+
+    def run(self):
+        'Serve until stopped, then wipe the vaults and remove the socket'
+        self._stopped = threading.Event()
+        if self.idle_timeout:
+            threading.Thread(target=self._watchdog).start()
+        try:
+            self.serve_forever(poll_interval=0.2)
+        finally:
+            self._stopped.set()
+            self.server_close()
+            self.agent.wipe()
+            if os.path.exists(self.sockpath):
+                os.unlink(self.sockpath)
+        return
+
+    pass
+
+
+class Client(object):
+    '''
+    Talk to a running agent.
+    '''
+
+    def __init__(self, sockpath=None):
+        self.sockpath = sockpath or default_socket()
+        return
+
+    def available(self):
+        'Return True if an agent is listening on the socket'
+        if not self.sockpath or not os.path.exists(self.sockpath):
+            return False
+        try:
+            self.request(op='ping')
+        except (IOError, socket.error):
+            return False
+        return True
+
+    def request(self, **req):
+        '''Send one request and return the reply.  Raises ValueError if
+        the agent reports an error.'''
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.sockpath)
+            fp = sock.makefile('rw')
+            fp.write(json.dumps(req) + '\n')
+            fp.flush()
+            line = fp.readline()
+            fp.close()
+        finally:
+            sock.close()
+        if not line:
+            raise IOError, 'No reply from agent at "%s"' % self.sockpath
+        reply = json.loads(line)
+        if not reply.pop('ok', False):
+            raise ValueError, reply.get('error','Agent error')
+        return reply
+
+    def load(self, path, masterkey=""):
+        'Return a Database built from the agent\'s decrypted copy of path'
+        from kpdb import Database
+        from header import DBHDR
+        reply = self.request(op='load', path=os.path.realpath(path),
+                             masterkey=masterkey)
+        db = Database(masterkey=masterkey)
+        db.header = DBHDR(b64decode(reply['header']))
+        db.parse_payload(b64decode(reply['payload']))
+        return db
+
+    pass
+
+
+def daemonize():
+    '''Fork into the background as ssh-agent does.  Return the process
+    id of the child in the parent and 0 in the child, which leaves the
+    session and has stdin, stdout and stderr on /dev/null.'''
+    pid = os.fork()
+    if pid:
+        return pid
+    os.setsid()
+    null = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(null, fd)
+        continue
+    if null > 2:
+        os.close(null)
+    return 0
+
+def load(path, masterkey=""):
+    '''Return a Database for path from a running agent or None if no
+    agent is available.'''
+    client = Client()
+    if not client.available():
+        return None
+    return client.load(path, masterkey)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+'''
+Open and save databases without blocking the caller.
+
+The master key transformation, the payload decryption or encryption
+and the file I/O all run in a worker pool.  By default this is a pool
+of threads.  Pass a multiprocessing.Pool to use processes.
+
+Python 2 has no asyncio so the functions here return a Pending object
+with the interface of multiprocessing's AsyncResult: ready(), wait()
+and get().  An event loop can instead register a function with
+add_done_callback(), as with a concurrent.futures Future, and have it
+wake the loop, for example by writing to a pipe the loop watches.
+
+  pending = aio.open_database('file.kdb', 'secret')
+  ...
+  db = pending.get()
+  aio.save(db, 'copy.kdb').wait()
+
+Concurrent opens of the same file with the same master key share one
+in-flight task.
+'''
+
+# This file is part of python-keepass and is Copyright (C) 2012 Brett Viren.
+#
+# This code is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any
+# later version.
+
+import os
+import threading
+
+_pool = None
+_pool_lock = threading.Lock()
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+def set_pool(pool):
+    '''Set the default worker pool, for example a multiprocessing.Pool
+    or a multiprocessing.pool.ThreadPool.'''
+    global _pool
+    with _pool_lock:
+        _pool = pool
+    return
+
+def default_pool():
+    'Return the default worker pool, making a thread pool if none is set'
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            from multiprocessing.pool import ThreadPool
+            _pool = ThreadPool(4)
+        return _pool
+
+# The functions run by the workers.  They are module level so that a
+# process pool can pickle them.  Exceptions are returned rather than
+# raised so that the completion callback always runs.
+
+def _call(func, args, pid=None):
+    '''Return (ok, result or exception, pickled).  In another process
+    than pid the value is pickled here, so that one which does not
+    pickle is returned as an error rather than lost by the pool.'''
+    try:
+        ok,value = True,func(*args)
+    except Exception, err:
+        ok,value = False,err
+    if pid is None or os.getpid() == pid:
+        return ok, value, False
+    import cPickle as pickle
+    try:
+        return ok, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), True
+    except Exception, err:
+        if ok:
+            value = err
+        err = RuntimeError('%s: %s' % (value.__class__.__name__, value))
+        return False, pickle.dumps(err, pickle.HIGHEST_PROTOCOL), True
+
+def _open(filename, masterkey):
+    from kpdb import Database
+    return Database(filename, masterkey)
+
+def _save(db, filename, masterkey, pid=None):
+    '''Write the database and return what it remembers of the file for
+    its next write.  A changed file is merged only in process pid, as
+    elsewhere the database is a copy.'''
+    merge = 'newest' if pid is None or os.getpid() == pid else None
+    db.write(filename, masterkey, merge=merge)
+    return db._base, db._base_records
+
+
+class Pending(object):
+    '''
+    The eventual result of an operation running in the pool.
+    '''
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._callbacks = []
+        self._async = None      # the AsyncResult of the pool
+        return
+
+    def _done(self, result):
+        'Keep the first (ok, value) result and call the callbacks'
+        with self._lock:
+            if self._event.is_set(): return
+            self._result = result
+            self._event.set()
+            callbacks,self._callbacks = self._callbacks,[]
+        for callback in callbacks:
+            self._run(callback)
+            continue
+        return
+
+    def _run(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            import traceback
+            traceback.print_exc()
+        return
+
+    def _check(self):
+        '''Finish with the error of a task which the pool failed without
+        calling back, such as one whose arguments did not pickle'''
+        if self._event.is_set() or self._async is None or not self._async.ready():
+            return
+        try:
+            self._async.get(0)
+        except Exception, err:
+            self._done((False, err))
+        return
+
+    def add_done_callback(self, callback):
+        '''Call callback(pending) once the operation has finished, in a
+        thread of the pool, or at once if it has finished'''
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        self._run(callback)
+        return
+
+    def ready(self):
+        'Return True once the operation has finished'
+        self._check()
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        'Wait until the operation has finished or the timeout passes'
+        import time
+        deadline = timeout is not None and time.time() + timeout
+        if self._async is not None:
+            self._async.wait(timeout)
+            self._check()
+        if deadline:
+            timeout = max(deadline - time.time(), 0)
+        self._event.wait(timeout)
+        return
+
+    def successful(self):
+        'Return True if the operation finished without an exception'
+        if not self.ready():
+            raise ValueError, 'Operation has not finished'
+        return self._result[0]
+
+    def get(self, timeout=None):
+        '''Return the result of the operation, raising any exception it
+        raised.  Raises multiprocessing.TimeoutError after timeout.'''
+        self.wait(timeout)
+        if not self.ready():
+            from multiprocessing import TimeoutError
+            raise TimeoutError
+        ok,value = self._result
+        if not ok: raise value
+        return value
+
+    pass
+
+
+def _submit(pool, func, args, pending=None):
+    'Run func(*args) in the pool, return the Pending, a new one by default'
+    pending = pending or Pending()
+    def callback(result):
+        ok,value,pickled = result
+        if pickled:
+            import cPickle as pickle
+            try:
+                value = pickle.loads(value)
+            except Exception, err:
+                ok,value = False,err
+        pending._done((ok, value))
+    pending._async = (pool or default_pool()).apply_async(
+        _call, (func, args, os.getpid()), callback=callback)
+    return pending
+
+def open_database(filename, masterkey="", pool=None):
+    '''
+    Start opening the given .kdb file, return a Pending whose get()
+    gives the kpdb.Database.
+    '''
+    import hashlib
+    key = (os.path.realpath(filename), hashlib.sha256(masterkey).digest())
+    pool = pool or default_pool()
+    with _inflight_lock:
+        pending = _inflight.get(key)
+        if pending: return pending
+        pending = _inflight[key] = Pending()
+    def done(pending):
+        with _inflight_lock:
+            if _inflight.get(key) is pending:
+                del _inflight[key]
+    pending.add_done_callback(done)
+    return _submit(pool, _open, (filename, masterkey), pending)
+
+def save(db, filename, masterkey="", pool=None):
+    '''
+    Start writing the kpdb.Database to the given file, return a
+    Pending whose get() returns None once written.
+
+    A process pool writes a copy of the database, so the database is
+    then given what the write learnt of the file, as if it had written
+    it.  If the file changed since it was read, merging it needs the
+    database itself and the write is done again in a thread.
+    '''
+    from kpdb import WriteConflict
+    pending = Pending()
+    def finish(ok, value):
+        if ok:
+            db._base,db._base_records = value
+            value = None
+        pending._done((ok, value))
+    def written(first):
+        ok,value = first._result
+        if not ok and isinstance(value, WriteConflict):
+            thread = threading.Thread(
+                target=lambda: finish(*_call(_save, (db, filename, masterkey))[:2]))
+            thread.daemon = True
+            thread.start()
+            return
+        finish(ok, value)
+    first = _submit(pool, _save, (db, filename, masterkey, os.getpid()))
+    first.add_done_callback(written)
+    pending._async = first._async       # for a task the pool fails
+    return pending
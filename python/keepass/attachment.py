@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+'''
+Binary attachments of entries.
+
+The binary data of an entry (field 0xE) is held as an Attachment.
+When read from a file it is a view into the decrypted payload buffer
+rather than a copy.  An attachment can also be backed by a file on
+disk (mapped, not read) or spilled to an encrypted temporary file to
+release memory.  Its data is read in chunks through open() or
+chunks() and written out the same way when the database is saved.
+'''
+
+# This file is part of python-keepass and is Copyright (C) 2012 Brett Viren.
+#
+# This code is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any
+# later version.
+
+import os
+
+CHUNK_SIZE = 1 << 16
+
+def _bytes(chunk):
+    'Return chunk as a string'
+    if isinstance(chunk, memoryview):
+        return chunk.tobytes()
+    return chunk
+
+class Attachment(object):
+    '''
+    The data of one attachment.  Build from a string, a memoryview or
+    with from_file().  Use str() to get a copy of the whole data.
+    '''
+
+    def __init__(self, data):
+        if not hasattr(data, 'close'): # memory maps give no memoryview in Python 2
+            data = memoryview(data)
+        self._data = data
+        self._spill = None      # (file, key) once spilled
+        self._size = len(data)
+        return
+
+    @classmethod
+    def from_file(cls, filename):
+        'Return an attachment backed by a memory map of the given file'
+        import mmap
+        if not os.path.getsize(filename):
+            return cls('')
+        with open(filename, 'rb') as fp:
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mapped)
+
+    def __len__(self):
+        return self._size
+
+    def __str__(self):
+        return ''.join(_bytes(chunk) for chunk in self.chunks())
+
+    def __eq__(self, other):
+        if isinstance(other, Attachment):
+            other = str(other)
+        return str(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __reduce__(self):
+        # memoryviews and temporary files do not pickle
+        return (Attachment, (str(self),))
+
+    def __copy__(self):
+        'Return an attachment sharing the data, which can spill on its own'
+        ret = Attachment.__new__(Attachment)
+        ret.__dict__.update(self.__dict__)
+        return ret
+
+    def spilled(self):
+        'Return True if the data lives in an encrypted temporary file'
+        return self._spill is not None
+
+    def _cipher(self, key, offset):
+        from Crypto.Cipher import AES
+        from Crypto.Util import Counter
+        return AES.new(key, AES.MODE_CTR,
+                       counter=Counter.new(128, initial_value=offset // 16))
+
+    def spill(self, directory=None):
+        '''Move the data to an encrypted temporary file in the given
+        directory and drop the in-memory view.  The file is removed
+        when the attachment is no longer used.'''
+        if self._spill or not self._size:
+            return
+        import tempfile
+        from Crypto import Random
+        key = Random.new().read(32)
+        fp = tempfile.TemporaryFile(dir=directory)
+        cipher = self._cipher(key, 0)
+        for chunk in self.chunks():
+            fp.write(cipher.encrypt(_bytes(chunk)))
+            continue
+        fp.flush()
+        self._spill = (fp, key)
+        self._data = None
+        return
+
+    def chunks(self, size=CHUNK_SIZE):
+        '''Yield the data in chunks of at most size bytes.  In-memory
+        data is yielded as memoryview slices, without copies.'''
+        if not self._spill:
+            for start in xrange(0, self._size, size):
+                yield self._data[start:start+size]
+                continue
+            return
+        fp,key = self._spill
+        size -= size % 16       # keep chunks on counter block boundaries
+        fp.seek(0)
+        cipher = self._cipher(key, 0)
+        while True:
+            data = fp.read(size)
+            if not data: break
+            yield cipher.decrypt(data)
+            continue
+        return
+
+    def open(self):
+        'Return a read-only file-like object over the data'
+        return AttachmentReader(self)
+
+    def save(self, fp, size=CHUNK_SIZE):
+        'Write the data to the given file object in chunks'
+        for chunk in self.chunks(size):
+            fp.write(chunk)
+            continue
+        return
+
+    pass
+
+
+class AttachmentReader(object):
+    '''
+    A file-like object reading an Attachment.
+    '''
+
+    def __init__(self, attachment):
+        self.attachment = attachment
+        self.pos = 0
+        return
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1: offset += self.pos
+        elif whence == 2: offset += len(self.attachment)
+        self.pos = max(0, offset)
+        return
+
+    def read(self, size=-1):
+        att = self.attachment
+        end = len(att)
+        if size >= 0:
+            end = min(end, self.pos + size)
+        if end <= self.pos:
+            return ''
+        start = self.pos
+        self.pos = end
+        if not att._spill:
+            return _bytes(att._data[start:end])
+        fp,key = att._spill
+        skip = start % 16
+        fp.seek(start - skip)
+        data = att._cipher(key, start - skip).decrypt(fp.read(end - start + skip))
+        return data[skip:]
+
+    def close(self):
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, tb):
+        self.close()
+        return False
+
+    pass
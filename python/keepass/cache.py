@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+'''
+A process wide cache of decrypted databases.
+
+Opening a file pays for the master key transformation, decryption and
+parsing.  A service opening the same files again and again can use
+open_database() here instead of kpdb.Database() to pay this only when
+a file changed.
+
+Files are known by their real path, inode, size and modification time
+from one stat() and by the contents hash in their header, so a
+changed file is noticed without decrypting it.  Each caller gets its
+own copy of the database lists and of every group, entry and
+attachment object.  The field values and attachment data themselves
+are shared until the caller assigns new ones or spills an attachment,
+so changing a copy never changes the cached database.
+
+The cache holds at most budget bytes of decrypted payload and drops
+the least recently used databases beyond that.  clear() forgets every
+database, as is done at exit.  Python gives no way to overwrite the
+strings holding secrets so forgetting means dropping all references.
+'''
+
+# This file is part of python-keepass and is Copyright (C) 2012 Brett Viren.
+#
+# This code is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any
+# later version.
+
+import os
+import atexit
+import hashlib
+import threading
+from copy import copy
+from collections import OrderedDict
+
+budget = 64 << 20               # bytes of decrypted payload to keep
+
+_cache = OrderedDict()          # file identity -> (database, size, key digest)
+_size = 0
+_lock = threading.Lock()
+_salt = os.urandom(16)
+
+def _keyhash(masterkey):
+    'Return the digest used to check a master key against a cached database'
+    return hashlib.sha256(_salt + masterkey).digest()
+
+def identity(filename):
+    '''Return the tuple identifying the current contents of the file:
+    real path, inode, size, modification time and contents hash'''
+    from header import DBHDR
+    path = os.path.realpath(filename)
+    with open(path, 'rb') as fp:
+        st = os.fstat(fp.fileno())
+        contents_hash = DBHDR(fp.read(124)).contents_hash
+    return (path, st.st_ino, st.st_size, st.st_mtime, contents_hash)
+
+def view(db):
+    '''Return a copy of the database whose lists, groups, entries and
+    attachments can be changed or spilled without changing the given one'''
+    ret = copy(db)
+    ret.header = copy(db.header)
+    ret.groups = [copy(group) for group in db.groups]
+    ret.entries = [copy(entry) for entry in db.entries]
+    for ent in ret.entries:
+        data = ent.__dict__.get('binary_data')
+        if hasattr(data,'spill'):
+            ent.binary_data = copy(data)
+        continue
+    ret._time_indexes = None
+    return ret
+
+def open_database(filename, masterkey="", stats=None):
+    '''
+    Return a kpdb.Database of the file, from the cache if the file is
+    unchanged since it was cached with the same master key.  The stats
+    are given only to the returned copy, the cache keeps none.
+    '''
+    global _size
+    key = identity(filename)
+    digest = _keyhash(masterkey)
+    with _lock:
+        cached = _cache.pop(key, None)
+        if cached:
+            _cache[key] = cached        # most recently used
+    if cached:
+        import hmac
+        db,size,keydigest = cached
+        if hmac.compare_digest(digest, keydigest):
+            ret = view(db)
+            ret.stats = stats
+            return ret
+
+    from kpdb import Database
+    db = Database(filename, masterkey, stats=stats)
+    if db.header.contents_hash != key[-1]:
+        return db       # changed while reading, do not cache
+    db.stats = None     # the reading was timed for this caller only
+    size = key[2]
+    with _lock:
+        for stale in [other for other in _cache if other[0] == key[0]]:
+            _size -= _cache.pop(stale)[1]       # earlier contents of the file
+            continue
+        if size <= budget:
+            _cache[key] = (db, size, digest)
+            _size += size
+        while _size > budget:
+            oldkey,(olddb,oldsize,olddigest) = _cache.popitem(last=False)
+            _size -= oldsize
+            continue
+    ret = view(db)
+    ret.stats = stats
+    return ret
+
+def size():
+    'Return the number of payload bytes held'
+    return _size
+
+def discard(filename):
+    'Forget any cached database of the given file'
+    global _size
+    path = os.path.realpath(filename)
+    with _lock:
+        for key in [key for key in _cache if key[0] == path]:
+            _size -= _cache.pop(key)[1]
+            continue
+    return
+
+def clear():
+    'Forget all cached databases'
+    global _size
+    with _lock:
+        for db,size,digest in _cache.itervalues():
+            del db.groups[:]
+            del db.entries[:]
+            db.masterkey = db.finalkey = None
+            continue
+        _cache.clear()
+        _size = 0
+    return
+
+atexit.register(clear)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+'''
+Payload ciphers, chosen by the encryption flag in the file header.
+
+Each flag of header.DBHDR.encryption_flags has a list of backends in
+the order they are preferred.  The first whose library is installed
+is used.  register() adds backends, each of which must define
+encrypt(data) and decrypt_into(data, out).
+
+  Rijndael  AES-256-CBC from PyCrypto/pycryptodome ("Crypto") or from
+            the cryptography package (OpenSSL).  pycryptodome and
+            OpenSSL use the AES-NI instructions where the CPU has them.
+  TwoFish   Twofish-CBC from the twofish package.  Only its block
+            function is native; the CBC chaining is done here, which
+            makes it much slower than AES.
+
+KeePass 1 never wrote ArcFour files, so that flag has no backend.
+
+decrypt() works through the payload a chunk at a time, decrypting
+each chunk straight into one preallocated buffer where the library
+can write into a buffer.  Large chunks let the libraries release the
+interpreter lock while they work.
+'''
+
+# This file is part of python-keepass and is Copyright (C) 2012 Brett Viren.
+#
+# This code is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any
+# later version.
+
+from header import DBHDR
+
+BLOCK = 16
+CHUNK = 1 << 20         # bytes decrypted per library call
+
+class Backend(object):
+    '''
+    A CBC cipher over one key and IV.  Subclasses set name and the
+    library they need and define encrypt(data), returning the
+    encryption of data, and decrypt_into(data, out), decrypting data
+    into the writable buffer out.  Both are given a multiple of BLOCK
+    bytes and carry the chaining over from one call to the next.
+    '''
+
+    name = None         # the name of the header flag
+    library = None      # the module which must import
+
+    @classmethod
+    def available(cls):
+        'Return True if the library of this backend is installed'
+        try:
+            __import__(cls.library)
+        except ImportError:
+            return False
+        return True
+
+    pass
+
+
+class CryptoAES(Backend):
+    'AES from PyCrypto or pycryptodome'
+
+    name = 'Rijndael'
+    library = 'Crypto.Cipher.AES'
+
+    def __init__(self, key, iv):
+        from Crypto.Cipher import AES
+        self.cipher = AES.new(key, AES.MODE_CBC, iv)
+        return
+
+    def encrypt(self, data):
+        return self.cipher.encrypt(data)
+
+    def decrypt_into(self, data, out):
+        try:
+            self.cipher.decrypt(data, output=out)
+        except TypeError:       # PyCrypto can neither write into nor read buffers
+            out[:] = self.cipher.decrypt(data.tobytes() if isinstance(data, memoryview)
+                                         else data)
+        return
+
+    pass
+
+
+class OpenSSLAES(Backend):
+    'AES from the cryptography package'
+
+    name = 'Rijndael'
+    library = 'cryptography.hazmat.primitives.ciphers'
+
+    def __init__(self, key, iv):
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
+        self._encryptor = cipher.encryptor()
+        self._decryptor = cipher.decryptor()
+        return
+
+    def encrypt(self, data):
+        return self._encryptor.update(data)
+
+    def decrypt_into(self, data, out):
+        out[:] = self._decryptor.update(data)
+        return
+
+    pass
+
+
+class Twofish(Backend):
+    'Twofish from the twofish package, chained here'
+
+    name = 'TwoFish'
+    library = 'twofish'
+
+    def __init__(self, key, iv):
+        import twofish
+        self.block = twofish.Twofish(key)
+        self.iv = iv
+        return
+
+    def encrypt(self, data):
+        encrypt = self.block.encrypt
+        prev = self.iv
+        ret = []
+        for ind in xrange(0, len(data), BLOCK):
+            prev = encrypt(_xor(data[ind:ind+BLOCK], prev))
+            ret.append(prev)
+            continue
+        self.iv = prev
+        return ''.join(ret)
+
+    def decrypt_into(self, data, out):
+        decrypt = self.block.decrypt
+        prev = self.iv
+        for ind in xrange(0, len(data), BLOCK):
+            block = data[ind:ind+BLOCK]
+            if isinstance(block, memoryview):
+                block = block.tobytes()
+            out[ind:ind+BLOCK] = _xor(decrypt(block), prev)
+            prev = block
+            continue
+        self.iv = prev
+        return
+
+    pass
+
+
+def _xor(one, two):
+    import struct
+    a = struct.unpack('<QQ', one)
+    b = struct.unpack('<QQ', two)
+    return struct.pack('<QQ', a[0] ^ b[0], a[1] ^ b[1])
+
+# header flag -> backend classes, the preferred first
+backends = {}
+
+def register(flag, cls, first=False):
+    '''Add a backend class for the header flag.  Raise ValueError if
+    it does not define encrypt() and decrypt_into().'''
+    for method in ('encrypt', 'decrypt_into'):
+        if not callable(getattr(cls, method, None)):
+            raise ValueError, 'Backend %s does not define %s()'%(cls.__name__, method)
+        continue
+    backends.setdefault(flag, [])
+    if first:
+        backends[flag].insert(0, cls)
+    else:
+        backends[flag].append(cls)
+    return
+
+register(2, CryptoAES)
+register(2, OpenSSLAES)
+register(8, Twofish)
+
+def flag(enctype):
+    'Return the header flag of the encryption type name'
+    for name,value in DBHDR.encryption_flags[1:]:
+        if name == enctype:
+            return value
+        continue
+    raise ValueError, 'Unknown encryption type: "%s"'%enctype
+
+def backend(enctype):
+    '''Return the backend class to use for the encryption type, a
+    header flag or its name.  Raise ValueError if there is none.'''
+    value = enctype if isinstance(enctype, int) else flag(enctype)
+    candidates = backends.get(value, [])
+    for cls in candidates:
+        if cls.available():
+            return cls
+        continue
+    if candidates:
+        raise ValueError, 'Encryption type "%s" needs one of: %s'%\
+            (enctype, ', '.join(cls.library.split('.')[0] for cls in candidates))
+    raise ValueError, 'Unsupported encryption type: "%s"'%enctype
+
+def new(enctype, key, iv):
+    'Return a backend object for the encryption type, key and IV'
+    return backend(enctype)(key, iv)
+
+def decrypt(enctype, key, iv, data, chunk=CHUNK):
+    '''Return a bytearray of the decrypted data with the padding
+    removed.  The data is a string or any object supporting the
+    buffer protocol.'''
+    cipher = new(enctype, key, iv)
+    data = memoryview(data)
+    size = len(data) - len(data) % BLOCK
+    out = bytearray(size)
+    view = memoryview(out)
+    chunk -= chunk % BLOCK
+    for start in xrange(0, size, chunk):
+        cipher.decrypt_into(data[start:start+chunk], view[start:start+chunk])
+        continue
+    del view
+    if out:
+        del out[max(0, size - out[-1]):]
+    return out
+
+def encrypt(enctype, key, iv, data):
+    'Return the encryption of the data after padding it'
+    padding = BLOCK - len(data) % BLOCK
+    return new(enctype, key, iv).encrypt(data + chr(padding) * padding)
@@ -12,6 +12,15 @@ Command line interface to manipulating keepass files
 
 import sys
 
+class _Parsers(dict):
+    'Option parsers by command name, each made when first needed'
+    def __init__(self,cli):
+        self.cli = cli
+    def __missing__(self,cmd):
+        op = Cli.dispatch[cmd][0](self.cli)
+        self[cmd] = op
+        return op
+
 class Cli(object):
     '''
     Process command line
@@ -23,13 +32,30 @@ class Cli(object):
         'save',                 # save current DB to file
         'dump',                 # dump current DB to text
         'entry',                # add an entry
+        'agent',                # serve unlocked databases over a socket
+        'scan',                 # open many files in parallel and summarize
+        'merge',                # merge other databases into the current one
+        'attachment',           # extract or put an entry's attachment
+        'expiring',             # list entries expiring soon
+        'changed',              # list entries changed recently
+        'find',                 # list entries matching some text
+        'compact',              # fold the journal into the database file
+        'fsck',                 # check and repair the database structure
+        'audit',                # report duplicate entries and reused passwords
+        'shard',                # split into one file per top-level group
+        'unshard',              # read a sharded vault as one database
+        'apply',                # bring the database to a desired state
+        'batch',                # run commands read from a script
         ]
 
     def __init__(self,args=None):
         self.db = None
         self.hier = None
+        self.others = []
+        self.stats = None
+        self.deferred_saves = None
         self.command_line = None
-        self.ops = {}
+        self.ops = _Parsers(self)
         if args: self.parse_args(args)
         return
 
@@ -39,52 +65,20 @@ class Cli(object):
 
         The command line consists of general options followed by zero
         or more commands and their options.
-
         '''
-
-        def splitopts(argv):
-            'Split optional command and its args removing them from input'
-            if not argv: return None
-
-            cmd=""
-            if argv[0][0] != '-':
-                if argv[0] not in Cli.commands:
-                    raise ValueError,'Unknown command: "%s"'%argv[0]
-                cmd = argv.pop(0)
-                pass
-            copy = list(argv)
-            cmdopts = []
-            for arg in copy:
-                if arg in Cli.commands: break
-                cmdopts.append(argv.pop(0))
-                continue
-            return [cmd,cmdopts]
-
-        cmdline = []
-        copy = list(args)
-        while copy:
-            chunk = splitopts(copy)
-            if not chunk: break
-
-            if not chunk[0]: chunk[0] = 'general'
-            meth = eval('self._%s_op'%chunk[0])
-            self.ops[chunk[0]] = meth()
-            cmdline.append(chunk)
-            continue
-
-        self.command_line = cmdline
-
+        self.command_line = split_command_line(args)
         return
 
     def __call__(self):
         'Process commands'
         if not self.command_line:
-            print self._general_op().print_help()
+            self.ops['general'].print_help()
             return
         for cmd,cmdopts in self.command_line:
-            meth = eval('self._%s'%cmd)
-            meth(cmdopts)
+            Cli.dispatch[cmd][1](self,cmdopts)
             continue
+        if self.stats:
+            sys.stderr.write('%s\n'%self.stats)
         return
 
     def _general_op(self):
@@ -101,11 +95,16 @@ class Cli(object):
         '''
         from optparse import OptionParser
         op = OptionParser(usage=self._general_op.__doc__)
+        op.add_option('-T','--timings',action='store_true',default=False,
+                      help='Print time spent in each phase when done')
         return op
 
     def _general(self,opts):
         'Process general options'
         opts,args = self.ops['general'].parse_args(opts)
+        if opts.timings:
+            import stats
+            self.stats = stats.Stats(memory=True)
         return
 
 
@@ -116,14 +115,12 @@ class Cli(object):
 
         print 'Available commands:'
         for cmd in Cli.commands:
-            meth = eval('self._%s'%cmd)
-            print '\t%s: %s'%(cmd,meth.__doc__)
+            print '\t%s: %s'%(cmd,Cli.dispatch[cmd][1].__doc__)
             continue
         print '\nPer-command help:\n'
 
         for cmd in Cli.commands:
-            meth = eval('self._%s_op'%cmd)
-            op = meth()
+            op = self.ops[cmd]
             if not op: continue
             print '%s'%cmd.upper()
             op.print_help()
@@ -136,35 +133,95 @@ class Cli(object):
         op = OptionParser(usage=self._open_op.__doc__,add_help_option=False)
         op.add_option('-m','--masterkey',type='string',default="",
                       help='Set master key for decrypting file, default: ""')
+        op.add_option('-A','--no-agent',action='store_true',default=False,
+                      help='Do not use a running agent even if one is available')
+        op.add_option('-p','--progress',action='store_true',default=False,
+                      help='Show the progress of the master key transformation')
         return op
 
     def _open(self,opts):
-        'Read a file to the in-memory database'
+        '''Read a file to the in-memory database.  Any further files are
+        held for a following merge command.'''
         opts,files = self.ops['open'].parse_args(opts)
-        import kpdb
-        # fixme - add support for opening/merging multiple DBs!
-        try:
-            dbfile = files[0]
-        except IndexError:
+        if not files:
             print "No database file specified"
             sys.exit(1)
-        self.db = kpdb.Database(files[0],opts.masterkey)
-        self.hier = self.db.hierarchy()
+        progress = None
+        if opts.progress:
+            progress = show_progress
+        dbs = [self._load(dbfile,opts.masterkey,not opts.no_agent,progress)
+               for dbfile in files]
+        self.db = dbs.pop(0)
+        self.others = dbs
+        self.hier = None        # built when needed, fsck must run on damaged files
         return
 
+    def _load(self,dbfile,masterkey,use_agent=True,progress=None):
+        'Return the database in the file, from the agent if possible'
+        import os, journal
+        db = None
+        if journal.exists(dbfile):
+            return journal.JournaledDatabase(dbfile,masterkey,stats=self.stats,
+                                             progress=progress)
+        if use_agent and os.environ.get('KEEPASS_AGENT_SOCK'):
+            import agent
+            db = agent.load(dbfile,masterkey)
+            if db and self.stats:
+                db.stats = self.stats
+        if not db:
+            import kpdb
+            db = kpdb.Database(dbfile,masterkey,stats=self.stats,progress=progress)
+        return db
+
     def _save_op(self):
         'save [options] filename'
         from optparse import OptionParser
         op = OptionParser(usage=self._save_op.__doc__,add_help_option=False)
         op.add_option('-m','--masterkey',type='string',default="",
                       help='Set master key for encrypting file, default: ""')
+        op.add_option('-i','--index',action='store_true',default=None,
+                      help='Also write the sidecar index for lazy opening')
+        op.add_option('-j','--journal',action='store_true',default=False,
+                      help='Append the changes to the journal of the file instead of rewriting it')
         return op
 
     def _save(self,opts):
         'Save the current in-memory database to a file'
         opts,files = self.ops['save'].parse_args(opts)
-        self.db.update(self.hier)
-        self.db.write(files[0],opts.masterkey)
+        save = (self.db,opts.masterkey,opts.index,opts.journal)
+        if self.deferred_saves is not None:
+            # keep a copy, later commands must not change what is saved
+            import cache
+            save = (cache.view(self.db),) + save[1:]
+            self.deferred_saves.pop(files[0],None)
+            self.deferred_saves[files[0]] = save
+            return
+        self._write(files[0],*save)
+        return
+
+    def _write(self,filename,db,masterkey,index=None,use_journal=False):
+        '''Write the database to the file or, if use_journal, append
+        its changes to the journal of the file'''
+        import os, journal
+        if isinstance(db,journal.JournaledDatabase) and \
+                os.path.realpath(filename) == os.path.realpath(db.filename):
+            if use_journal:
+                db.commit()
+            else:
+                db.compact(masterkey,index)
+            return
+        if not use_journal:
+            db.write(filename,masterkey,index)
+            return
+        if not os.path.exists(filename):
+            db.write(filename,masterkey,index)
+        # journal the difference from the file, later saves append to it
+        jdb = journal.JournaledDatabase(filename,masterkey or db.masterkey,
+                                        stats=self.stats)
+        jdb.groups,jdb.entries = db.groups,db.entries
+        jdb.commit()
+        if self.db is db:
+            self.db = jdb
         return
 
     def _dump_op(self):
@@ -181,9 +238,11 @@ class Cli(object):
     def _dump(self,opts):
         'Print the current database in a formatted way.'
         opts,files = self.ops['dump'].parse_args(opts)
-        if not self.hier:
+        if not self.db:
             sys.stderr.write('Can not dump.  No database open.\n')
             return
+        if not self.hier:
+            self.hier = self.db.hierarchy()
         print self.hier
         #self.hier.dump(opts.format,opts.show_passwords)
         return
@@ -222,12 +281,504 @@ class Cli(object):
                     sys.stderr.write("Error: Your passwords didn't match\n")
                     continue
                 break
+            password = password1
             pass
 
         self.db.add_entry(opts.path,opts.title or username,username,password,
                           opts.url,opts.note,opts.imageid,opts.append)
+        self.hier = None        # rebuilt when next needed
+        return
+
+    def _agent_op(self):
+        'agent [options] [filename ...]'
+        from optparse import OptionParser
+        op = OptionParser(usage=self._agent_op.__doc__,add_help_option=False)
+        op.add_option('-s','--socket',type='string',default=None,
+                      help='Set the socket path, default: $KEEPASS_AGENT_SOCK')
+        op.add_option('-t','--timeout',type='int',default=0,
+                      help='Exit after this many idle seconds, default: never')
+        op.add_option('-m','--masterkey',type='string',default="",
+                      help='Set master key for the files to open at start, default: ""')
+        op.add_option('-D','--foreground',action='store_true',default=False,
+                      help='Stay in the foreground instead of forking into the background')
+        return op
+
+    def _agent(self,opts):
+        '''Serve unlocked databases to other commands over a Unix socket.
+        Prints the shell commands setting the environment for clients,
+        then forks into the background.'''
+        opts,files = self.ops['agent'].parse_args(opts)
+        import os, tempfile, agent
+        sockpath = opts.socket or agent.default_socket() or \
+            os.path.join(tempfile.mkdtemp(prefix='keepass-'),'agent.sock')
+        server = agent.Server(sockpath, idle_timeout=opts.timeout or None)
+        for dbfile in files:
+            reply = server.agent(dict(op='open',path=dbfile,masterkey=opts.masterkey))
+            if not reply['ok']:
+                sys.stderr.write('%s: %s\n'%(dbfile,reply['error']))
+            continue
+        pid = os.getpid()
+        if not opts.foreground:
+            sys.stdout.flush()
+            pid = agent.daemonize()
+        if pid:
+            print 'KEEPASS_AGENT_SOCK=%s; export KEEPASS_AGENT_SOCK;'%sockpath
+            print 'KEEPASS_AGENT_PID=%d; export KEEPASS_AGENT_PID;'%pid
+            sys.stdout.flush()
+            if not opts.foreground:
+                os._exit(0)     # the socket is the child's now
+        server.run()
+        return
+
+    def _scan_op(self):
+        'scan [options] filename ...'
+        from optparse import OptionParser
+        op = OptionParser(usage=self._scan_op.__doc__,add_help_option=False)
+        op.add_option('-m','--masterkey',type='string',default="",
+                      help='Set master key for decrypting the files, default: ""')
+        op.add_option('-j','--jobs',type='int',default=None,
+                      help='Set number of worker processes, default: number of CPUs')
+        return op
+
+    def _scan(self,opts):
+        'Open many files in parallel and print a summary of each'
+        opts,files = self.ops['scan'].parse_args(opts)
+        import kpdb
+        nerrors = 0
+        for filename,summary,error in kpdb.open_many(files,opts.masterkey,
+                                                     opts.jobs,summary=True):
+            if error:
+                sys.stderr.write('%s: %s\n'%(filename,error))
+                nerrors += 1
+                continue
+            print '%s: %d groups, %d entries, %d rounds'%\
+                (filename,summary['ngroups'],summary['nentries'],summary['rounds'])
+            continue
+        if nerrors:
+            sys.exit(1)
+        return
+
+    def _merge_op(self):
+        'merge [options] [filename ...]'
+        from optparse import OptionParser
+        import kpdb
+        op = OptionParser(usage=self._merge_op.__doc__,add_help_option=False)
+        op.add_option('-m','--masterkey',type='string',default="",
+                      help='Set master key for decrypting the named files, default: ""')
+        op.add_option('-P','--policy',type='choice',default='newest',
+                      choices=kpdb.Database.merge_policies,
+                      help='Set which of two versions to keep: newest, ours or theirs, default: newest')
+        return op
+
+    def _merge(self,opts):
+        'Merge the other opened files and any named files into the database'
+        opts,files = self.ops['merge'].parse_args(opts)
+        if not self.db:
+            sys.stderr.write('Can not merge.  No database open.\n')
+            return
+        others = self.others + [self._load(dbfile,opts.masterkey)
+                                for dbfile in files]
+        for other in others:
+            self.db.merge(other,opts.policy)
+            continue
+        self.others = []
+        self.hier = None
+        return
+
+    def _attachment_op(self):
+        'attachment [options] extract|put entry [filename]'
+        from optparse import OptionParser
+        op = OptionParser(usage=self._attachment_op.__doc__,add_help_option=False)
+        op.add_option('-o','--output',type='string',default=None,
+                      help='Extract into this file, default: stdout')
+        op.add_option('-d','--description',type='string',default=None,
+                      help='Set the attachment description when putting, default: file name')
+        return op
+
+    def _attachment(self,opts):
+        '''Stream the attachment of the entry with the given uuid or
+        title out to a file or in from a file'''
+        opts,args = self.ops['attachment'].parse_args(opts)
+        import os, datetime, attachment
+        if not self.db:
+            sys.stderr.write('Can not handle attachment.  No database open.\n')
+            return
+        try:
+            action,name = args[:2]
+        except ValueError:
+            sys.stderr.write('Usage: %s\n'%self._attachment_op.__doc__)
+            sys.exit(1)
+        found = [e for e in self.db.entries if name in (e.uuid,e.title)]
+        if len(found) != 1:
+            sys.stderr.write('Found %d entries for "%s"\n'%(len(found),name))
+            sys.exit(1)
+        ent = found[0]
+
+        if action == 'extract':
+            data = ent.__dict__.get('binary_data')
+            if not data:
+                sys.stderr.write('Entry "%s" has no attachment\n'%name)
+                sys.exit(1)
+            if not isinstance(data,attachment.Attachment):
+                data = attachment.Attachment(data)
+            if opts.output:
+                fp = open(opts.output,'wb')
+            else:
+                fp = os.fdopen(os.dup(sys.stdout.fileno()),'wb')
+            try:
+                data.save(fp)
+            finally:
+                fp.close()
+            return
+
+        if action == 'put':
+            try:
+                filename = args[2]
+            except IndexError:
+                sys.stderr.write('No attachment file specified\n')
+                sys.exit(1)
+            ent.binary_data = attachment.Attachment.from_file(filename)
+            ent.binary_desc = opts.description or os.path.basename(filename)
+            ent.last_mod_time = datetime.datetime.now()
+            ent.update_order()
+            self.db.changed([ent])
+            return
+
+        sys.stderr.write('Unknown attachment action: "%s"\n'%action)
+        sys.exit(1)
+
+    def _print_timed(self,entries,field):
+        'Print entries with the given time field and their group paths'
+        paths = self.db.group_paths()
+        for ent in entries:
+            print '%s %s/%s (%s)'%(getattr(ent,field),
+                                   '/'.join(paths.get(ent.groupid,['?'])),
+                                   ent.title,ent.username)
+            continue
+        return
+
+    def _expiring_op(self):
+        'expiring [options]'
+        from optparse import OptionParser
+        op = OptionParser(usage=self._expiring_op.__doc__,add_help_option=False)
+        op.add_option('-w','--within',type='string',default='30d',
+                      help='Set how far ahead to look, as a number followed by s, m, h, d or w, default: 30d')
+        return op
+
+    def _expiring(self,opts):
+        'List entries expiring within the given time from now'
+        opts,args = self.ops['expiring'].parse_args(opts)
+        if not self.db:
+            sys.stderr.write('Can not list.  No database open.\n')
+            return
+        self._print_timed(self.db.expiring(duration(opts.within)),'expiration_time')
         return
 
+    def _changed_op(self):
+        'changed [options]'
+        from optparse import OptionParser
+        op = OptionParser(usage=self._changed_op.__doc__,add_help_option=False)
+        op.add_option('-s','--since',type='string',default='1d',
+                      help='Set a date (YYYY-MM-DD[THH:MM:SS]) or a duration ago like 12h, default: 1d')
+        return op
+
+    def _changed(self,opts):
+        'List entries modified since the given time'
+        opts,args = self.ops['changed'].parse_args(opts)
+        import datetime
+        if not self.db:
+            sys.stderr.write('Can not list.  No database open.\n')
+            return
+        try:
+            since = datetime.datetime.now() - duration(opts.since)
+        except ValueError:
+            since = timestamp(opts.since)
+        self._print_timed(self.db.changed_since(since),'last_mod_time')
+        return
+
+    def _find_op(self):
+        'find [options] text'
+        from optparse import OptionParser
+        op = OptionParser(usage=self._find_op.__doc__,add_help_option=False)
+        op.add_option('-p','--show-passwords',action='store_true',default=False,
+                      help='Show passwords as plain text')
+        op.add_option('-f','--format',type='string',
+                      default='%(group_path)s/%(title)s %(username)s %(url)s',
+                      help='Set the format of each line')
+        return op
+
+    def _find(self,opts):
+        'Print entries with the text in their title, username, url or notes'
+        opts,args = self.ops['find'].parse_args(opts)
+        if not self.db:
+            sys.stderr.write('Can not find.  No database open.\n')
+            return
+        paths = self.db.group_paths()
+        for ent in self.db.search(' '.join(args)):
+            dat = ent.fields()
+            dat['group_path'] = '/'.join(paths.get(ent.groupid,['?']))
+            if not opts.show_passwords:
+                dat['password'] = '****'
+            print opts.format%dat
+            continue
+        return
+
+    def _compact_op(self):
+        return None
+    def _compact(self,opts):
+        'Fold the journal of the current database into its file'
+        import journal
+        if not isinstance(self.db,journal.JournaledDatabase):
+            sys.stderr.write('Can not compact.  The database has no journal.\n')
+            return
+        self.db.compact()
+        return
+
+    def _fsck_op(self):
+        'fsck [options]'
+        from optparse import OptionParser
+        op = OptionParser(usage=self._fsck_op.__doc__,add_help_option=False)
+        op.add_option('-r','--repair',action='store_true',default=False,
+                      help='Repair the problems found in the in-memory database')
+        return op
+
+    def _fsck(self,opts):
+        'Check the structure of the current database, optionally repairing it'
+        opts,args = self.ops['fsck'].parse_args(opts)
+        if not self.db:
+            sys.stderr.write('Can not check.  No database open.\n')
+            return
+        problems = self.db.check(repair=opts.repair)
+        for kind,message in problems:
+            print '%s: %s'%(kind,message)
+            continue
+        if not problems:
+            return
+        if opts.repair:
+            print '%d problems repaired'%len(problems)
+            self.hier = None
+            return
+        print '%d problems found'%len(problems)
+        sys.exit(1)
+
+    def _audit_op(self):
+        'audit [options]'
+        from optparse import OptionParser
+        op = OptionParser(usage=self._audit_op.__doc__,add_help_option=False)
+        op.add_option('-k','--keys',type='string',default='title,username,url,password',
+                      help='Set comma separated fields which make entries duplicates, '
+                      'default: title,username,url,password')
+        op.add_option('-m','--merge',action='store_true',default=False,
+                      help='Keep only the newest of entries equal in every field and group')
+        return op
+
+    def _audit(self,opts):
+        'Report duplicate entries and reused passwords, never showing passwords'
+        opts,args = self.ops['audit'].parse_args(opts)
+        if not self.db:
+            sys.stderr.write('Can not audit.  No database open.\n')
+            return
+        paths = self.db.group_paths()
+        def where(ent):
+            return '/%s/%s (%s)'%('/'.join(paths.get(ent.groupid,['?'])),
+                                  ent.title,ent.username)
+        keys = opts.keys.split(',')
+        for bucket in self.db.find_duplicates(keys):
+            print '%d duplicates in %s:'%(len(bucket),','.join(keys))
+            for ent in bucket:
+                print '\t%s'%where(ent)
+            continue
+        for bucket in self.db.find_reused_passwords():
+            print '%d entries share a password:'%len(bucket)
+            for ent in bucket:
+                print '\t%s'%where(ent)
+            continue
+        if opts.merge:
+            removed = self.db.merge_duplicates()
+            print '%d duplicate entries removed'%len(removed)
+            if removed:
+                self.hier = None
+        return
+
+    def _shard_op(self):
+        'shard [options] manifest'
+        from optparse import OptionParser
+        op = OptionParser(usage=self._shard_op.__doc__,add_help_option=False)
+        op.add_option('-m','--masterkey',type='string',default="",
+                      help='Set master key for encrypting the files, default: the current one')
+        return op
+
+    def _shard(self,opts):
+        'Write the current database as a manifest and one file per top-level group'
+        opts,files = self.ops['shard'].parse_args(opts)
+        if not self.db:
+            sys.stderr.write('Can not shard.  No database open.\n')
+            return
+        import shard
+        vault = shard.shard(self.db,files[0],opts.masterkey)
+        for name,part in vault.shards.iteritems():
+            print '%s: %s'%(part.filename,name)
+            continue
+        return
+
+    def _unshard_op(self):
+        'unshard [options] manifest'
+        from optparse import OptionParser
+        op = OptionParser(usage=self._unshard_op.__doc__,add_help_option=False)
+        op.add_option('-m','--masterkey',type='string',default="",
+                      help='Set master key for decrypting the files, default: ""')
+        op.add_option('-j','--jobs',type='int',default=None,
+                      help='Set number of worker processes, default: number of CPUs')
+        return op
+
+    def _unshard(self,opts):
+        'Read all files of a sharded vault into the in-memory database'
+        opts,files = self.ops['unshard'].parse_args(opts)
+        import shard
+        vault = shard.ShardedDatabase(files[0],opts.masterkey,stats=self.stats)
+        vault.open_all(opts.jobs)
+        self.db = vault.unshard()
+        self.hier = None
+        return
+
+    def _apply_op(self):
+        'apply [options] specfile'
+        from optparse import OptionParser
+        op = OptionParser(usage=self._apply_op.__doc__,add_help_option=False)
+        op.add_option('-n','--dry-run',action='store_true',default=False,
+                      help='Print the changes without making them')
+        op.add_option('-p','--prune',action='store_true',default=False,
+                      help='Remove entries and groups the file does not name')
+        return op
+
+    def _apply(self,opts):
+        '''Bring the database to the desired state in a JSON or YAML
+        file ("-" for stdin) with the fewest changes'''
+        opts,files = self.ops['apply'].parse_args(opts)
+        if not self.db:
+            sys.stderr.write('Can not apply.  No database open.\n')
+            return
+        import diff
+        changes = diff.diff_spec(self.db,diff.load_spec(files[0]),opts.prune)
+        for line in diff.describe(self.db,changes):
+            print line
+            continue
+        if opts.dry_run or not changes:
+            return
+        diff.apply(self.db,changes)
+        self.hier = None
+        return
+
+    def _batch_op(self):
+        'batch [options]'
+        from optparse import OptionParser
+        op = OptionParser(usage=self._batch_op.__doc__,add_help_option=False)
+        op.add_option('-f','--file',type='string',default='-',
+                      help='Read commands from this file, default: stdin')
+        op.add_option('-t','--timings',action='store_true',default=False,
+                      help='Print the time taken by each command')
+        return op
+
+    def _batch(self,opts):
+        '''Run commands read from a script, one or more per line as on
+        the command line.  Saves are done once, at the end, each writing
+        the database as it was at its save command.'''
+        opts,args = self.ops['batch'].parse_args(opts)
+        import shlex, time
+        from collections import OrderedDict
+        fp = sys.stdin
+        if opts.file != '-':
+            fp = open(opts.file)
+        self.deferred_saves = OrderedDict()
+        try:
+            for lineno,line in enumerate(fp):
+                line = line.strip()
+                if not line or line.startswith('#'): continue
+                for cmd,cmdopts in split_command_line(shlex.split(line)):
+                    if cmd in ('general','batch'):
+                        raise ValueError,'Line %d: can not run "%s" in a batch'%\
+                            (lineno+1,cmdopts and cmdopts[0] or cmd)
+                    start = time.time()
+                    Cli.dispatch[cmd][1](self,cmdopts)
+                    if opts.timings:
+                        sys.stderr.write('%10.4fs %d: %s\n'%
+                                         (time.time()-start,lineno+1,cmd))
+                    continue
+                continue
+        finally:
+            saves,self.deferred_saves = self.deferred_saves,None
+            if fp is not sys.stdin:
+                fp.close()
+        for filename,save in saves.iteritems():
+            start = time.time()
+            self._write(filename,*save)
+            if opts.timings:
+                sys.stderr.write('%10.4fs save %s\n'%(time.time()-start,filename))
+            continue
+        return
+
+# command name -> (option parser factory, handler), both called with the Cli
+Cli.dispatch = dict((cmd, (getattr(Cli,'_%s_op'%cmd), getattr(Cli,'_%s'%cmd)))
+                    for cmd in ['general'] + Cli.commands)
+
+def show_progress(done,total,remaining):
+    'Show the progress of a key transformation on stderr'
+    sys.stderr.write('\rTransforming master key: %3d%%, %.1fs left   '%
+                     (100*done//total,remaining))
+    if done == total:
+        sys.stderr.write('\n')
+    sys.stderr.flush()
+    return
+
+def split_command_line(args):
+    '''Split arguments into a list of [command, options] chunks.  Any
+    leading options go with the "general" command.'''
+    def splitopts(argv):
+        'Split optional command and its args removing them from input'
+        if not argv: return None
+
+        cmd=""
+        if argv[0][0] != '-':
+            if argv[0] not in Cli.dispatch:
+                raise ValueError,'Unknown command: "%s"'%argv[0]
+            cmd = argv.pop(0)
+            pass
+        cmdopts = []
+        while argv and argv[0] not in Cli.dispatch:
+            cmdopts.append(argv.pop(0))
+            continue
+        return [cmd,cmdopts]
+
+    cmdline = []
+    copy = list(args)
+    while copy:
+        chunk = splitopts(copy)
+        if not chunk: break
+
+        if not chunk[0]: chunk[0] = 'general'
+        cmdline.append(chunk)
+        continue
+    return cmdline
+
+def duration(text):
+    'Return timedelta for text like 30d: a number and one of s, m, h, d, w'
+    import re, datetime
+    units = dict(s='seconds',m='minutes',h='hours',d='days',w='weeks')
+    match = re.match(r'^(\d+)([smhdw])$',text.strip())
+    if not match:
+        raise ValueError, 'Bad duration: "%s"'%text
+    return datetime.timedelta(**{units[match.group(2)]:int(match.group(1))})
+
+def timestamp(text):
+    'Return datetime for text like YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS'
+    import datetime
+    for fmt in ('%Y-%m-%dT%H:%M:%S','%Y-%m-%d %H:%M:%S','%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(text.strip(),fmt)
+        except ValueError:
+            continue
+    raise ValueError, 'Bad date: "%s"'%text
+
 if '__main__' == __name__:
     cliobj = Cli(sys.argv[1:])
     cliobj()
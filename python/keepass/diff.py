@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+'''
+Differences between databases and making them.
+
+diff() compares two databases by entry uuid and groupid.  diff_spec()
+compares a database with a desired state, a document naming the
+groups and entries it should hold, and returns the fewest changes
+bringing the database to that state.  Both run in time linear in the
+databases and document.  apply() makes a set of changes in one pass
+over the database.  Entries which are not changed keep their objects,
+and changed entries keep their uuid and creation time.
+
+A desired state document is JSON or, with PyYAML installed, YAML:
+
+  {"groups": ["Web/Shops"],
+   "entries": [{"path": "Web/Shops", "title": "shop", "username": "alice",
+                "password": "hunter2", "url": "https://shop.example.org/"}]}
+
+Entries are matched by their "uuid" if the document gives one and
+otherwise by path, title and username.  Fields the document leaves
+out keep their current values.  With prune, the entries and groups
+the document does not name are removed.
+'''
+
+# This file is part of python-keepass and is Copyright (C) 2012 Brett Viren.
+#
+# This code is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any
+# later version.
+
+import datetime
+import hashlib
+from copy import copy
+
+from infoblock import GroupInfo, EntryInfo
+
+# entry fields a desired state document may set
+FIELDS = ('title','username','password','url','notes')
+
+# fields not shown as changed by describe()
+UNSHOWN = ('order','last_mod_time','last_acc_time')
+
+class Changes(object):
+    '''
+    The differences between two versions of a database.  The changed
+    lists hold (old, new) pairs.  If the groups or their order differ,
+    group_order lists the groupids of the new version in order.
+    '''
+
+    kinds = ('entries_added','entries_changed','entries_removed',
+             'groups_added','groups_changed','groups_removed')
+
+    def __init__(self):
+        for kind in self.kinds:
+            setattr(self, kind, [])
+            continue
+        self.group_order = None
+        return
+
+    def __nonzero__(self):
+        return self.group_order is not None or \
+            any(getattr(self, kind) for kind in self.kinds)
+
+    def __str__(self):
+        ret = ['%s: %d'%(kind.replace('_',' '),len(getattr(self, kind)))
+               for kind in self.kinds if getattr(self, kind)]
+        return ', '.join(ret) or 'no changes'
+
+    pass
+
+
+def _digests(infos, key):
+    'Return a dictionary from the key of each info block to its encoding digest'
+    return dict((getattr(info, key), (hashlib.sha256(info.encode()).digest(), info))
+                for info in infos)
+
+def diff(old, new):
+    'Return the Changes from the old to the new Database'
+    changes = Changes()
+    for key,attr in [('uuid','entries'), ('groupid','groups')]:
+        before = _digests(getattr(old, attr), key)
+        after = _digests(getattr(new, attr), key)
+        for ident,(digest,info) in after.iteritems():
+            if ident not in before:
+                getattr(changes, attr + '_added').append(info)
+            elif before[ident][0] != digest:
+                getattr(changes, attr + '_changed').append((before[ident][1], info))
+            continue
+        for ident,(digest,info) in before.iteritems():
+            if ident not in after:
+                getattr(changes, attr + '_removed').append(info)
+            continue
+        continue
+    order = [group.groupid for group in new.groups]
+    if changes.groups_added or changes.groups_changed or changes.groups_removed \
+            or order != [group.groupid for group in old.groups]:
+        changes.group_order = order
+    return changes
+
+def apply(db, changes):
+    '''Make the changes to the database in one pass.  The new groups
+    and entries of the changes are put in the database as they are.'''
+    if changes.group_order is not None:
+        groups = dict((group.groupid, group) for group in db.groups)
+        groups.update((group.groupid, group) for group in changes.groups_added)
+        groups.update((new.groupid, new) for old,new in changes.groups_changed)
+        db.groups = [groups[groupid] for groupid in changes.group_order]
+    removed = set(ent.uuid for ent in changes.entries_removed)
+    replaced = dict((old.uuid, new) for old,new in changes.entries_changed)
+    entries = [replaced.get(ent.uuid, ent) for ent in db.entries
+               if ent.uuid not in removed]
+    entries.extend(changes.entries_added)
+    db.entries = entries
+    db._reindex(added=changes.entries_added +
+                [new for old,new in changes.entries_changed],
+                removed=changes.entries_removed +
+                [old for old,new in changes.entries_changed])
+    return
+
+def load_spec(filename):
+    'Return the desired state document in the JSON or YAML file, "-" for stdin'
+    import sys
+    fp = sys.stdin if filename == '-' else open(filename)
+    try:
+        if filename.endswith(('.yaml','.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError, 'Reading %s needs PyYAML'%filename
+            return yaml.safe_load(fp)
+        import json
+        return json.load(fp)
+    finally:
+        if fp is not sys.stdin:
+            fp.close()
+
+def _text(value):
+    'Return a document value as the byte string the file format holds'
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def _path(path):
+    'Return a document path, a string or list of names, as a tuple of names'
+    if isinstance(path, basestring):
+        path = _text(path).split('/')
+    return tuple(_text(name) for name in path if name)
+
+def diff_spec(db, spec, prune=False):
+    '''Return the Changes bringing the database to the desired state
+    given as a document, see the module documentation'''
+    import uuid
+    now = datetime.datetime.now()
+    never = db.date_range[1]
+    changes = Changes()
+
+    # the group tree by groupid, None being the top
+    paths = db.group_paths()
+    children = {None: []}
+    by_path = {}
+    breadcrumb = []
+    for group in db.groups:
+        del breadcrumb[group.level:]
+        children[breadcrumb[-1] if breadcrumb else None].append(group.groupid)
+        children[group.groupid] = []
+        breadcrumb.append(group.groupid)
+        by_path.setdefault(tuple(paths[group.groupid]), group.groupid)
+        continue
+    used = set(children)
+
+    def ensure(path):
+        'Return the groupid of the group path, adding groups as needed'
+        groupid = by_path.get(path)
+        if groupid is not None:
+            return groupid
+        if not path:
+            raise ValueError, 'Entries need a group path'
+        parent = ensure(path[:-1]) if len(path) > 1 else None
+        group = GroupInfo()
+        group.groupid = db.gen_groupid(used)
+        group.group_name = path[-1]
+        group.imageid = 1
+        group.creation_time = group.last_mod_time = group.last_acc_time = now
+        group.expiration_time = never
+        group.level = len(path) - 1
+        group.flags = 0
+        group.update_order()
+        used.add(group.groupid)
+        children[parent].append(group.groupid)
+        children[group.groupid] = []
+        by_path[path] = group.groupid
+        changes.groups_added.append(group)
+        return group.groupid
+
+    wanted = set()
+    for path in spec.get('groups') or []:
+        path = _path(path)
+        ensure(path)
+        wanted.update(path[:ind] for ind in range(1, len(path)+1))
+        continue
+
+    by_uuid = dict((ent.uuid, ent) for ent in db.entries)
+    by_key = {}
+    for ent in db.entries:
+        by_key.setdefault((tuple(paths.get(ent.groupid, ())), ent.title, ent.username), ent)
+        continue
+    seen = set()
+    for item in spec.get('entries') or []:
+        path = _path(item.get('path', ''))
+        values = dict((name, _text(item[name])) for name in FIELDS if name in item)
+        values['groupid'] = ensure(path)
+        wanted.update(path[:ind] for ind in range(1, len(path)+1))
+        ident = item.get('uuid') and _text(item['uuid']).lower()
+        ent = by_uuid.get(ident) if ident else \
+            by_key.get((path, values.get('title'), values.get('username')))
+        if ent is None:
+            new = EntryInfo()
+            new.uuid = ident or uuid.uuid4().hex
+            new.imageid = 1
+            for name in FIELDS:
+                setattr(new, name, '')
+                continue
+            new.__dict__.update(values)
+            new.creation_time = new.last_mod_time = new.last_acc_time = now
+            new.expiration_time = never
+            new.binary_desc = ''
+            new.binary_data = None
+            new.update_order()
+            changes.entries_added.append(new)
+            by_uuid[new.uuid] = new
+            seen.add(new.uuid)
+            continue
+        if ent.uuid in seen:
+            raise ValueError, 'Entry "%s" is named twice'%ent.title
+        seen.add(ent.uuid)
+        if all(ent.__dict__.get(name) == value for name,value in values.iteritems()):
+            continue
+        new = copy(ent)
+        new.order = list(ent.order)
+        new.__dict__.update(values)
+        new.last_mod_time = now
+        new.update_order()
+        changes.entries_changed.append((ent, new))
+        continue
+
+    if prune:
+        changes.entries_removed = [ent for ent in db.entries if ent.uuid not in seen]
+        changes.groups_removed = [group for group in db.groups
+                                  if tuple(paths[group.groupid]) not in wanted]
+    if changes.groups_added or changes.groups_removed:
+        removed = set(group.groupid for group in changes.groups_removed)
+        order = []
+        stack = list(reversed(children[None]))
+        while stack:
+            groupid = stack.pop()
+            if groupid in removed: continue
+            order.append(groupid)
+            stack.extend(reversed(children[groupid]))
+            continue
+        changes.group_order = order
+    return changes
+
+def _fields(old, new):
+    'Return the names of the fields which differ between two info blocks'
+    return sorted(name for name,value in new.__dict__.iteritems()
+                  if name not in UNSHOWN and old.__dict__.get(name) != value)
+
+def describe(db, changes):
+    '''Return lines describing the changes to the database, naming the
+    fields changed but never their values'''
+    import cache
+    before = db.group_paths()
+    target = cache.view(db)
+    apply(target, changes)
+    after = target.group_paths()
+    def where(paths, groupid):
+        return '/' + '/'.join(paths.get(groupid, ['?']))
+    def entry(paths, ent):
+        return '%s/%s (%s)'%(where(paths, ent.groupid), ent.title, ent.username)
+    ret = []
+    ret += ['+ group %s'%where(after, group.groupid) for group in changes.groups_added]
+    ret += ['~ group %s: %s'%(where(after, new.groupid), ', '.join(_fields(old, new)))
+            for old,new in changes.groups_changed]
+    ret += ['- group %s'%where(before, group.groupid) for group in changes.groups_removed]
+    ret += ['+ entry %s'%entry(after, ent) for ent in changes.entries_added]
+    ret += ['~ entry %s: %s'%(entry(after, new), ', '.join(_fields(old, new)))
+            for old,new in changes.entries_changed]
+    ret += ['- entry %s'%entry(before, ent) for ent in changes.entries_removed]
+    return ret
@@ -44,8 +44,6 @@ Notes:
 # Free Software Foundation; either version 2, or (at your option) any
 # later version.
 
-import Crypto.Random
-
 class DBHDR(object):
     '''
     Interface to the database header chunk.
@@ -89,6 +87,7 @@ class DBHDR(object):
             self.reset_random_fields()
     
     def reset_random_fields(self):
+        import Crypto.Random
         rng = Crypto.Random.new()
         self.encryption_iv  = rng.read(16)
         self.master_seed    = rng.read(16)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+'''
+Sorted indexes over the time fields of entries.
+
+Entries are kept sorted on an integer key equal to the 5-byte packed
+date/time of the KeePass file format read as a big-endian number, so
+range queries are a pair of bisections and comparing keys never
+builds datetime objects.
+'''
+
+# This file is part of python-keepass and is Copyright (C) 2012 Brett Viren.
+#
+# This code is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any
+# later version.
+
+from bisect import bisect_left, bisect_right
+
+def pack_time(when):
+    'Return the integer key of a datetime, ordered like the datetimes'
+    return (when.year << 26) | (when.month << 22) | (when.day << 17) | \
+        (when.hour << 12) | (when.minute << 6) | when.second
+
+def packed_key(buf):
+    'Return the integer key of a 5-byte packed date/time string'
+    import struct
+    hi,lo = struct.unpack('>BI', buf)
+    return (hi << 32) | lo
+
+class TimeIndex(object):
+    '''
+    Entries sorted by one of their time fields.  Entries are tracked
+    by identity so they can be removed or re-sorted after their time
+    field changed.
+    '''
+
+    def __init__(self, field, entries=()):
+        self.field = field
+        pairs = sorted(((pack_time(getattr(ent, field)), ind, ent)
+                        for ind,ent in enumerate(entries)))
+        self.keys = [key for key,ind,ent in pairs]
+        self.entries = [ent for key,ind,ent in pairs]
+        self._key_of = dict((id(ent), key) for key,ind,ent in pairs)
+        return
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry):
+        'Add an entry'
+        key = pack_time(getattr(entry, self.field))
+        pos = bisect_right(self.keys, key)
+        self.keys.insert(pos, key)
+        self.entries.insert(pos, entry)
+        self._key_of[id(entry)] = key
+        return
+
+    def remove(self, entry):
+        'Remove an entry, using the key it was added with'
+        key = self._key_of.pop(id(entry), None)
+        if key is None: return
+        pos = bisect_left(self.keys, key)
+        while self.entries[pos] is not entry:
+            pos += 1
+        del self.keys[pos]
+        del self.entries[pos]
+        return
+
+    def update(self, entry):
+        'Re-sort an entry after its time field changed'
+        self.remove(entry)
+        self.add(entry)
+        return
+
+    def between(self, start=None, end=None):
+        'Return entries with start <= time < end, either may be None'
+        lo = 0
+        hi = len(self.keys)
+        if start is not None:
+            lo = bisect_left(self.keys, pack_time(start))
+        if end is not None:
+            hi = bisect_left(self.keys, pack_time(end))
+        return self.entries[lo:hi]
+
+    pass
@@ -13,16 +13,22 @@ Classes and functions for the GroupInfo and EntryInfo blocks of a keepass file
 
 import struct
 import sys
+import datetime
+
+from attachment import Attachment
 
 # return tupleof (decode,encode) functions
 
 def null_de(): return (lambda buf:None, lambda val:None)
 def shunt_de(): return (lambda buf:buf, lambda val:val)
 
+def attachment_de():
+    return (lambda buf:Attachment(buf), lambda val:val)
+
 def ascii_de():
     from binascii import b2a_hex, a2b_hex
     return (lambda buf:b2a_hex(buf).replace('\0',''), 
-            lambda val:a2b_hex(val)+'\0')
+            lambda val:a2b_hex(val))
 
 def string_de():
     return (lambda buf: buf.replace('\0',''), lambda val: val+'\0')
@@ -61,12 +67,59 @@ def date_de():
 class InfoBase(object):
     'Base class for info type blocks'
 
-    def __init__(self,format,string=None):
+    # fields decoded from a view into the buffer rather than a copy
+    lazy = ()
+    # fields holding a datetime
+    dates = ('creation_time','last_mod_time','last_acc_time','expiration_time')
+
+    def __init__(self,format,string=None,offset=0):
         self.format = format
         self.order = []         # keep field order
-        if string: self.decode(string)
+        if string: self.decode(string,offset)
         return
 
+    def __getstate__(self):
+        # the format holds the (un-picklable) decode/encode functions
+        state = dict(self.__dict__)
+        del state['format']
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.format = self.__class__.format
+        return
+
+    def marshal_state(self):
+        '''Return the state in types the marshal module can hold, which
+        is much faster to pass between processes than a pickle'''
+        state = dict(self.__dict__)
+        del state['format']
+        for name in self.dates:
+            if name in state:
+                state[name] = state[name].timetuple()[:6]
+            continue
+        for name in self.lazy:
+            if name in state:
+                state[name] = str(state[name])
+            continue
+        return state
+
+    @classmethod
+    def from_marshal_state(cls,state):
+        'Return a new object from the result of marshal_state()'
+        for name in cls.dates:
+            if name in state:
+                state[name] = datetime.datetime(*state[name])
+            continue
+        for name in cls.lazy:
+            if name in state:
+                state[name] = Attachment(state[name])
+            continue
+        state['format'] = cls.format
+        self = cls.__new__(cls)
+        self.__dict__ = state
+        return self
+
     def __str__(self):
         ret = [self.__class__.__name__ + ':']
         for num,form in self.format.iteritems():
@@ -77,22 +130,36 @@ class InfoBase(object):
             ret.append('\t%s %s'%(form[0],value))
         return '\n'.join(ret)
 
-    def decode(self,string):
-        'Fill self from binary string'
-        index = 0
+    def fields(self):
+        'Return a dictionary of the decoded field values'
+        ret = {}
+        for name,decenc in self.format.itervalues():
+            if name in (None,'ignored'): continue
+            if name not in self.__dict__: continue
+            ret[name] = self.__dict__[name]
+            continue
+        return ret
+
+    def decode(self,string,offset=0):
+        'Fill self from binary string starting at the given offset'
+        index = offset
         while True:
-            substr = string[index:index+6]
+            typ,siz = struct.unpack_from('<H I',string,index)
             index += 6
-            typ,siz = struct.unpack('<H I',substr)
             self.order.append((typ,siz))
 
-            substr = string[index:index+siz]
-            index += siz
-            buf = struct.unpack('<%ds'%siz,substr)[0]
-
             name,decenc = self.format[typ]
             if name is None: break
+            if siz and name in self.lazy:
+                buf = memoryview(string)[index:index+siz]
+            else:
+                buf = string[index:index+siz]
+                if isinstance(buf, bytearray):
+                    buf = str(buf)      # decrypted payloads are bytearrays
+            index += siz
             try:
+                if len(buf) != siz:
+                    raise struct.error, 'field truncated at %d bytes' % len(buf)
                 value = decenc[0](buf)
             except struct.error,msg:
                 msg = '%s, typ = %d[%d] -> %s buf = "%s"'%\
@@ -111,7 +178,12 @@ class InfoBase(object):
 
     def encode(self):
         'Return binary string representation'
-        string = ""
+        return ''.join(chunk.tobytes() if isinstance(chunk,memoryview) else chunk
+                       for chunk in self.encode_chunks())
+
+    def encode_chunks(self):
+        '''Yield the binary representation in pieces.  Attachments are
+        yielded as chunks of their data rather than copied whole.'''
         for typ,siz in self.order:
             if typ == 0xFFFF:   # end of block
                 encoded = None
@@ -120,13 +192,41 @@ class InfoBase(object):
                 value = self.__dict__[name]
                 encoded = decenc[1](value)
                 pass
-            buf = struct.pack('<H',typ)
-            buf += struct.pack('<I',siz)
-            if encoded is not None:
-                buf += struct.pack('<%ds'%siz,encoded)
-            string += buf
+            yield struct.pack('<HI',typ,siz)
+            if encoded is None:
+                continue
+            if isinstance(encoded,Attachment):
+                if len(encoded) != siz:
+                    raise ValueError, 'Attachment size %d does not match field size %d'%\
+                        (len(encoded),siz)
+                for chunk in encoded.chunks():
+                    yield chunk
+                continue
+            yield struct.pack('<%ds'%siz,encoded)
+            continue
+        return
+
+    def update_order(self):
+        '''Set the field sizes from the current values, adding any
+        fields set on this object but missing from the order'''
+        present = set(typ for typ,siz in self.order)
+        order = [(typ,siz) for typ,siz in self.order if typ != 0xFFFF]
+        for typ in sorted(self.format):
+            name = self.format[typ][0]
+            if typ in present or name in (None,'ignored'): continue
+            if name in self.__dict__:
+                order.append((typ,0))
             continue
-        return string
+        self.order = []
+        for typ,siz in order:
+            name,decenc = self.format[typ]
+            if name != 'ignored':
+                encoded = decenc[1](self.__dict__[name])
+                siz = len(encoded) if encoded is not None else 0
+            self.order.append((typ,siz))
+            continue
+        self.order.append((0xFFFF,0))
+        return
 
     pass
 
@@ -171,8 +271,8 @@ Notes:
         0xFFFF: (None,None),
         }
 
-    def __init__(self,string=None):
-        super(GroupInfo,self).__init__(GroupInfo.format,string)
+    def __init__(self,string=None,offset=0):
+        super(GroupInfo,self).__init__(GroupInfo.format,string,offset)
         return
 
     def name(self):
@@ -226,12 +326,14 @@ Notes:
         0xb: ('last_acc_time',date_de()),
         0xc: ('expiration_time',date_de()),
         0xd: ('binary_desc',string_de()),
-        0xe: ('binary_data',shunt_de()),  #size ??  if None = 0?
+        0xe: ('binary_data',attachment_de()),  #size ??  if None = 0?
         0xFFFF: (None,None),
         }
 
-    def __init__(self,string=None):
-        super(EntryInfo,self).__init__(EntryInfo.format,string)
+    lazy = ('binary_data',)
+
+    def __init__(self,string=None,offset=0):
+        super(EntryInfo,self).__init__(EntryInfo.format,string,offset)
         return
 
     def name(self):
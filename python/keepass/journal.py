@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+'''
+An append-only journal of changes on top of a database file.
+
+Writing a database re-encodes and re-encrypts all of it and runs a
+new key transformation.  A JournaledDatabase instead appends the
+entries added, changed or removed since the last commit to
+"<file>.journal" and replays them when the file is next opened.  The
+journal is folded back into a standard file by compact(), which runs
+on its own once the journal grows past a threshold.
+
+Each record holds one change, encoded as the KeePass file format
+encodes entries and groups, encrypted with AES-CBC and authenticated
+with an HMAC chained over all earlier records.  Both keys are derived
+from the final key of the base file and the journal starts with the
+contents hash of that file, so a journal only applies to the exact
+file it was written against.  Opening a file whose journal was
+written against another version of it raises ValueError and leaves
+the journal alone.  Compaction renames the journal to
+"<file>.journal.compacted" before writing the new base and removes it
+after; if it was interrupted, opening the file removes that journal
+when the base was written and restores it when not.  An incomplete
+last record, from a crash while appending, is ignored.
+
+Commits, compaction and that recovery hold the lock Database.write()
+takes on the base file.  A commit or compaction finding that another
+writer changed the base file or appended to the journal since this
+database read it raises kpdb.WriteConflict and changes nothing; open
+the file again to go on from the other writer's changes.  Writing the
+database to its base file with write() compacts.
+
+commit() costs time in the number of changes when they were made
+through the Database methods, which report the entries they change.
+Entries changed in place otherwise must be passed to changed().
+'''
+
+# This file is part of python-keepass and is Copyright (C) 2012 Brett Viren.
+#
+# This code is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any
+# later version.
+
+import os
+import struct
+import hashlib
+
+from kpdb import Database, WriteConflict, locked, file_contents_hash
+from infoblock import GroupInfo, EntryInfo
+
+MAGIC = 'KPDBJNL\x01'
+BLOCK = 16
+MACSIZE = 32
+
+# record types
+GROUPS = 'G'    # all groups, replacing the current ones
+ENTRY = 'E'     # an entry, replacing the one with the same uuid
+REMOVE = 'R'    # the uuid of an entry to remove
+
+def journal_name(filename):
+    'Return the name of the journal of the given database file'
+    return filename + '.journal'
+
+def compacted_name(filename):
+    'Return the name the journal of the file has while compacting'
+    return journal_name(filename) + '.compacted'
+
+def exists(filename):
+    'Return True if the database file has a journal, maybe mid-compaction'
+    return os.path.exists(journal_name(filename)) or \
+        os.path.exists(compacted_name(filename))
+
+def _journal_base(path):
+    'Return the contents hash of the base file the journal was written against'
+    with open(path, 'rb') as fp:
+        data = fp.read(len(MAGIC) + 32)
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError, 'Not a journal file: %s'%path
+    return data[len(MAGIC):]
+
+def _keys(finalkey):
+    'Return the (encryption, authentication) keys of a journal'
+    return (hashlib.sha256('journal encryption' + finalkey).digest(),
+            hashlib.sha256('journal authentication' + finalkey).digest())
+
+def _digest(info):
+    return hashlib.sha256(info.encode()).digest()
+
+
+class JournaledDatabase(Database):
+    '''
+    A database read from a file and the journal of changes made to it
+    since.  Change it as any Database then call commit() to append the
+    changes to the journal.
+    '''
+
+    threshold = 1 << 20         # compact once the journal is larger
+    _dirty = None               # uuid -> entry changed since the last commit or None
+                                # if removed, all may have changed if None
+
+    def __init__(self, filename, masterkey="", stats=None, threshold=None,
+                 progress=None, cancel=None, deadline=None):
+        if threshold is not None:
+            self.threshold = threshold
+        self.filename = filename
+        Database.__init__(self, filename, masterkey, stats, progress, cancel, deadline)
+        self._base_hash = self.header.contents_hash
+        self._mac = self._base_hash
+        self._journal_size = 0
+        self.replay()
+        return
+
+    def write(self, filename, masterkey="", index=None, *args, **kwds):
+        '''Database.write(), but writing to the base file compacts the
+        journal into it rather than leaving one which no longer applies'''
+        if os.path.realpath(filename) != os.path.realpath(self.filename):
+            return Database.write(self, filename, masterkey, index, *args, **kwds)
+        self.compact(masterkey, index)
+        return self.header, self.finalkey
+
+    def __copy__(self):
+        'Return a shallow copy keeping its own record of what was committed'
+        ret = self.__class__.__new__(self.__class__)
+        ret.__dict__.update(self.__dict__)
+        ret._digests = dict(self._digests)
+        ret._dirty = None       # the entries of a copy are not those committed
+        return ret
+
+    def replay(self):
+        '''Apply the records in the journal, if any, to the groups and
+        entries read from the base file'''
+        import hmac
+        from Crypto.Cipher import AES
+        path = journal_name(self.filename)
+        self._mac = self._base_hash
+        self._journal_size = 0
+        compacted = compacted_name(self.filename)
+        data = None
+        with locked(os.path.realpath(self.filename)):
+            if os.path.exists(compacted):
+                if _journal_base(compacted) != self._base_hash:
+                    os.remove(compacted)    # the compaction wrote the base
+                elif os.path.exists(path):
+                    raise ValueError, 'Both %s and %s exist'%(path, compacted)
+                else:
+                    os.rename(compacted, path)
+            if os.path.exists(path):
+                if _journal_base(path) != self._base_hash:
+                    raise ValueError, 'Journal %s was written against another version of %s'%\
+                        (path, self.filename)
+                with open(path, 'rb') as fp:
+                    data = fp.read()
+        if data is not None:
+            with self._phase('replay') as phase:
+                phase.nbytes = len(data)
+                enckey,mackey = _keys(self.finalkey)
+                entries = list(self.entries)
+                where = dict((ent.uuid, ind) for ind,ent in enumerate(entries))
+                offset = len(MAGIC) + 32
+                while offset + 4 <= len(data):
+                    size, = struct.unpack_from('<I', data, offset)
+                    end = offset + 4 + size + MACSIZE
+                    if end > len(data): break       # interrupted append
+                    body = data[offset+4:offset+4+size]
+                    mac = hmac.new(mackey, self._mac + body, hashlib.sha256).digest()
+                    if not hmac.compare_digest(mac, data[end-MACSIZE:end]):
+                        raise ValueError, 'Journal %s is damaged or the key is wrong'%path
+                    plain = AES.new(enckey, AES.MODE_CBC, body[:BLOCK]).decrypt(body[BLOCK:])
+                    self._apply(plain[:-ord(plain[-1])], entries, where)
+                    self._mac = mac
+                    offset = end
+                    continue
+                self.entries = [ent for ent in entries if ent is not None]
+                self._time_indexes = None
+                self._journal_size = offset
+        self._snapshot()
+        return
+
+    def _apply(self, record, entries, where):
+        '''Apply one decrypted journal record to the groups and to the
+        entries being replayed, removed ones left as None, and where, a
+        dictionary from uuid to index in entries'''
+        typ,data = record[0],record[1:]
+        if typ == GROUPS:
+            groups = []
+            offset = 0
+            while offset < len(data):
+                group = GroupInfo(data, offset)
+                groups.append(group)
+                offset += len(group)
+                continue
+            self.groups = groups
+        elif typ == ENTRY:
+            entry = EntryInfo(data)
+            ind = where.pop(entry.uuid, None)
+            if ind is not None:
+                entries[ind] = None
+            where[entry.uuid] = len(entries)
+            entries.append(entry)
+        elif typ == REMOVE:
+            ind = where.pop(data, None)
+            if ind is not None:
+                entries[ind] = None
+        else:
+            raise ValueError, 'Unknown journal record type: %r'%typ
+        return
+
+    def _groups_digest(self):
+        return hashlib.sha256(''.join(g.encode() for g in self.groups)).digest()
+
+    def _snapshot(self):
+        '''Remember the groups and entries as committed, with the digest
+        of the groups and of each entry by uuid'''
+        self._committed_groups = (self.groups, list(self.groups), self._groups_digest())
+        self._committed_entries = (self.entries, len(self.entries))
+        self._digests = dict((ent.uuid, (ent, _digest(ent))) for ent in self.entries)
+        self._dirty = {}
+        return
+
+    def _reindex(self, added=(), removed=()):
+        'Note the changed entries for commit() as well'
+        Database._reindex(self, added, removed)
+        if self._dirty is not None:
+            for ent in removed:
+                self._dirty[ent.uuid] = None
+            for ent in added:
+                self._dirty[ent.uuid] = ent
+        return
+
+    def changed(self, entries=None):
+        '''Note entries changed in place other than through the Database
+        methods, by default all of them'''
+        if entries is None:
+            self._dirty = None
+            self._time_indexes = None
+            return
+        Database.changed(self, entries)
+        return
+
+    def check(self, repair=False):
+        'Database.check(), noting any repairs for commit()'
+        problems = Database.check(self, repair)
+        if repair and problems:
+            self.changed()
+        return problems
+
+    def commit(self):
+        '''Append the changes made since the last commit to the journal
+        and return the number of records written.  Compacts if the
+        journal grew past the threshold.'''
+        with locked(os.path.realpath(self.filename)):
+            self._check_journal()
+            return self._commit()
+
+    def _commit(self):
+        records = []
+        groups,members,digest = self._committed_groups
+        if self._dirty is None or self.groups is not groups or \
+                len(members) != len(self.groups) or \
+                any(old is not new for old,new in zip(members, self.groups)):
+            new = self._groups_digest()
+            if new != digest:
+                records.append(GROUPS + ''.join(g.encode() for g in self.groups))
+            digest = new
+        self._committed_groups = (self.groups, list(self.groups), digest)
+
+        dirty,digests = self._dirty,self._digests
+        entries,count = self._committed_entries
+        if dirty is None or self.entries is not entries or len(self.entries) != count:
+            # the entries were replaced: compare every one, encoding
+            # only those which are not the objects committed
+            current = set()
+            for ent in self.entries:
+                current.add(ent.uuid)
+                old = digests.get(ent.uuid)
+                if old and old[0] is ent and (dirty is not None and ent.uuid not in dirty):
+                    continue
+                self._record_entry(ent, records)
+                continue
+            removed = [uuid for uuid in digests if uuid not in current]
+        else:
+            removed = []
+            for uuid,ent in dirty.iteritems():
+                if ent is None:
+                    removed.append(uuid)
+                else:
+                    self._record_entry(ent, records)
+                continue
+        for uuid in removed:
+            if digests.pop(uuid, None):
+                records.append(REMOVE + uuid)
+            continue
+
+        if records:
+            self._append(records)
+        self._committed_entries = (self.entries, len(self.entries))
+        self._dirty = {}
+        if self._journal_size > self.threshold:
+            self.compact()
+        return len(records)
+
+    def _record_entry(self, ent, records):
+        'Add a record of the entry to records if it changed since committed'
+        digest = _digest(ent)
+        old = self._digests.get(ent.uuid)
+        self._digests[ent.uuid] = (ent, digest)
+        if not old or old[1] != digest:
+            records.append(ENTRY + ent.encode())
+        return
+
+    def _append(self, records):
+        'Encrypt, authenticate and append the records to the journal'
+        import hmac
+        from Crypto.Cipher import AES
+        from Crypto import Random
+        enckey,mackey = _keys(self.finalkey)
+        out = []
+        if not self._journal_size:
+            out.append(MAGIC + self._base_hash)
+        mac = self._mac
+        for record in records:
+            padding = BLOCK - len(record) % BLOCK
+            iv = Random.new().read(BLOCK)
+            body = iv + AES.new(enckey, AES.MODE_CBC, iv).encrypt(record + chr(padding)*padding)
+            mac = hmac.new(mackey, mac + body, hashlib.sha256).digest()
+            out.append(struct.pack('<I', len(body)) + body + mac)
+            continue
+        data = ''.join(out)
+        with self._phase('journal', len(data)):
+            mode = 'r+b' if self._journal_size else 'wb'
+            with open(journal_name(self.filename), mode) as fp:
+                fp.seek(self._journal_size)     # drop any interrupted append
+                fp.write(data)
+                fp.truncate()
+                fp.flush()
+                os.fsync(fp.fileno())
+        self._mac = mac
+        self._journal_size += len(data)
+        return
+
+    def _check_journal(self):
+        '''Raise WriteConflict if the base file or the journal changed
+        since this database read or wrote them, other than by an
+        interrupted append.  Call holding the lock of the base file.'''
+        import hmac
+        if file_contents_hash(self.filename) != self._base_hash:
+            raise WriteConflict, 'File %s changed since it was read'%self.filename
+        try:
+            with open(journal_name(self.filename), 'rb') as fp:
+                data = fp.read()
+        except IOError:
+            data = ''
+        start = self._journal_size or len(MAGIC) + MACSIZE
+        if len(data) < start:
+            if self._journal_size:
+                raise WriteConflict, 'Journal of %s was removed'%self.filename
+            return
+        # the journal ends with the MAC of the last record, or the base hash
+        if data[start-MACSIZE:start] != self._mac:
+            raise WriteConflict, 'Journal of %s was rewritten'%self.filename
+        if start + 4 > len(data):
+            return
+        size, = struct.unpack_from('<I', data, start)
+        end = start + 4 + size + MACSIZE
+        if end > len(data):
+            return              # an interrupted append, dropped by the next
+        mackey = _keys(self.finalkey)[1]
+        mac = hmac.new(mackey, self._mac + data[start+4:end-MACSIZE], hashlib.sha256).digest()
+        if hmac.compare_digest(mac, data[end-MACSIZE:end]):
+            raise WriteConflict, 'Journal of %s was appended to since it was read'%self.filename
+        return
+
+    def journal_size(self):
+        'Return the number of bytes in the journal'
+        return self._journal_size
+
+    def compact(self, masterkey="", index=None):
+        '''Write the current database as a standard file in place of
+        the base and remove the journal.  Optionally change the master
+        key and write the sidecar index as Database.write() does.'''
+        with locked(os.path.realpath(self.filename)):
+            self._check_journal()
+            if masterkey:
+                self.masterkey = masterkey
+            path = journal_name(self.filename)
+            compacted = compacted_name(self.filename)
+            if os.path.exists(path):
+                os.rename(path, compacted)
+            try:
+                self.header,self.finalkey = Database.write(self, self.filename,
+                                                           self.masterkey, index, merge=None)
+            except:
+                if os.path.exists(compacted):
+                    os.rename(compacted, path)
+                raise
+            if os.path.exists(compacted):
+                os.remove(compacted)
+        self._base_hash = self._mac = self.header.contents_hash
+        self._journal_size = 0
+        self._snapshot()
+        return
+
+    pass
@@ -20,20 +20,54 @@ General structure:
 
 import sys, struct, os
 import datetime
-import uuid
-import random
 from copy import copy
+from contextlib import contextmanager
 
 from header import DBHDR
 from infoblock import GroupInfo, EntryInfo
+from stats import NULL_PHASE
+
+class Cancelled(Exception):
+    'The key transformation was cancelled or ran past its deadline'
+    pass
+
+class WriteConflict(ValueError):
+    'The file changed since it was read and could not be merged'
+    pass
 
 class Database(object):
     '''
     Access a KeePass DB file of format v3
+
+    Give a stats.Stats object as stats to record the time spent in
+    each phase of reading, writing and building the hierarchy.
+
+    The master key transformation runs key_chunk rounds at a time when
+    given any of: a progress callable, called after each chunk with the
+    rounds done, the total and the estimated seconds left; a cancel
+    object such as a threading.Event, checked with
+    is_set(); or a deadline in seconds since the epoch.  Cancelling or
+    passing the deadline raises Cancelled.
     '''
+
+    stats = None
+    _time_indexes = None        # field name -> index.TimeIndex, built on demand
+    _base = None                # (real path, contents hash) of the file last read or written
+    _base_records = None        # (uuid, groupid) -> last_mod_time of the records in that file
+    parallel_threshold = 32 << 20   # decode payloads this large in worker processes, see _use_parallel()
+    parallel_workers = None         # number of decoding processes, default: number of CPUs
+    pipeline_threshold = 8 << 20    # read files this large in overlapping threads, see pipeline.py
+    progress = None
+    cancel = None
+    deadline = None
+    key_chunk = 1 << 14             # key transformation rounds between checks
     
-    def __init__(self, filename = None, masterkey=""):
+    def __init__(self, filename = None, masterkey="", stats=None,
+                 progress=None, cancel=None, deadline=None):
         self.masterkey = masterkey
+        if stats is not None:
+            self.stats = stats
+        self._key_options(progress, cancel, deadline)
         if filename:
             self.read(filename)
             return
@@ -42,41 +76,142 @@ class Database(object):
         self.entries = []
         return
 
-    def read(self,filename):
-        'Read in given .kdb file'
-        fp = open(filename)
-        buf = fp.read()
-        fp.close()
+    def _key_options(self, progress=None, cancel=None, deadline=None):
+        'Set the given options of the key transformation'
+        if progress is not None:
+            self.progress = progress
+        if cancel is not None:
+            self.cancel = cancel
+        if deadline is not None:
+            self.deadline = deadline
+        return
 
-        headbuf = buf[:124]
-        self.header = DBHDR(headbuf)
-        self.groups = []
-        self.entries = []
+    def read(self,filename,progress=None,cancel=None,deadline=None):
+        '''Read in given .kdb file.  Any progress, cancel or deadline
+        given are kept for later key transformations.'''
+        self._key_options(progress, cancel, deadline)
+        with open(filename,'rb') as fp:
+            self._read_fileobj(fp)
+        self._set_base(os.path.realpath(filename), self.header.contents_hash)
+        return
+
+    def _set_base(self, path, contents_hash):
+        'Remember the file this DB was read from or written to, for write()'
+        self._base = (path, contents_hash)
+        self._base_records = (dict((ent.uuid, ent.last_mod_time) for ent in self.entries),
+                              dict((group.groupid, group.last_mod_time)
+                                   for group in self.groups))
+        return
+
+    def _read_fileobj(self,fp):
+        'Fill this DB from the rest of the binary file object'
+        size = remaining_size(fp)
+        if size is not None and self._use_pipeline(size):
+            import pipeline
+            pipeline.read(self, fp, size)
+            return
+        with self._phase('read') as phase:
+            buf = read_all(fp)
+            phase.nbytes = len(buf)
+        self.parse_payload(self.decrypt(buf))
+        return
+
+    def _use_pipeline(self, size):
+        '''Return True to read a file of the size with pipeline.read().
+        Files large enough to parse in parallel processes are not, nor
+        are any where there is one CPU for the threads to share.'''
+        if self.pipeline_threshold is None or size < self.pipeline_threshold:
+            return False
+        if self._use_parallel(size):
+            return False
+        import multiprocessing
+        return multiprocessing.cpu_count() > 1
+
+    def _use_parallel(self, size):
+        '''Return True to decode a payload of the size with
+        parse_parallel().  Only the main thread forks the workers, so
+        payloads read in other threads, such as those of the agent or
+        of aio, are decoded in order.  So are all where there is one
+        worker, by default on a machine with one CPU.'''
+        if self.parallel_threshold is None or size < self.parallel_threshold:
+            return False
+        if not _can_fork():
+            return False
+        import multiprocessing
+        return (self.parallel_workers or multiprocessing.cpu_count()) > 1
+
+    @classmethod
+    def from_bytes(cls, data, masterkey="", stats=None,
+                   progress=None, cancel=None, deadline=None):
+        '''Return the DB held in the given file contents, a string or
+        any object supporting the buffer protocol, which is not copied'''
+        db = cls(None, masterkey, stats, progress, cancel, deadline)
+        db.parse_payload(db.decrypt(data))
+        return db
+
+    @classmethod
+    def from_fileobj(cls, fp, masterkey="", stats=None,
+                     progress=None, cancel=None, deadline=None):
+        'Return the DB read from the rest of the binary file object'
+        db = cls(None, masterkey, stats, progress, cancel, deadline)
+        db._read_fileobj(fp)
+        return db
+
+    def _phase(self, name, nbytes=0):
+        'Return a context manager timing the named phase if keeping stats'
+        if self.stats is None:
+            return NULL_PHASE
+        return self.stats.phase(name, nbytes)
+
+    def decrypt(self,buf):
+        '''Set the header from the given file contents and return the
+        decrypted payload'''
+        buf = memoryview(buf)
+        self.header = DBHDR(buf[:124].tobytes())
 
         payload = buf[124:]
 
-        self.finalkey = self.final_key(self.masterkey,
-                                       self.header.master_seed,
-                                       self.header.master_seed2,
-                                       self.header.key_enc_rounds)
+        with self._phase('final_key'):
+            self.finalkey = self.final_key(self.masterkey,
+                                           self.header.master_seed,
+                                           self.header.master_seed2,
+                                           self.header.key_enc_rounds)
         payload = self.decrypt_payload(payload, self.finalkey, 
                                        self.header.encryption_type(),
                                        self.header.encryption_iv)
+        return payload
+
+    def parse_payload(self,payload):
+        'Fill groups and entries from the decrypted payload buffer'
+        with self._phase('parse', len(payload)):
+            self._parse_payload(payload)
+        return
+
+    def _parse_payload(self,payload):
+        self.groups = []
+        self.entries = []
+        self._time_indexes = None
 
+        if self._use_parallel(len(payload)):
+            self.groups,self.entries = parse_parallel(payload,self.header.ngroups,
+                                                      self.header.nentries,
+                                                      self.parallel_workers)
+            return
+
+        offset = 0
         ngroups = self.header.ngroups
         while ngroups:
-            gi = GroupInfo(payload)
+            gi = GroupInfo(payload,offset)
             self.groups.append(gi)
-            length = len(gi)
-            payload = payload[length:]
+            offset += len(gi)
             ngroups -= 1
             continue
 
         nentries = self.header.nentries
         while nentries:
-            ei = EntryInfo(payload)
+            ei = EntryInfo(payload,offset)
             self.entries.append(ei)
-            payload = payload[len(ei):]
+            offset += len(ei)
             nentries -= 1
             continue
         return
@@ -84,65 +219,96 @@ class Database(object):
     def final_key(self,masterkey,masterseed,masterseed2,rounds):
         '''Munge masterkey into the final key for decrypting payload by
         encrypting it for the given number of rounds masterseed2 and
-        hashing it with masterseed.'''
+        hashing it with masterseed.  See the class documentation for
+        reporting progress and cancelling.'''
         from Crypto.Cipher import AES
-        import hashlib
+        import hashlib, time
 
         key = hashlib.sha256(masterkey).digest()
-        cipher = AES.new(masterseed2,  AES.MODE_ECB)
-        
-        while rounds:
-            rounds -= 1
-            key = cipher.encrypt(key)
+        encrypt = AES.new(masterseed2,  AES.MODE_ECB).encrypt
+
+        progress,cancel,deadline = self.progress,self.cancel,self.deadline
+        checking = progress or cancel is not None or deadline is not None
+        chunk = max(1, self.key_chunk) if checking else rounds
+        start = time.time()
+        done = 0
+        while done < rounds:
+            todo = min(chunk, rounds - done)
+            for ind in xrange(todo):
+                key = encrypt(key)
+            done += todo
+            if not checking: continue
+            now = time.time()
+            if progress:
+                progress(done, rounds, (now - start) * (rounds - done) / done)
+            if done == rounds: continue
+            if cancel is not None and cancel.is_set():
+                raise Cancelled, 'Key transformation cancelled after %d of %d rounds'%\
+                    (done, rounds)
+            if deadline is not None and now > deadline:
+                raise Cancelled, 'Key transformation passed its deadline after %d of %d rounds'%\
+                    (done, rounds)
             continue
         key = hashlib.sha256(key).digest()
         return hashlib.sha256(masterseed + key).digest()
 
     def decrypt_payload(self, payload, finalkey, enctype, iv):
-        'Decrypt payload (non-header) part of the buffer'
-
-        if enctype != 'Rijndael':
-            raise ValueError, 'Unsupported decryption type: "%s"'%enctype
+        '''Decrypt payload (non-header) part of the buffer with the
+        cipher backend of the encryption type, see cipher.py'''
+        import cipher
+        cipher.backend(enctype)         # fail early if unsupported
 
-        payload = self.decrypt_payload_aes_cbc(payload, finalkey, iv)
+        with self._phase('decrypt', len(payload)):
+            payload = cipher.decrypt(enctype, finalkey, iv, payload)
         crypto_size = len(payload)
 
         if ((crypto_size > 2147483446) or (not crypto_size and self.header.ngroups)):
             raise ValueError, "Decryption failed.\nThe key is wrong or the file is damaged"
 
         import hashlib
-        if self.header.contents_hash != hashlib.sha256(payload).digest():
+        with self._phase('hash', len(payload)):
+            digest = hashlib.sha256(payload).digest()
+        if self.header.contents_hash != digest:
             raise ValueError, "Decryption failed. The file checksum did not match."
 
         return payload
 
     def decrypt_payload_aes_cbc(self, payload, finalkey, iv):
         'Decrypt payload buffer with AES CBC'
-
-        from Crypto.Cipher import AES
-        cipher = AES.new(finalkey, AES.MODE_CBC, iv)
-        payload = cipher.decrypt(payload)
-        extra = ord(payload[-1])
-        payload = payload[:len(payload)-extra]
-        return payload
+        import cipher
+        return cipher.decrypt('Rijndael', finalkey, iv, payload)
 
     def encrypt_payload(self, payload, finalkey, enctype, iv):
         'Encrypt payload'
-        if enctype != 'Rijndael':
-            raise ValueError, 'Unsupported encryption type: "%s"'%enctype
-        return self.encrypt_payload_aes_cbc(payload, finalkey, iv)
+        import cipher
+        return cipher.encrypt(enctype, finalkey, iv, payload)
 
     def encrypt_payload_aes_cbc(self, payload, finalkey, iv):
         'Encrypt payload buffer with AES CBC'
-        from Crypto.Cipher import AES
-        cipher = AES.new(finalkey, AES.MODE_CBC, iv)
+        return self.encrypt_payload(payload, finalkey, 'Rijndael', iv)
+
+    def encrypt_payload_chunks(self, chunks, fp, finalkey, enctype, iv,
+                               bufsize=1<<16):
+        '''Encrypt the payload given as an iterable of chunks and write it
+        to the file object a buffer at a time.  Return the number of
+        plaintext bytes.'''
+        import cipher
+        encrypt = cipher.new(enctype, finalkey, iv).encrypt
+        length = 0
+        buf = bytearray()
+        for chunk in chunks:
+            buf += chunk
+            length += len(chunk)
+            if len(buf) < bufsize: continue
+            nbytes = len(buf) - len(buf) % cipher.BLOCK
+            fp.write(encrypt(bytes(buf[:nbytes])))
+            del buf[:nbytes]
+            continue
         # pad out and store amount as last value
-        length = len(payload)
-        encsize = (length/AES.block_size+1)*16
-        padding = encsize - length
-        for ind in range(padding):
-            payload += chr(padding)
-        return cipher.encrypt(payload)
+        padding = cipher.BLOCK - len(buf) % cipher.BLOCK
+        buf += chr(padding) * padding
+        fp.write(encrypt(bytes(buf)))
+        return length
         
     def __str__(self):
         ret = [str(self.header)]
@@ -150,21 +316,158 @@ class Database(object):
         ret += map(str,self.entries)
         return '\n'.join(ret)
 
-    def encode_payload(self):
-        'Return encoded, plaintext groups+entries buffer'
-        payload = ""
+    def iter_payload(self):
+        '''Yield the encoded, plaintext groups+entries buffer in pieces.
+        Attachment data is yielded as views, without copies.'''
         for group in self.groups:
-            payload += group.encode()
+            for chunk in group.encode_chunks():
+                yield chunk
         for entry in self.entries:
-            payload += entry.encode()
-        return payload
+            for chunk in entry.encode_chunks():
+                yield chunk
+        return
 
-    def write(self,filename,masterkey=""):
+    def encode_payload(self):
+        'Return encoded, plaintext groups+entries buffer'
+        return ''.join(chunk.tobytes() if isinstance(chunk,memoryview) else chunk
+                       for chunk in self.iter_payload())
+
+    def write(self,filename,masterkey="",index=None,merge='newest',retries=3,
+              progress=None,cancel=None,deadline=None):
         '''' 
         Write out DB to given filename with optional master key.
         If no master key is given, the one used to create this DB is used.
         Resets IVs and master seeds.
+
+        The file is replaced atomically by renaming a temporary file
+        over it while holding an advisory lock on "<filename>.lock",
+        which is removed again.  If this DB was read from or last
+        written to the file and the file changed since, the file is
+        read again with the given master key, or this DB's, and merged
+        into this DB by uuid with the merge policy (see merge()).
+        Entries and groups removed since the file was read by this DB,
+        or by the other writer without this DB changing them, stay
+        removed.  The write is then tried again, up to retries times.
+        Give merge=None to raise WriteConflict instead.
+
+        If index is True also write the encrypted sidecar index used
+        by open_lazy().  If None, rewrite it only if one exists.
+
+        Any progress, cancel or deadline given are kept for later key
+        transformations.
+
+        Return the header and final key of the written file.
         '''
+        import lazy
+        self._key_options(progress, cancel, deadline)
+        path = os.path.realpath(filename)
+        for attempt in range(retries+1):
+            # the key transformation and encryption happen unlocked
+            tmpname,header,finalkey = self._write_temp(path,masterkey)
+            try:
+                with locked(path):
+                    ondisk = file_contents_hash(path)
+                    if ondisk is None or not self._base or self._base[0] != path \
+                            or ondisk == self._base[1]:
+                        os.rename(tmpname,path)
+                        tmpname = None
+                        sidecar = lazy.sidecar_name(path)
+                        if index or (index is None and os.path.exists(sidecar)):
+                            lazy.write_sidecar(sidecar,
+                                               lazy.record_offsets(self,header.contents_hash),
+                                               finalkey)
+                        self._set_base(path,header.contents_hash)
+                        return header,finalkey
+            finally:
+                if tmpname:
+                    os.remove(tmpname)
+            if merge is None:
+                raise WriteConflict, 'File %s changed since it was read'%filename
+            with self._phase('merge'):
+                self._merge_base(self._read_conflict(path,masterkey),merge)
+            continue
+        raise WriteConflict, 'File %s kept changing, gave up after %d tries'%\
+            (filename,retries+1)
+
+    def _read_conflict(self,path,masterkey=""):
+        '''Return the DB in the file which changed since this DB read it,
+        trying the master key given to write() before this DB's'''
+        options = dict(stats=self.stats,progress=self.progress,
+                       cancel=self.cancel,deadline=self.deadline)
+        if masterkey and masterkey != self.masterkey:
+            try:
+                return Database(path,masterkey,**options)
+            except ValueError:
+                pass            # still under the key it was read with
+        return Database(path,self.masterkey,**options)
+
+    def _merge_base(self,other,policy):
+        '''Merge the other DB, read from the file after it changed, into
+        this one, three ways with the file as this DB read it.  Records
+        this DB removed since are left out of the other DB and records
+        the other removed are removed here if this DB did not change
+        them.'''
+        entries,groups = self._base_records or ({},{})
+        base,records = other._base,other._base_records
+        uuids,their_uuids = _removed(entries,self.entries,other.entries,'uuid')
+        groupids,their_groupids = _removed(groups,self.groups,other.groups,'groupid')
+        if their_uuids:
+            self._remove_entries(lambda ent: ent.uuid in their_uuids)
+        their_groupids -= set(ent.groupid for ent in self.entries)
+        if their_groupids:
+            self.groups = [group for group in self.groups
+                           if group.groupid not in their_groupids]
+        if uuids or groupids:
+            other.groups = [group for group in other.groups
+                            if group.groupid not in groupids]
+            other.entries = [ent for ent in other.entries
+                             if ent.uuid not in uuids and ent.groupid not in groupids]
+        self.merge(other,policy)
+        self._base,self._base_records = base,records
+        return
+
+    def _write_temp(self,path,masterkey=""):
+        '''Write the file contents to a new temporary file next to the
+        path, with the permissions of any existing file.  Return its
+        name and the header and final key used.'''
+        import tempfile
+        dirname,basename = os.path.split(path)
+        fd,tmpname = tempfile.mkstemp(prefix='.%s.'%basename,suffix='.tmp',dir=dirname)
+        try:
+            with os.fdopen(fd,'wb') as fp:
+                header,finalkey = self.to_fileobj(fp,masterkey)
+                fp.flush()
+                os.fsync(fp.fileno())
+            if os.path.exists(path):
+                import stat
+                os.chmod(tmpname,stat.S_IMODE(os.stat(path).st_mode))
+        except:
+            os.remove(tmpname)
+            raise
+        return tmpname,header,finalkey
+
+    @classmethod
+    def open_lazy(cls, filename, masterkey="", verify='background', stats=None):
+        '''Return a lazy.LazyDatabase reading single records of the file
+        through its sidecar index'''
+        import lazy
+        return lazy.LazyDatabase(filename, masterkey, verify, stats)
+
+    def to_bytes(self,masterkey=""):
+        '''
+        Return the file contents for this DB with optional master key.
+        Resets IVs and master seeds.
+        '''
+        from cStringIO import StringIO
+        fp = StringIO()
+        self.to_fileobj(fp,masterkey)
+        return fp.getvalue()
+
+    def to_fileobj(self,fp,masterkey=""):
+        '''Write the file contents to the binary file object and return
+        the header and final key used.  The payload is encoded twice, once
+        to hash it for the header and once while encrypting it, so that
+        it is never held whole in memory.'''
         import hashlib
 
         header = copy(self.header)
@@ -172,23 +475,27 @@ class Database(object):
         header.nentries = len(self.entries)
         header.reset_random_fields()
 
-        payload = self.encode_payload()
-        header.contents_hash = hashlib.sha256(payload).digest()
+        with self._phase('hash') as phase:
+            digest = hashlib.sha256()
+            length = 0
+            for chunk in self.iter_payload():
+                digest.update(chunk)
+                length += len(chunk)
+            header.contents_hash = digest.digest()
+            phase.nbytes = length
 
-        finalkey = self.final_key(masterkey = masterkey or self.masterkey,
-                                  masterseed = header.master_seed,
-                                  masterseed2 = header.master_seed2,
-                                  rounds = header.key_enc_rounds)
+        with self._phase('final_key'):
+            finalkey = self.final_key(masterkey = masterkey or self.masterkey,
+                                      masterseed = header.master_seed,
+                                      masterseed2 = header.master_seed2,
+                                      rounds = header.key_enc_rounds)
 
-        payload = self.encrypt_payload(payload, finalkey, 
-                                       header.encryption_type(),
-                                       header.encryption_iv)
-
-        fp = open(filename,'w')
-        fp.write(header.encode())
-        fp.write(payload)
-        fp.close()
-        return
+        with self._phase('encrypt', length):
+            fp.write(header.encode())
+            self.encrypt_payload_chunks(self.iter_payload(), fp, finalkey,
+                                        header.encryption_type(),
+                                        header.encryption_iv)
+        return header,finalkey
 
     def group(self,field,value):
         'Return the group which has the given field and value'
@@ -219,6 +526,10 @@ class Database(object):
     def hierarchy(self):
         '''Return database with groups and entries organized into a
         hierarchy'''
+        with self._phase('hierarchy'):
+            return self._hierarchy()
+
+    def _hierarchy(self):
         from hier import Node
 
         top = Node()
@@ -249,24 +560,366 @@ class Database(object):
         '''
         import hier
         collector = hier.CollectVisitor()
-        hier.visit(hierarchy, collector)
+        with self._phase('update_by_hierarchy'):
+            hier.visit(hierarchy, collector)
         self.groups = collector.groups
         self.entries = collector.entries
+        self._time_indexes = None
         return
+
+    time_fields = ('creation_time','last_mod_time','expiration_time')
+
+    def time_index(self, field):
+        'Return the index.TimeIndex of entries on the given time field'
+        if field not in Database.time_fields:
+            raise ValueError, 'Not an indexed time field: "%s"'%field
+        if self._time_indexes is None:
+            self._time_indexes = {}
+        idx = self._time_indexes.get(field)
+        if idx is None:
+            import index
+            idx = self._time_indexes[field] = index.TimeIndex(field, self.entries)
+        return idx
+
+    def _reindex(self, added=(), removed=()):
+        'Bring any built time indexes up to date with changed entries'
+        if not self._time_indexes: return
+        for idx in self._time_indexes.itervalues():
+            for ent in removed:
+                idx.remove(ent)
+            for ent in added:
+                idx.add(ent)
+            continue
+        return
+
+    def changed(self, entries):
+        '''Note entries the caller changed in place other than through
+        the methods of this DB, keeping the time indexes up to date'''
+        self._reindex(entries, entries)
+        return
+
+    def entries_between(self, field, start=None, end=None):
+        '''Return entries whose time field is in [start, end), sorted on
+        that field.  Either bound may be None.'''
+        return self.time_index(field).between(start, end)
+
+    def expiring(self, within, now=None):
+        'Return entries expiring from now until the timedelta within from now'
+        now = now or datetime.datetime.now()
+        return self.entries_between('expiration_time', now, now + within)
+
+    def changed_since(self, since):
+        'Return entries modified at or after the given datetime'
+        return self.entries_between('last_mod_time', since)
     
-    def gen_groupid(self):
+    def group_paths(self):
+        '''Return a dictionary mapping each groupid to the list of group
+        names leading from the top of the hierarchy down to that group'''
+        paths = {}
+        breadcrumb = []
+        for group in self.groups:
+            del breadcrumb[group.level:]
+            breadcrumb.append(group.group_name)
+            paths[group.groupid] = list(breadcrumb)
+            continue
+        return paths
+
+    def search(self,text,fields=('title','username','url','notes')):
+        'Return entries with text (case insensitive) in any of the fields'
+        text = text.lower()
+        ret = []
+        for ent in self.entries:
+            for field in fields:
+                value = ent.__dict__.get(field)
+                if value and text in value.lower():
+                    ret.append(ent)
+                    break
+                continue
+            continue
+        return ret
+
+    def gen_groupid(self, existing_groupids=None):
         """
         Generate a new groupid (4-byte value that isn't 0 or 0xffffffff).
+        A set of groupids already in use may be given to avoid building
+        it from the groups on every call.
         """
-        existing_groupids = {group.groupid for group in self.groups}
+        if existing_groupids is None:
+            existing_groupids = {group.groupid for group in self.groups}
         if len(existing_groupids) >= 0xfffffffe:
             raise Exception("All groupids are in use!")
+        import random
         while True:
             groupid = random.randint(1, 0xfffffffe) # 0 and 0xffffffff are reserved
             if groupid not in existing_groupids:
                 return groupid
     
+    merge_policies = ('newest','ours','theirs')
+
+    def merge(self, other, policy='newest'):
+        '''
+        Merge the groups and entries of the other Database into this one.
+
+        Groups are matched by their path and entries by their uuid.  When
+        both databases hold a group or entry the policy decides which
+        version is kept: "newest" by last_mod_time, "ours" or "theirs".
+        Groups new to this database whose groupid is already in use are
+        given a new one.  This runs in time linear in both databases.
+        '''
+        import hier
+        if policy not in Database.merge_policies:
+            raise ValueError, 'Unknown merge policy: "%s"'%policy
+
+        def theirs_win(ours, theirs):
+            if policy == 'newest':
+                return theirs.last_mod_time > ours.last_mod_time
+            return policy == 'theirs'
+
+        def take(obj, **values):
+            new = copy(obj)
+            new.order = list(obj.order)
+            new.__dict__.update(values)
+            return new
+
+        # index our hierarchy by group path and our entries by uuid
+        top = self.hierarchy()
+        node_by_path = {(): top}
+        node_by_id = {}
+        stack = [((), top)]
+        while stack:
+            path,node = stack.pop()
+            for sub in node.nodes:
+                subpath = path + (sub.group.group_name,)
+                node_by_path.setdefault(subpath, sub)
+                node_by_id[sub.group.groupid] = sub
+                stack.append((subpath, sub))
+                continue
+            continue
+        entry_loc = {}
+        for node in node_by_id.itervalues():
+            for ind,ent in enumerate(node.entries):
+                entry_loc[ent.uuid] = (node, ind)
+                continue
+            continue
+        used_ids = set(node_by_id)
+
+        # their groups, parents come before children
+        their_node = {}
+        their_paths = other.group_paths()
+        for group in other.groups:
+            path = tuple(their_paths[group.groupid])
+            node = node_by_path.get(path)
+            if node:
+                if theirs_win(node.group, group):
+                    node.group = take(group, groupid=node.group.groupid,
+                                      level=node.group.level)
+            else:
+                parent = node_by_path.get(path[:-1], top)
+                groupid = group.groupid
+                if groupid in used_ids:
+                    groupid = self.gen_groupid(used_ids)
+                used_ids.add(groupid)
+                node = hier.Node(take(group, groupid=groupid, level=parent.level()+1))
+                parent.nodes.append(node)
+                node_by_path[path] = node
+            their_node[group.groupid] = node
+            continue
+
+        # their entries
+        for ent in other.entries:
+            node = their_node.get(ent.groupid)
+            if not node:
+                sys.stderr.write("Skipping entry in missing group with ID %d\n"%
+                                 ent.groupid)
+                continue
+            new = take(ent, groupid=node.group.groupid)
+            loc = entry_loc.get(ent.uuid)
+            if not loc:
+                node.entries.append(new)
+                entry_loc[ent.uuid] = (node, len(node.entries)-1)
+                continue
+            old_node,ind = loc
+            if not theirs_win(old_node.entries[ind], ent):
+                continue
+            if old_node is node:
+                node.entries[ind] = new
+                continue
+            old_node.entries[ind] = None # removed below
+            node.entries.append(new)
+            entry_loc[ent.uuid] = (node, len(node.entries)-1)
+            continue
+        for node in node_by_id.itervalues():
+            if None in node.entries:
+                node.entries = [e for e in node.entries if e is not None]
+            continue
+
+        self.update_by_hierarchy(top)
+        return
+
+    # dates outside this range are reported by check()
+    date_range = (datetime.datetime(1970, 1, 1), datetime.datetime(2999, 12, 28, 23, 59, 59))
+
+    def check(self, repair=False):
+        '''
+        Return a list of (kind, message) tuples describing problems in
+        the structure of the database.  Each group, entry and field is
+        looked at once.  The kinds are:
+
+          duplicate-groupid  a group has the groupid of an earlier one
+          level              a group is more than one level below the
+                             one before it, or below level 0
+          orphan             an entry's groupid names no group
+          duplicate-uuid     an entry has the uuid of an earlier one
+          size               a field's recorded size is not its size
+          date               a date is outside date_range
+
+        With repair, give duplicate groups new groupids, raise groups to
+        one level below the one before them, move orphans to a new
+        "Recovered" group, give duplicate entries new uuids, recompute
+        field sizes and clamp dates into the range.
+        '''
+        problems = []
+        def report(kind, message):
+            problems.append((kind, message))
+        lo,hi = self.date_range
+
+        def check_info(info, what):
+            'Check the dates and field sizes of a group or entry'
+            for name in info.dates:
+                when = info.__dict__.get(name)
+                if when is None or lo <= when <= hi: continue
+                report('date', '%s has %s %s' % (what, name, when))
+                if repair:
+                    info.__dict__[name] = min(max(when, lo), hi)
+                continue
+            for typ,siz in info.order:
+                name = info.format.get(typ, (None,))[0]
+                if name in (None, 'ignored') or name not in info.__dict__: continue
+                encoded = info.format[typ][1][1](info.__dict__[name])
+                actual = len(encoded) if encoded is not None else 0
+                if actual != siz:
+                    report('size', '%s field %s is %d bytes, recorded as %d' %
+                           (what, name, actual, siz))
+                    if repair:
+                        info.update_order()
+                        break
+                continue
+            return
+
+        groupids = set()
+        previous = -1
+        for group in self.groups:
+            what = 'Group "%s"' % group.group_name
+            if group.groupid in groupids:
+                report('duplicate-groupid', '%s reuses groupid %d' % (what, group.groupid))
+                if repair:
+                    group.groupid = self.gen_groupid(groupids)
+            groupids.add(group.groupid)
+            if group.level < 0 or group.level > previous + 1:
+                report('level', '%s is at level %d after level %d' %
+                       (what, group.level, previous))
+                if repair:
+                    group.level = min(max(group.level, 0), previous + 1)
+            previous = group.level
+            check_info(group, what)
+            continue
+
+        uuids = set()
+        orphans = []
+        for ent in self.entries:
+            what = 'Entry "%s"' % ent.__dict__.get('title')
+            if ent.groupid not in groupids:
+                report('orphan', '%s is in missing group %d' % (what, ent.groupid))
+                orphans.append(ent)
+            if ent.uuid in uuids:
+                report('duplicate-uuid', '%s reuses uuid %s' % (what, ent.uuid))
+                if repair:
+                    import uuid
+                    ent.uuid = uuid.uuid4().hex
+            uuids.add(ent.uuid)
+            check_info(ent, what)
+            continue
+
+        if repair and orphans:
+            group = GroupInfo()
+            group.groupid = self.gen_groupid(groupids)
+            group.group_name = 'Recovered'
+            group.imageid = 1
+            group.creation_time = group.last_mod_time = group.last_acc_time = \
+                datetime.datetime.now()
+            group.expiration_time = hi
+            group.level = 0
+            group.flags = 0
+            group.update_order()
+            self.groups.append(group)
+            for ent in orphans:
+                ent.groupid = group.groupid
+                continue
+        if repair and problems:
+            self._time_indexes = None
+        return problems
+
+    # fields which are equal in true duplicates, see merge_duplicates()
+    duplicate_fields = ('groupid','title','username','url','password','notes',
+                        'binary_desc','binary_data')
+
+    def find_duplicates(self, keys=('title','username','url','password')):
+        '''Return lists of two or more entries, in file order, whose
+        values of all the given fields are equal.  Entries are bucketed
+        by a digest of the fields keyed with a random key made for this
+        call, so no field value, in particular no password, is kept.'''
+        import hmac, hashlib
+        secret = os.urandom(32)
+        buckets = {}
+        order = []
+        for ent in self.entries:
+            mac = hmac.new(secret, digestmod=hashlib.sha256)
+            for name in keys:
+                value = ent.__dict__.get(name)
+                value = '' if value is None else str(value)
+                mac.update(struct.pack('<I', len(value)))
+                mac.update(value)
+                continue
+            digest = mac.digest()
+            bucket = buckets.get(digest)
+            if bucket is None:
+                bucket = buckets[digest] = []
+                order.append(bucket)
+            bucket.append(ent)
+            continue
+        return [bucket for bucket in order if len(bucket) > 1]
+
+    def find_reused_passwords(self):
+        'Return lists of two or more entries sharing a non-empty password'
+        return [bucket for bucket in self.find_duplicates(('password',))
+                if bucket[0].password]
+
+    def merge_duplicates(self, keys=None):
+        '''Remove all but the most recently changed entry of each set
+        of entries equal in the given fields, by default all of
+        duplicate_fields.  Return the removed entries.'''
+        doomed = set()
+        for bucket in self.find_duplicates(keys or self.duplicate_fields):
+            keep = max(bucket, key=lambda ent: ent.last_mod_time)
+            doomed.update(id(ent) for ent in bucket if ent is not keep)
+            continue
+        if not doomed:
+            return []
+        return self._remove_entries(lambda entry: id(entry) in doomed)
+
+    def spill_attachments(self, threshold=1<<20, directory=None):
+        '''Move attachments larger than threshold bytes to encrypted
+        temporary files in the given directory to release memory.'''
+        for ent in self.entries:
+            data = ent.__dict__.get('binary_data')
+            if hasattr(data,'spill') and len(data) > threshold:
+                data.spill(directory)
+            continue
+        return
+
     def update_entry(self,title,username,url,notes="",new_title=None,new_username=None,new_password=None,new_url=None,new_notes=None):
+        'Change the matching entries, return how many there were'
+        count = 0
         for entry in self.entries:
             if entry.title == str(title) and entry.username == str(username) and entry.url == str(url):
                 if new_title: entry.title = new_title
@@ -274,7 +927,11 @@ class Database(object):
                 if new_password: entry.password = new_password
                 if new_url: entry.url = new_url
                 if new_notes: entry.notes = new_notes
-                entry.new_entry.last_mod_time = datetime.datetime.now()
+                entry.last_mod_time = datetime.datetime.now()
+                entry.update_order()
+                self._reindex([entry],[entry])
+                count += 1
+        return count
 
     def add_entry(self,path,title,username,password,url="",notes="",imageid=1,append=True):
         '''
@@ -282,7 +939,7 @@ class Database(object):
         append is False a pre-existing entry that matches path, title
         and username will be overwritten with the new one.
         '''
-        import hier, infoblock
+        import hier, infoblock, uuid
 
         top = self.hierarchy()
         node = hier.mkdir(top, path, self.gen_groupid)
@@ -323,40 +980,284 @@ class Database(object):
             #fixme, deal with times
             return new_entry
         
-        existing_node_updated = False
+        new_entry = make_entry()
+        replaced = []
         if not append:
             for i, ent in enumerate(node.entries):
                 if ent.title != title: continue
                 if ent.username != username: continue
-                node.entries[i] = make_entry()
-                existing_node_updated = True
+                node.entries[i] = new_entry
+                replaced.append(ent)
                 break
         
-        if not existing_node_updated:
-            node.entries.append(make_entry())
+        if not replaced:
+            node.entries.append(new_entry)
         
+        indexes = self._time_indexes
         self.update_by_hierarchy(top)
+        self._time_indexes = indexes
+        self._reindex([new_entry],replaced)
 
-    def remove_entry(self, username, url):
+    def _remove_entries(self, doomed):
+        'Remove the entries for which doomed(entry) is true'
+        keep = []
+        removed = []
         for entry in self.entries:
-            if entry.username == str(username) and entry.url == str(url):
-                self.entries.remove(entry)
+            (removed if doomed(entry) else keep).append(entry)
+            continue
+        self.entries = keep
+        self._reindex(removed=removed)
+        return removed
+
+    def remove_entry(self, username, url):
+        'Remove the matching entries, return them'
+        return self._remove_entries(lambda entry: entry.username == str(username) and
+                             entry.url == str(url))
 
     def remove_group(self, path, level=None):
+        doomed = set()
+        keep = []
         for group in self.groups:
-            if group.group_name == str(path):
-                if level:
-                    if group.level == level:
-                        self.groups.remove(group)
-                        for entry in self.entries:
-                            if entry.groupid == group.groupid:
-                                self.entries.remove(entry)
-                else:
-                    self.groups.remove(group)
-                    for entry in self.entries:
-                        if entry.groupid == group.groupid:
-                            self.entries.remove(entry)
+            if group.group_name == str(path) and (not level or group.level == level):
+                doomed.add(group.groupid)
+            else:
+                keep.append(group)
+            continue
+        self.groups = keep
+        self._remove_entries(lambda entry: entry.groupid in doomed)
 
 
     pass
 
+
+def _removed(base, ours, theirs, key):
+    '''Return the keys of the records in base, a dictionary from key to
+    last_mod_time, which are missing from ours and the keys of those
+    missing from theirs and unchanged in ours'''
+    ours = dict((getattr(rec,key),rec) for rec in ours)
+    theirs = set(getattr(rec,key) for rec in theirs)
+    here,there = set(),set()
+    for ident,mtime in base.iteritems():
+        if ident not in ours:
+            here.add(ident)
+        elif ident not in theirs and ours[ident].last_mod_time == mtime:
+            there.add(ident)
+        continue
+    return here,there
+
+_held = {}      # file name -> thread holding its lock
+
+@contextmanager
+def locked(filename):
+    '''Return a context holding an exclusive advisory lock on
+    "<filename>.lock", removing the file when done.  The thread holding
+    the lock may enter it again.  Does nothing where flock() is not
+    available.'''
+    import threading
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    me = threading.current_thread()
+    if _held.get(filename) is me:
+        yield
+        return
+    lockname = filename + '.lock'
+    while True:
+        fp = open(lockname,'a')
+        try:
+            fcntl.flock(fp.fileno(),fcntl.LOCK_EX)
+            # the holder before may have removed the file we locked
+            if os.fstat(fp.fileno()).st_ino == os.stat(lockname).st_ino:
+                break
+        except OSError:
+            pass
+        except:
+            fp.close()
+            raise
+        fp.close()
+        continue
+    _held[filename] = me
+    try:
+        yield
+    finally:
+        del _held[filename]
+        os.remove(lockname)     # while locked, so waiters lock afresh
+        fp.close()
+
+def remaining_size(fp):
+    '''Return the number of bytes left in the binary file object if it
+    is a regular file, else None'''
+    import stat
+    try:
+        st = os.fstat(fp.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return max(st.st_size - fp.tell(), 0)
+    except (AttributeError, EnvironmentError, ValueError):
+        return None
+
+def read_all(fp):
+    '''Return the rest of the binary file object.  A real file is read
+    straight into one buffer of its size.'''
+    size = remaining_size(fp)
+    if size is None:
+        return fp.read()
+    buf = bytearray(size)
+    view = memoryview(buf)
+    nread = 0
+    while nread < size:
+        count = fp.readinto(view[nread:])
+        if not count: break     # the file shrank meanwhile
+        nread += count
+        continue
+    if nread < size:
+        del view
+        del buf[nread:]
+    return buf
+
+def file_contents_hash(filename):
+    'Return the contents hash in the header of the file, None if missing'
+    try:
+        fp = open(filename,'rb')
+    except IOError:
+        return None
+    with fp:
+        return DBHDR(fp.read(124)).contents_hash
+
+def record_starts(payload, count, offset=0):
+    '''Return the offsets of count records starting at offset and the
+    offset just past them.  Only the field type and size headers are
+    read, no field is decoded.'''
+    unpack = struct.Struct('<HI').unpack_from
+    starts = []
+    while count:
+        starts.append(offset)
+        while True:
+            typ,siz = unpack(payload,offset)
+            offset += 6 + siz
+            if typ == 0xFFFF: break
+            continue
+        count -= 1
+        continue
+    if offset > len(payload):
+        raise ValueError, 'Payload truncated, %d bytes short'%(offset-len(payload))
+    return starts,offset
+
+def _can_fork():
+    '''Return True if this process can start a pool of forked workers
+    from the calling thread, which must be the main thread'''
+    import threading
+    if not hasattr(os,'fork') or \
+            not isinstance(threading.current_thread(),threading._MainThread):
+        return False
+    import multiprocessing
+    return not multiprocessing.current_process().daemon
+
+# The payload being decoded in parallel.  The forked workers inherit it
+# rather than receiving a copy.
+_parse_buffer = None
+
+def _decode_records(args):
+    import marshal
+    cls,starts = args
+    return marshal.dumps([cls(_parse_buffer,start).marshal_state() for start in starts])
+
+def parse_parallel(payload, ngroups, nentries, workers=None):
+    '''
+    Return the lists of GroupInfo and EntryInfo decoded from the
+    payload by a pool of forked worker processes.  The record
+    boundaries are found first so that each worker decodes a share of
+    the records independently.  The results are the same as decoding
+    in order except that attachments hold copies of their data rather
+    than views of the payload.
+    '''
+    global _parse_buffer
+    from multiprocessing import Pool, cpu_count
+    gstarts,offset = record_starts(payload,ngroups)
+    estarts,offset = record_starts(payload,nentries,offset)
+    workers = workers or cpu_count()
+    nchunks = workers * 4
+    tasks = []
+    for cls,starts in [(GroupInfo,gstarts),(EntryInfo,estarts)]:
+        step = max(1, -(-len(starts) // nchunks))
+        for ind in xrange(0,len(starts),step):
+            tasks.append((cls,starts[ind:ind+step]))
+            continue
+        continue
+    _parse_buffer = payload
+    pool = Pool(workers)
+    try:
+        results = pool.map(_decode_records,tasks)
+    finally:
+        pool.terminate()
+        _parse_buffer = None
+    import marshal
+    records = []
+    for (cls,starts),result in zip(tasks,results):
+        records.extend(cls.from_marshal_state(state) for state in marshal.loads(result))
+        continue
+    return records[:ngroups],records[ngroups:]
+
+def _error(err):
+    'Return the description of an exception given by open_many()'
+    return '%s: %s'%(err.__class__.__name__,err)
+
+def _open_one(args):
+    '''Open one file for open_many(), return (filename, result, error).
+    The error of getting the master key is passed on.'''
+    filename,masterkey,summary,error = args
+    if error:
+        return filename, None, error
+    try:
+        db = Database(filename,masterkey)
+    except Exception, err:
+        return filename, None, _error(err)
+    if summary:
+        db = dict(ngroups=len(db.groups), nentries=len(db.entries),
+                  version=db.header.version, rounds=db.header.key_enc_rounds,
+                  encryption=db.header.encryption_type())
+    return filename, db, None
+
+def open_many(filenames, key_provider="", workers=None, summary=False):
+    '''
+    Open many .kdb files with a pool of worker processes.
+
+    The key_provider is either the master key for all files or a
+    callable returning the master key for a given filename.  It is
+    called in this process.  Workers defaults to the number of CPUs.
+
+    Yields (filename, result, error) tuples in the order of the given
+    filenames.  The result is the Database, or a dictionary of counts
+    if summary is True, and None if opening failed, or key_provider
+    raised, in which case error holds the reason.
+    '''
+    if not callable(key_provider):
+        masterkey = key_provider
+        key_provider = lambda filename: masterkey
+    def make_jobs():
+        for filename in filenames:
+            try:
+                masterkey = key_provider(filename)
+            except Exception, err:
+                yield filename, None, summary, _error(err)
+                continue
+            yield filename, masterkey, summary, None
+            continue
+    jobs = make_jobs()
+
+    if workers == 1:
+        for job in jobs:
+            yield _open_one(job)
+        return
+
+    from multiprocessing import Pool
+    pool = Pool(workers)
+    try:
+        for result in pool.imap(_open_one, jobs):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+    return
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+'''
+Random access to single records of a database through a sidecar index.
+
+The payload is encrypted with AES in CBC mode, so any 16 byte block
+can be decrypted on its own given the ciphertext block before it.
+When Database.write() is asked to, it also writes "<file>.idx", an
+encrypted index giving the offset and length in the plaintext payload
+of every group and entry by uuid, title and group path.  A
+LazyDatabase reads only the header and that index, then decrypts just
+the blocks covering each record asked for.
+
+Trust: the index is authenticated with a key derived from the final
+key of the database file it was written with, so opening it proves
+the master key is right and that the index belongs to that very file.
+The records themselves are not covered by the contents hash of the
+header until the whole payload has been decrypted and hashed.  Until
+verify() succeeds, a damaged or altered file can give wrong records.
+The verified attribute is None until the check has run, then True or
+False.  Every later read checks that the file still has the header,
+size and modification time it had when opened and raises ValueError
+if it was rewritten since, rather than decrypting records of the new
+contents at the offsets of the old index.
+'''
+
+# This file is part of python-keepass and is Copyright (C) 2012 Brett Viren.
+#
+# This code is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any
+# later version.
+
+import threading
+
+MAGIC = 'KPDBIDX\x01'
+HEADER_SIZE = 124
+BLOCK = 16
+
+def sidecar_name(filename):
+    'Return the name of the sidecar index of the given database file'
+    return filename + '.idx'
+
+def _keys(finalkey):
+    'Return the (encryption, authentication) keys of a sidecar'
+    import hashlib
+    return (hashlib.sha256('sidecar encryption' + finalkey).digest(),
+            hashlib.sha256('sidecar authentication' + finalkey).digest())
+
+def _str(value):
+    'Undo the unicode JSON gives back for strings'
+    if isinstance(value, unicode):
+        return value.encode('latin-1')
+    if isinstance(value, list):
+        return [_str(item) for item in value]
+    return value
+
+def record_offsets(db, contents_hash):
+    '''Return the index document of a database written with the given
+    contents hash: the offset and length of every group and entry in
+    its plaintext payload.'''
+    import binascii
+    paths = db.group_paths()
+    offset = 0
+    groups = []
+    for group in db.groups:
+        groups.append([group.groupid, paths.get(group.groupid, []), offset, len(group)])
+        offset += len(group)
+        continue
+    entries = []
+    for entry in db.entries:
+        entries.append([entry.uuid, entry.title, entry.groupid, offset, len(entry)])
+        offset += len(entry)
+        continue
+    return dict(contents_hash=binascii.hexlify(contents_hash),
+                size=offset, groups=groups, entries=entries)
+
+def write_sidecar(filename, doc, finalkey):
+    '''Encrypt and authenticate the index document into the file,
+    replacing it atomically by renaming a temporary file over it'''
+    import os, json, hmac, hashlib, tempfile
+    from Crypto.Cipher import AES
+    from Crypto import Random
+    enckey,mackey = _keys(finalkey)
+    text = json.dumps(doc, encoding='latin-1', separators=(',',':'))
+    padding = BLOCK - len(text) % BLOCK
+    iv = Random.new().read(BLOCK)
+    body = MAGIC + iv + AES.new(enckey, AES.MODE_CBC, iv).encrypt(text + chr(padding)*padding)
+    dirname,basename = os.path.split(os.path.abspath(filename))
+    fd,tmpname = tempfile.mkstemp(prefix='.%s.'%basename, suffix='.tmp', dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(body)
+            fp.write(hmac.new(mackey, body, hashlib.sha256).digest())
+            fp.flush()
+            os.fsync(fp.fileno())
+        if os.path.exists(filename):
+            import stat
+            os.chmod(tmpname, stat.S_IMODE(os.stat(filename).st_mode))
+        os.rename(tmpname, filename)
+    except:
+        os.remove(tmpname)
+        raise
+    return
+
+def read_sidecar(filename, finalkey):
+    '''Return the index document in the file.  Raise ValueError if it
+    was not written with this final key.'''
+    import json, hmac, hashlib
+    from Crypto.Cipher import AES
+    enckey,mackey = _keys(finalkey)
+    with open(filename, 'rb') as fp:
+        data = fp.read()
+    body,mac = data[:-32],data[-32:]
+    if not body.startswith(MAGIC) or \
+            not hmac.compare_digest(mac, hmac.new(mackey, body, hashlib.sha256).digest()):
+        raise ValueError, 'Sidecar index %s does not belong to this file and key'%filename
+    iv = body[len(MAGIC):len(MAGIC)+BLOCK]
+    text = AES.new(enckey, AES.MODE_CBC, iv).decrypt(body[len(MAGIC)+BLOCK:])
+    text = text[:-ord(text[-1])]
+    return _str(json.loads(text, encoding='latin-1'))
+
+
+class LazyDatabase(object):
+    '''
+    A database file opened through its sidecar index, decrypting
+    records as they are asked for.  See the module documentation for
+    what can be trusted before verify() has succeeded.
+
+    Give verify as 'background' to check the contents hash in a
+    thread right away, 'now' to check before returning or 'demand' to
+    check only when verify() is called.
+    '''
+
+    def __init__(self, filename, masterkey="", verify='background', stats=None):
+        from kpdb import Database
+        from header import DBHDR
+        self.filename = filename
+        self.verified = None
+        self._verify_lock = threading.Lock()
+
+        # the Database object only computes keys and checks the payload
+        self._db = Database(masterkey=masterkey, stats=stats)
+        with open(filename, 'rb') as fp:
+            self._identity = self._identify(fp)
+            self.header = DBHDR(self._identity[0])
+        import cipher
+        cipher.backend(self.header.encryption_type())   # any CBC cipher will do
+        with self._db._phase('final_key'):
+            self.finalkey = self._db.final_key(masterkey,
+                                               self.header.master_seed,
+                                               self.header.master_seed2,
+                                               self.header.key_enc_rounds)
+        self._db.header = self.header
+
+        doc = read_sidecar(sidecar_name(filename), self.finalkey)
+        import binascii
+        if binascii.unhexlify(doc['contents_hash']) != self.header.contents_hash:
+            raise ValueError, 'Sidecar index of %s is stale'%filename
+        self.paths = dict((tuple(path), (groupid, offset, length))
+                          for groupid,path,offset,length in doc['groups'])
+        self._by_uuid = {}
+        self._by_title = {}
+        self._by_group = {}
+        for uuid,title,groupid,offset,length in doc['entries']:
+            self._by_uuid[uuid] = (offset, length)
+            self._by_title.setdefault(title, []).append(uuid)
+            self._by_group.setdefault(groupid, []).append(uuid)
+            continue
+
+        if verify == 'now':
+            self.verify()
+        elif verify == 'background':
+            thread = threading.Thread(target=self._verify_quietly)
+            thread.daemon = True
+            thread.start()
+        return
+
+    def __len__(self):
+        return len(self._by_uuid)
+
+    def uuids(self):
+        'Return the uuids of all entries'
+        return self._by_uuid.keys()
+
+    def titles(self):
+        'Return the titles of all entries'
+        return self._by_title.keys()
+
+    def _identify(self, fp):
+        'Return the header bytes, size and modification time of the open file'
+        import os
+        st = os.fstat(fp.fileno())
+        fp.seek(0)
+        return (fp.read(HEADER_SIZE), st.st_size, st.st_mtime)
+
+    def _open(self):
+        '''Return the file opened for reading.  Raise ValueError if it
+        was rewritten since the header and index were read.'''
+        fp = open(self.filename, 'rb')
+        if self._identify(fp) != self._identity:
+            fp.close()
+            raise ValueError, 'Database file %s changed since it was opened'%self.filename
+        return fp
+
+    def _record(self, offset, length):
+        'Return the plaintext payload bytes [offset, offset+length)'
+        import cipher
+        first = offset // BLOCK
+        last = (offset + length - 1) // BLOCK
+        with self._db._phase('read'):
+            with self._open() as fp:
+                if first:
+                    fp.seek(HEADER_SIZE + (first - 1) * BLOCK)
+                    iv = fp.read(BLOCK)
+                else:
+                    fp.seek(HEADER_SIZE)
+                    iv = self.header.encryption_iv
+                data = fp.read((last - first + 1) * BLOCK)
+        if len(data) != (last - first + 1) * BLOCK:
+            raise ValueError, 'Database file %s is truncated'%self.filename
+        with self._db._phase('decrypt', len(data)):
+            out = bytearray(len(data))
+            cipher.new(self.header.encryption_type(), self.finalkey, iv).decrypt_into(
+                memoryview(data), memoryview(out))
+        start = offset - first * BLOCK
+        return str(out[start:start+length])
+
+    def entry(self, uuid):
+        'Return the EntryInfo with the given uuid or None'
+        from infoblock import EntryInfo
+        if uuid not in self._by_uuid:
+            return None
+        return EntryInfo(self._record(*self._by_uuid[uuid]))
+
+    def find(self, title):
+        'Return the list of EntryInfo with the given title'
+        return [self.entry(uuid) for uuid in self._by_title.get(title, [])]
+
+    def group(self, path):
+        '''Return the GroupInfo at the given path, a list of names or a
+        string separated by "/", or None'''
+        from infoblock import GroupInfo
+        if isinstance(path, basestring):
+            path = [name for name in path.split('/') if name]
+        found = self.paths.get(tuple(path))
+        if not found:
+            return None
+        groupid,offset,length = found
+        return GroupInfo(self._record(offset, length))
+
+    def entries_in(self, path):
+        'Return the list of EntryInfo directly in the group at the given path'
+        if isinstance(path, basestring):
+            path = [name for name in path.split('/') if name]
+        found = self.paths.get(tuple(path))
+        if not found:
+            return []
+        return [self.entry(uuid) for uuid in self._by_group.get(found[0], [])]
+
+    def verify(self):
+        '''Decrypt the whole payload and check it against the contents
+        hash of the header.  Return True or raise ValueError.  Waits for
+        a check already running in the background.'''
+        with self._verify_lock:
+            if self.verified is None:
+                with self._open() as fp:
+                    fp.seek(HEADER_SIZE)
+                    payload = fp.read()
+                try:
+                    self._db.decrypt_payload(payload, self.finalkey,
+                                             self.header.encryption_type(),
+                                             self.header.encryption_iv)
+                except ValueError:
+                    self.verified = False
+                    raise
+                self.verified = True
+        if not self.verified:
+            raise ValueError, 'Decryption failed. The file checksum did not match.'
+        return True
+
+    def _verify_quietly(self):
+        try:
+            self.verify()
+        except (ValueError, IOError):
+            pass
+        return
+
+    pass
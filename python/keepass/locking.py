@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+'''
+Share one database between threads.
+
+A Database changes its lists and entries in place and does no locking
+of its own.  A LockedDatabase guards one with a reader/writer lock so
+that any number of threads can look up and search entries at once
+while changes wait for the readers to finish and run one at a time.
+
+  shared = LockedDatabase(kpdb.Database(filename, masterkey))
+  found = shared.search('example')              # any thread
+  with shared.writing() as db:                  # one thread at a time
+      db.add_entry('Web', 'site', 'user', 'secret')
+      db.remove_entry('olduser', 'https://old.example.org/')
+  shared.write(filename)
+
+The changes made in one writing() block are seen by readers all at
+once.  Saves run one at a time holding the read lock, so readers go on
+while the file is written and it always holds the state between two
+writing() blocks.  A save finding the file changed by another program
+merges it into the database holding the write lock.
+'''
+
+# This file is part of python-keepass and is Copyright (C) 2012 Brett Viren.
+#
+# This code is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any
+# later version.
+
+import threading
+from contextlib import contextmanager
+
+class RWLock(object):
+    '''
+    A lock held by many readers or one writer.  Waiting writers keep
+    new readers out so that a steady stream of readers can not starve
+    them.  Not reentrant.
+    '''
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+        return
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        return
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+        return
+
+    def acquire_write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        return
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+        return
+
+    @contextmanager
+    def reading(self):
+        'Hold the lock as a reader for the duration of a with block'
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def writing(self):
+        'Hold the lock as the writer for the duration of a with block'
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+    pass
+
+
+def _reader(name):
+    def method(self, *args, **kwds):
+        with self.lock.reading():
+            return getattr(self.db, name)(*args, **kwds)
+    method.__name__ = name
+    method.__doc__ = 'Call Database.%s holding the read lock' % name
+    return method
+
+def _writer(name):
+    def method(self, *args, **kwds):
+        with self.lock.writing():
+            return getattr(self.db, name)(*args, **kwds)
+    method.__name__ = name
+    method.__doc__ = 'Call Database.%s holding the write lock' % name
+    return method
+
+
+class LockedDatabase(object):
+    '''
+    A kpdb.Database guarded by a RWLock.  Use reading() and writing()
+    for several calls under one lock, or the methods named like those
+    of Database for one call each.  Objects returned while reading are
+    the database's own and must not be changed.
+    '''
+
+    # Database methods which only look.  Building a time index on
+    # first use stores it on the database; two readers racing to build
+    # it each build a correct one and one of them is kept.
+    reads = ('search', 'group', 'group_paths', 'hierarchy', 'time_index',
+             'entries_between', 'expiring', 'changed_since', 'to_bytes')
+    # Database methods which change it
+    writes = ('add_entry', 'update_entry', 'remove_entry', 'remove_group',
+              'update_by_hierarchy', 'merge', 'spill_attachments')
+
+    def __init__(self, db):
+        self.db = db
+        self.lock = RWLock()
+        self._saving = threading.Lock()
+        return
+
+    @contextmanager
+    def reading(self):
+        'Return a context giving the database to read'
+        with self.lock.reading():
+            yield self.db
+
+    @contextmanager
+    def writing(self):
+        'Return a context giving the database to change'
+        with self.lock.writing():
+            yield self.db
+
+    def snapshot(self):
+        '''Return a copy of the database as it is now, which later
+        changes do not affect and which the caller may change'''
+        import cache
+        with self.lock.reading():
+            return cache.view(self.db)
+
+    def write(self, filename, masterkey="", index=None, merge='newest'):
+        '''Write the database to the file holding the read lock.  If the
+        file changed since it was read, merge it and write again holding
+        the write lock, see Database.write().'''
+        import kpdb
+        with self._saving:
+            try:
+                with self.lock.reading():
+                    return self.db.write(filename, masterkey, index, merge=None)
+            except kpdb.WriteConflict:
+                if merge is None:
+                    raise
+            with self.lock.writing():
+                return self.db.write(filename, masterkey, index, merge=merge)
+
+    pass
+
+for name in LockedDatabase.reads:
+    setattr(LockedDatabase, name, _reader(name))
+for name in LockedDatabase.writes:
+    setattr(LockedDatabase, name, _writer(name))
+del name
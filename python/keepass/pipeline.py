@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+'''
+Read a database file in overlapping stages.
+
+Database.read() reads the whole file, then decrypts, hashes and parses
+the payload one step after the other.  read() here runs the steps as
+threads, with bounded queues of chunks between them:
+
+  reader -> decrypter -> hasher
+                      -> parser (the calling thread)
+
+The reader starts while the calling thread runs the master key
+transformation.  The cipher libraries and hashlib release the
+interpreter lock while they work on a chunk, so decrypting and hashing
+go on while the parser decodes the records already decrypted.  Opening
+a large file then takes about as long as its slowest step, which is
+usually parsing.  The threads only overlap on a machine with more than
+one CPU.
+
+The payload is decrypted into one buffer the size of the file, so the
+queues hold at most depth chunks of ciphertext and the offsets of
+decrypted chunks.  As with Database.read(), a file whose checksum does
+not match raises ValueError even if its records could be parsed.
+'''
+
+# This file is part of python-keepass and is Copyright (C) 2012 Brett Viren.
+#
+# This code is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any
+# later version.
+
+import os
+import struct
+import threading
+import Queue
+
+HEADER_SIZE = 124
+BLOCK = 16
+CHUNK = 1 << 20         # bytes of ciphertext per chunk
+DEPTH = 4               # chunks waiting between two stages
+
+_field = struct.Struct('<HI')
+
+class _Stopped(Exception):
+    'Raised in a stage when another stage failed'
+    pass
+
+
+class Pipeline(object):
+    '''
+    The stages reading one file.  Use read() rather than this class.
+    '''
+
+    def __init__(self, db, fp, size, chunk=CHUNK, depth=DEPTH):
+        self.db = db
+        self.fp = fp
+        self.size = size
+        self.chunk = max(BLOCK, chunk - chunk % BLOCK)
+        self.raw = Queue.Queue(depth)           # (offset, ciphertext) from the reader
+        self.plain = Queue.Queue(depth)         # (start, end) decrypted, for the hasher
+        self.out = bytearray(size)
+        self.view = memoryview(self.out)
+        self.decrypted = 0                      # bytes of out ready to parse
+        self.finished = False                   # decrypter is done
+        self.ready = threading.Condition()
+        self.stop = threading.Event()
+        self.errors = []
+        self.digest = None
+        self.length = None                      # payload bytes without padding
+        return
+
+    # Blocking calls throughout: Python 2 waits with a timeout by polling.
+
+    def _put(self, queue, item):
+        queue.put(item)
+        if self.stop.is_set():
+            raise _Stopped
+        return
+
+    def _get(self, queue):
+        item = queue.get()
+        if self.stop.is_set():
+            raise _Stopped
+        return item
+
+    def _abort(self):
+        'Stop all stages, waking any waiting on a queue or for data'
+        self.stop.set()
+        with self.ready:
+            self.ready.notify_all()
+        for queue in (self.raw, self.plain):
+            try:
+                while True:
+                    queue.get_nowait()
+            except Queue.Empty:
+                pass
+            try:
+                queue.put_nowait(None)
+            except Queue.Full:
+                pass
+            continue
+        return
+
+    def _stage(self, target, *args):
+        'Run a stage in a thread, keeping its error and stopping the others'
+        def run():
+            try:
+                target(*args)
+            except _Stopped:
+                pass
+            except Exception:
+                import sys
+                self.errors.append(sys.exc_info())
+                self._abort()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _reader(self):
+        offset = 0
+        while offset < self.size:
+            data = self.fp.read(min(self.chunk, self.size - offset))
+            if not data:
+                raise ValueError, 'Database file is truncated'
+            self._put(self.raw, (offset, data))
+            offset += len(data)
+            continue
+        self._put(self.raw, None)
+        return
+
+    def _decrypter(self, backend):
+        pending = ''            # ciphertext short of a whole block
+        done = 0
+        try:
+            while True:
+                item = self._get(self.raw)
+                if item is None: break
+                data = pending + item[1]
+                nbytes = len(data) - len(data) % BLOCK
+                pending = data[nbytes:]
+                if not nbytes: continue
+                backend.decrypt_into(memoryview(data)[:nbytes], self.view[done:done+nbytes])
+                self._put(self.plain, (done, done + nbytes))
+                done += nbytes
+                with self.ready:
+                    self.decrypted = done
+                    self.ready.notify_all()
+                continue
+            self._put(self.plain, None)
+        finally:
+            with self.ready:
+                self.finished = True
+                self.ready.notify_all()
+        return
+
+    def _hasher(self):
+        import hashlib
+        digest = hashlib.sha256()
+        held = None             # the last range, which holds the padding
+        while True:
+            item = self._get(self.plain)
+            if item is None: break
+            if held:
+                digest.update(self.view[held[0]:held[1]])
+            held = item
+            continue
+        length = 0
+        if held:
+            start,end = held
+            padding = self.out[end-1]
+            length = max(start, end - padding)
+            digest.update(self.view[start:length])
+        self.length = length
+        self.digest = digest.digest()
+        return
+
+    def _record_end(self, offset):
+        '''Return the offset past the record at offset once it is
+        decrypted, None if the payload ends first'''
+        while True:
+            if not self._wait(offset + 6):
+                return None
+            typ,siz = _field.unpack_from(self.out, offset)
+            offset += 6 + siz
+            if typ == 0xFFFF:
+                break
+            continue
+        if not self._wait(offset):
+            return None
+        return offset
+
+    def _wait(self, offset):
+        'Wait until the payload is decrypted up to offset, return False if it never will be'
+        if self.decrypted >= offset:
+            return True
+        with self.ready:
+            while self.decrypted < offset and not self.finished and not self.stop.is_set():
+                self.ready.wait()
+            return self.decrypted >= offset
+
+    def _parse(self):
+        '''Return the groups, the entries and the offset past them,
+        None if the payload ends first'''
+        from infoblock import GroupInfo, EntryInfo
+        header = self.db.header
+        records = []
+        offset = 0
+        for cls,count in ((GroupInfo, header.ngroups), (EntryInfo, header.nentries)):
+            for ind in xrange(count):
+                if self.finished:
+                    # all decrypted, no need to look for the record's end first
+                    record = cls(self.out, offset)
+                    offset += len(record)
+                else:
+                    end = self._record_end(offset)
+                    if end is None:
+                        return None
+                    record = cls(self.out, offset)
+                    offset = end
+                records.append(record)
+                continue
+            continue
+        return records[:header.ngroups], records[header.ngroups:], offset
+
+    def run(self):
+        'Fill the database, return the decrypted payload buffer'
+        import sys
+        import cipher
+        db = self.db
+        backend = cipher.backend(db.header.encryption_type())
+        threads = [self._stage(self._reader)]
+        try:
+            with db._phase('final_key'):
+                db.finalkey = db.final_key(db.masterkey, db.header.master_seed,
+                                           db.header.master_seed2,
+                                           db.header.key_enc_rounds)
+            threads.append(self._stage(self._decrypter,
+                                       backend(db.finalkey, db.header.encryption_iv)))
+            threads.append(self._stage(self._hasher))
+            with db._phase('parse', self.size):
+                failure = None
+                try:
+                    parsed = self._parse()
+                except Exception:
+                    parsed,failure = None,sys.exc_info()    # likely garbage from a wrong key
+                for thread in threads:
+                    thread.join()
+        except:
+            self._abort()
+            raise
+        if self.errors:
+            raise self.errors[0][0], self.errors[0][1], self.errors[0][2]
+        if not self.length and db.header.ngroups:
+            raise ValueError, "Decryption failed.\nThe key is wrong or the file is damaged"
+        if db.header.contents_hash != self.digest:
+            raise ValueError, "Decryption failed. The file checksum did not match."
+        if failure:
+            raise failure[0], failure[1], failure[2]
+        if parsed is None or parsed[2] > self.length:
+            raise ValueError, 'Payload truncated'
+        db.groups,db.entries = parsed[:2]
+        db._time_indexes = None
+        return self.out
+
+    pass
+
+
+def read(db, fp, size, chunk=CHUNK, depth=DEPTH):
+    '''
+    Fill the database from the binary file object holding size bytes
+    of file contents from its current position, running the stages
+    of reading as a pipeline of threads.  Return the decrypted
+    payload buffer.
+    '''
+    from header import DBHDR
+    if size < HEADER_SIZE:
+        raise ValueError, 'Database file is truncated'
+    db.header = DBHDR(fp.read(HEADER_SIZE))
+    size -= HEADER_SIZE
+    if size % BLOCK:
+        raise ValueError, "Decryption failed.\nThe key is wrong or the file is damaged"
+    return Pipeline(db, fp, size, chunk, depth).run()
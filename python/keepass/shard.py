@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+'''
+A vault split into one file per top-level group.
+
+A sharded vault is a manifest plus one standard KeePass v1 file, a
+shard, for each top-level group and everything below it.  The manifest
+is itself a small KeePass v1 file, encrypted with the same master key,
+holding one entry per shard: its title is the top-level group name and
+its URL the shard file name, relative to the manifest.
+
+A ShardedDatabase opens the manifest and then each shard only when it
+is first needed, or all of them at once in parallel with open_all().
+Changes mark their shard dirty and write() rewrites only dirty shards.
+
+  vault = ShardedDatabase('vault.kdb', 'secret')
+  vault.add_entry('Web/Shops', 'shop', 'alice', 'hunter2')  # opens "Web" only
+  vault.write()                                             # writes "Web" only
+'''
+
+# This file is part of python-keepass and is Copyright (C) 2012 Brett Viren.
+#
+# This code is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any
+# later version.
+
+import os
+import threading
+from collections import OrderedDict
+
+from kpdb import Database
+
+MANIFEST_GROUP = 'Shards'
+
+def _top_name(path):
+    'Return the top-level group name of a path'
+    import hier
+    names = [name for name in hier.path2list(path) if name]
+    if not names:
+        raise ValueError, 'Path "%s" names no group'%path
+    return names[0]
+
+
+class Shard(object):
+    '''
+    One shard file, opened when first needed.
+    '''
+
+    def __init__(self, name, filename, db=None):
+        self.name = name
+        self.filename = filename        # relative to the manifest
+        self.db = db
+        self.dirty = db is not None
+        return
+
+    pass
+
+
+class ShardedDatabase(object):
+    '''
+    A vault of one manifest and a shard per top-level group, used much
+    like a kpdb.Database.
+    '''
+
+    def __init__(self, filename, masterkey="", stats=None):
+        self.filename = filename
+        self.masterkey = masterkey
+        self.stats = stats
+        self.shards = OrderedDict()     # top-level group name -> Shard
+        self.manifest_dirty = False
+        self._removed = []              # shards whose files go at the next write
+        self._lock = threading.Lock()
+        if os.path.exists(filename):
+            manifest = Database(filename, masterkey, stats=stats)
+            for ent in manifest.entries:
+                self.shards[ent.title] = Shard(ent.title, ent.url)
+                continue
+        return
+
+    def _path(self, shard):
+        return os.path.join(os.path.dirname(os.path.abspath(self.filename)),
+                            shard.filename)
+
+    def _open(self, shard):
+        'Return the database of the shard, reading it if needed'
+        with self._lock:
+            if shard.db is None:
+                shard.db = Database(self._path(shard), self.masterkey, stats=self.stats)
+            return shard.db
+
+    def shard(self, name, create=False):
+        '''Return the database of the shard of the top-level group name,
+        or None.  With create, start a new shard if there is none.'''
+        shard = self.shards.get(name)
+        if shard:
+            return self._open(shard)
+        if not create:
+            return None
+        base = os.path.splitext(os.path.basename(self.filename))[0]
+        used = set(s.filename for s in self.shards.values() + self._removed)
+        ind = len(self.shards)
+        while '%s.%d.kdb'%(base,ind) in used:
+            ind += 1
+        db = Database(masterkey=self.masterkey, stats=self.stats)
+        db.header.key_enc_rounds = self._rounds()
+        self.shards[name] = Shard(name, '%s.%d.kdb'%(base,ind), db)
+        self.manifest_dirty = True
+        return db
+
+    def _rounds(self):
+        'Return the key transformation rounds to use for new shards'
+        for shard in self.shards.itervalues():
+            if shard.db is not None:
+                return shard.db.header.key_enc_rounds
+            continue
+        return Database().header.key_enc_rounds
+
+    def open_all(self, workers=None):
+        '''Open every shard not yet open, in parallel with the given
+        number of worker processes.  Raise ValueError if one fails.'''
+        import kpdb
+        closed = [shard for shard in self.shards.itervalues() if shard.db is None]
+        if not closed:
+            return
+        if len(closed) == 1:
+            workers = 1
+        paths = [self._path(shard) for shard in closed]
+        results = kpdb.open_many(paths, self.masterkey, workers)
+        for shard,(path,db,error) in zip(closed, results):
+            if error:
+                raise ValueError, 'Can not open shard %s: %s'%(path,error)
+            if self.stats is not None:
+                db.stats = self.stats
+            with self._lock:
+                if shard.db is None:
+                    shard.db = db
+            continue
+        return
+
+    def databases(self):
+        'Return the databases of all shards, opening them as needed'
+        self.open_all()
+        return [shard.db for shard in self.shards.itervalues()]
+
+    def hierarchy(self):
+        'Return one hier.Node holding the hierarchies of all shards'
+        import hier
+        top = hier.Node()
+        for db in self.databases():
+            top.nodes.extend(db.hierarchy().nodes)
+            continue
+        return top
+
+    def search(self, text, fields=('title','username','url','notes')):
+        'Return entries of all shards with the text in any of the fields'
+        ret = []
+        for db in self.databases():
+            ret.extend(db.search(text, fields))
+            continue
+        return ret
+
+    def add_entry(self, path, title, username, password, url="", notes="",
+                  imageid=1, append=True):
+        'Add an entry as kpdb.Database.add_entry(), opening only its shard'
+        name = _top_name(path)
+        db = self.shard(name, create=True)
+        db.add_entry(path, title, username, password, url, notes, imageid, append)
+        self.shards[name].dirty = True
+        return
+
+    def _each(self, method, *args):
+        'Call the method on every shard, marking those it changed dirty'
+        total = 0
+        for shard in self.shards.values():
+            changed = getattr(self._open(shard), method)(*args)
+            if changed:
+                shard.dirty = True
+                total += len(changed) if isinstance(changed, list) else changed
+            continue
+        return total
+
+    def update_entry(self, title, username, url, notes="", new_title=None,
+                     new_username=None, new_password=None, new_url=None, new_notes=None):
+        'Update entries as kpdb.Database.update_entry(), return the number changed'
+        return self._each('update_entry', title, username, url, notes, new_title,
+                          new_username, new_password, new_url, new_notes)
+
+    def remove_entry(self, username, url):
+        'Remove entries as kpdb.Database.remove_entry(), return the number removed'
+        return self._each('remove_entry', username, url)
+
+    def remove_group(self, name):
+        'Remove a whole top-level group and its shard file when written'
+        shard = self.shards.pop(name, None)
+        if shard:
+            self._removed.append(shard)
+            self.manifest_dirty = True
+        return
+
+    def write(self, masterkey=""):
+        '''Write the dirty shards and, if shards were added or removed,
+        the manifest.  A new master key rewrites everything.'''
+        if masterkey and masterkey != self.masterkey:
+            self.open_all()
+            for shard in self.shards.itervalues():
+                shard.dirty = True
+                continue
+            self.manifest_dirty = True
+            self.masterkey = masterkey
+        for shard in self.shards.itervalues():
+            if not shard.dirty: continue
+            shard.db.write(self._path(shard), self.masterkey)
+            shard.dirty = False
+            continue
+        if self.manifest_dirty:
+            self._write_manifest()
+        for shard in self._removed:
+            if os.path.exists(self._path(shard)):
+                os.remove(self._path(shard))
+            continue
+        self._removed = []
+        return
+
+    def _write_manifest(self):
+        manifest = Database(masterkey=self.masterkey)
+        manifest.header.key_enc_rounds = self._rounds()
+        for shard in self.shards.itervalues():
+            manifest.add_entry(MANIFEST_GROUP, shard.name, '', '', url=shard.filename)
+            continue
+        manifest.write(self.filename, self.masterkey)
+        self.manifest_dirty = False
+        return
+
+    def unshard(self):
+        'Return all shards merged into one kpdb.Database'
+        db = Database(masterkey=self.masterkey)
+        dbs = self.databases()
+        if dbs:
+            from copy import copy
+            db.header = copy(dbs[0].header)
+        for other in dbs:
+            db.merge(other, 'theirs')
+            continue
+        return db
+
+    pass
+
+
+def shard(db, filename, masterkey=""):
+    '''
+    Split the database into a sharded vault with its manifest in the
+    named file, one shard per top-level group.  Return the
+    ShardedDatabase.
+    '''
+    from copy import copy
+    vault = ShardedDatabase(filename, masterkey or db.masterkey)
+    vault.shards.clear()
+    by_groupid = {}
+    current = None
+    for group in db.groups:
+        if group.level == 0 or current is None:
+            current = vault.shard(group.group_name, create=True)
+            current.header = copy(db.header)
+        current.groups.append(group)
+        by_groupid[group.groupid] = current
+        continue
+    for ent in db.entries:
+        target = by_groupid.get(ent.groupid)
+        if target is None:
+            raise ValueError, 'Entry "%s" is in missing group %d, run fsck'%\
+                (ent.title, ent.groupid)
+        target.entries.append(ent)
+        continue
+    vault.write()
+    return vault
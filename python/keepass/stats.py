@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+'''
+Per-phase timing and memory instrumentation.
+
+Give a Stats object to a kpdb.Database to have it record the wall
+time, the number of bytes processed and, optionally, the growth of the
+peak memory for each phase of reading, writing and building the
+hierarchy:
+
+  st = stats.Stats()
+  db = kpdb.Database(filename, masterkey, stats=st)
+  print st
+
+A callback can be given to receive each phase as it finishes.  When
+no Stats is given the phases cost a no-op context manager each.
+'''
+
+# This file is part of python-keepass and is Copyright (C) 2012 Brett Viren.
+#
+# This code is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any
+# later version.
+
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def max_rss():
+    '''Return the peak resident size of this process so far in bytes,
+    None where it is not known'''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        rss *= 1024             # kilobytes but on Mac OS X
+    return rss
+
+
+class Phase(object):
+    '''
+    One timed phase, as a context manager.  After the phase the
+    seconds, nbytes and peak (bytes, or None) data members are filled.
+    The peak is how much the peak resident size of the process grew
+    in the phase, so it is 0 for a phase using less memory than one
+    before it.
+    '''
+
+    def __init__(self, stats, name, nbytes=0):
+        self.stats = stats
+        self.name = name
+        self.nbytes = nbytes
+        self.seconds = None
+        self.peak = None
+        return
+
+    def __enter__(self):
+        if self.stats.memory:
+            self._rss = max_rss()
+        self._start = time.time()
+        return self
+
+    def __exit__(self, typ, value, tb):
+        self.seconds = time.time() - self._start
+        if self.stats.memory:
+            self.peak = max_rss() - self._rss
+        self.stats.record(self)
+        return False
+
+    pass
+
+
+class NullPhase(object):
+    'A phase that records nothing'
+    def __enter__(self): return self
+    def __exit__(self, typ, value, tb): return False
+    pass
+
+NULL_PHASE = NullPhase()
+
+
+class Stats(object):
+    '''
+    Collect phases.
+
+    If callback is given it is called as callback(phase) as each phase
+    finishes.  If memory is True and the resource module is available
+    the growth of the peak resident size in each phase is recorded too.
+    '''
+
+    def __init__(self, callback=None, memory=False):
+        self.phases = []
+        self.callback = callback
+        self.memory = bool(memory and resource)
+        return
+
+    def phase(self, name, nbytes=0):
+        'Return a context manager timing the named phase'
+        return Phase(self, name, nbytes)
+
+    def record(self, phase):
+        'Add a finished phase'
+        self.phases.append(phase)
+        if self.callback:
+            self.callback(phase)
+        return
+
+    def totals(self):
+        '''Return list of (name, calls, seconds, nbytes, peak) summed over
+        phases of the same name, in order of first appearance.'''
+        ret = []
+        byname = {}
+        for ph in self.phases:
+            tot = byname.get(ph.name)
+            if tot is None:
+                tot = byname[ph.name] = [ph.name, 0, 0.0, 0, None]
+                ret.append(tot)
+            tot[1] += 1
+            tot[2] += ph.seconds
+            tot[3] += ph.nbytes
+            if ph.peak is not None:
+                tot[4] = max(tot[4], ph.peak)
+            continue
+        return [tuple(tot) for tot in ret]
+
+    def __str__(self):
+        ret = ['%-20s %5s %10s %12s %10s %12s' %
+               ('phase','calls','seconds','bytes','MB/s','peak')]
+        for name,calls,seconds,nbytes,peak in self.totals():
+            rate = '-'
+            if nbytes and seconds:
+                rate = '%.1f' % (nbytes / seconds / 1e6)
+            if peak is None: peak = '-'
+            ret.append('%-20s %5d %10.4f %12d %10s %12s' %
+                       (name,calls,seconds,nbytes,rate,peak))
+            continue
+        return '\n'.join(ret)
+
+    pass
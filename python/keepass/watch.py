@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+'''
+Follow changes made to a database file by other programs.
+
+A Watcher holds the database read from a file.  When the file changes
+it reads it again and updates the database it holds in place.  Every
+subscriber is then called with a diff.Changes object listing the
+entries added, changed and removed by uuid and the groups by groupid.
+Unchanged entries keep their objects, so references held by callers
+and any time indexes stay valid.  The time indexes are updated only
+for the entries that changed.
+
+Changes are noticed with inotify where the C library has it and by
+checking the file's stat() every interval seconds otherwise.  A file
+rewritten with the same contents, by the same plaintext hash in its
+header, is not read again.  A changed file is dropped from the cache
+of the cache module.
+
+  watcher = Watcher('file.kdb', 'secret')
+  watcher.subscribe(lambda changes: sys.stdout.write(str(changes)))
+  watcher.start()
+'''
+
+# This file is part of python-keepass and is Copyright (C) 2012 Brett Viren.
+#
+# This code is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any
+# later version.
+
+import os
+import struct
+import threading
+
+import cache
+from kpdb import Database, file_contents_hash
+from diff import Changes, diff, apply
+
+# inotify event masks from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+
+class _Inotify(object):
+    'Wait for changes to the files of a directory through inotify'
+
+    def __init__(self, directory):
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init'):
+            raise OSError, 'No inotify in the C library'
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError, os.strerror(ctypes.get_errno())
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(self.fd, directory, mask) < 0:
+            os.close(self.fd)
+            raise OSError, os.strerror(ctypes.get_errno())
+        return
+
+    def wait(self, name, timeout):
+        '''Return True if the named file may have changed within the
+        timeout'''
+        import select
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return False
+        data = os.read(self.fd, 1 << 16)
+        offset = 0
+        while offset < len(data):
+            wd,mask,cookie,size = struct.unpack_from('iIII', data, offset)
+            offset += 16
+            if mask & IN_Q_OVERFLOW or data[offset:offset+size].rstrip('\0') == name:
+                return True
+            offset += size
+            continue
+        return False
+
+    def close(self):
+        os.close(self.fd)
+        return
+
+    pass
+
+
+class Watcher(object):
+    '''
+    A database kept up to date with its file.  Call check() to look
+    for changes now or start() to look in a background thread.
+    '''
+
+    def __init__(self, filename, masterkey="", interval=1.0, stats=None):
+        self.filename = filename
+        self.interval = interval
+        self.db = Database(filename, masterkey, stats=stats)
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self._stat = self._identity()
+        self._stop = threading.Event()
+        self._thread = None
+        return
+
+    def _identity(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def subscribe(self, callback):
+        'Call callback(changes) after each change of the file'
+        self.subscribers.append(callback)
+        return
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+        return
+
+    def check(self):
+        '''Read the file again if it changed and return the Changes,
+        or None if it did not change'''
+        identity = self._identity()
+        if identity is None or identity == self._stat:
+            return None
+        if file_contents_hash(self.filename) == self.db.header.contents_hash:
+            self._stat = identity
+            return None
+        # a file caught mid-write raises here and is read again next time
+        new = Database(self.filename, self.db.masterkey, stats=self.db.stats)
+        with self.lock:
+            changes = diff(self.db, new)
+            self._update(new, changes)
+            self._stat = identity
+        cache.discard(self.filename)    # drop the decrypted earlier contents
+        for callback in list(self.subscribers):
+            callback(changes)
+            continue
+        return changes
+
+    def _update(self, new, changes):
+        'Bring the held database up to the new one, keeping unchanged objects'
+        apply(self.db, changes)
+        self.db.header = new.header
+        self.db.finalkey = new.finalkey
+        self.db._base,self.db._base_records = new._base,new._base_records
+        return
+
+    def run(self):
+        'Check for changes until stop() is called'
+        directory,name = os.path.split(os.path.abspath(self.filename))
+        try:
+            notify = _Inotify(directory)
+        except (OSError, AttributeError, TypeError):
+            notify = None
+        try:
+            while not self._stop.is_set():
+                if notify:
+                    if not notify.wait(name, self.interval): continue
+                else:
+                    self._stop.wait(self.interval)
+                try:
+                    self.check()
+                except (IOError, ValueError):
+                    pass        # caught mid-write, the rename brings another event
+                continue
+        finally:
+            if notify:
+                notify.close()
+        return
+
+    def start(self):
+        'Check for changes in a background thread'
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+        return
+
+    def stop(self):
+        'Stop the background thread'
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        return
+
+    pass
@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import threading
+
+import keepass.kpdb
+from keepass import agent
+
+def test_agent():
+    """
+    Serve a file from an agent and query it over the socket.
+    """
+    password = 'REINDEER FLOTILLA'
+    tempdir = tempfile.mkdtemp()
+    kdb_path = os.path.join(tempdir, 'test_agent.kdb')
+    sockpath = os.path.join(tempdir, 'agent.sock')
+    try:
+        db = keepass.kpdb.Database()
+        db.add_entry(path='Secrets/Terrible', title='Gonk', username='foo', password='bar')
+        db.write(kdb_path, password)
+
+        server = agent.Server(sockpath)
+        thread = threading.Thread(target=server.run)
+        thread.start()
+        try:
+            client = agent.Client(sockpath)
+            assert client.available()
+            reply = client.request(op='search', path=kdb_path, masterkey=password, text='gon')
+            assert len(reply['entries']) == 1
+            assert reply['entries'][0]['group_path'] == 'Secrets/Terrible'
+            assert reply['entries'][0]['password'] == '****'
+
+            try:
+                client.request(op='lookup', path=kdb_path, masterkey='wrong', title='Gonk')
+            except ValueError:
+                pass
+            else:
+                assert False, 'wrong key accepted'
+
+            client.request(op='add', path=kdb_path, masterkey=password,
+                           entry=dict(path='Secrets', username='baz', password='qux'))
+            db2 = client.load(kdb_path, password)
+            assert len(db2.entries) == 2
+            assert len(db2.groups) == 2
+
+            # unsaved changes over a file changed on disk are reported
+            db.add_entry(path='Secrets', title='Other', username='other', password='x')
+            db.write(kdb_path, password)
+            try:
+                client.request(op='search', path=kdb_path, masterkey=password, text='o')
+            except ValueError, err:
+                assert 'unsaved changes' in str(err)
+            else:
+                assert False, 'served a stale vault'
+            client.request(op='save', path=kdb_path, masterkey=password)
+            reply = client.request(op='search', path=kdb_path, masterkey=password, text='')
+            assert sorted(e['username'] for e in reply['entries']) == ['baz', 'foo', 'other']
+        finally:
+            agent.Client(sockpath).request(op='stop')
+            thread.join()
+        assert not os.path.exists(sockpath)
+        assert not server.agent.vaults
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_agent_background():
+    """
+    The agent command forks into the background, returning at once.
+    """
+    import subprocess, sys
+    import keepass
+    tempdir = tempfile.mkdtemp()
+    kdb_path = os.path.join(tempdir, 'test_agent.kdb')
+    sockpath = os.path.join(tempdir, 'agent.sock')
+    try:
+        keepass.kpdb.Database().write(kdb_path, 'secret')
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(keepass.__file__))
+        code = 'import sys; from keepass import cli; cli.Cli(sys.argv[1:])()'
+        out = subprocess.check_output([sys.executable, '-c', code, 'agent', '-t', '30',
+                                       '-s', sockpath, '-m', 'secret', kdb_path], env=env)
+        assert 'KEEPASS_AGENT_SOCK=%s;' % sockpath in out
+        client = agent.Client(sockpath)
+        assert client.request(op='ping')['vaults'] == 1
+        client.request(op='stop')
+    finally:
+        shutil.rmtree(tempdir)
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import threading
+
+import keepass.kpdb
+from keepass import aio
+
+def test_open_save():
+    """
+    Save and open in the pool, concurrent opens share one task.
+    """
+    password = 'REINDEER FLOTILLA'
+    tempdir = tempfile.mkdtemp()
+    kdb_path = os.path.join(tempdir, 'test_aio.kdb')
+    try:
+        db = keepass.kpdb.Database()
+        db.add_entry(path='Secrets', title='Gonk', username='foo', password='bar')
+        assert aio.save(db, kdb_path, password).get() is None
+
+        first = aio.open_database(kdb_path, password)
+        second = aio.open_database(kdb_path, password)
+        assert first is second
+        db2 = first.get()
+        assert db2.entries[0].name() == 'Gonk'
+        assert aio.open_database(kdb_path, password) is not first
+
+        called = []
+        first.add_done_callback(called.append)
+        assert called == [first]
+
+        bad = aio.open_database(kdb_path, 'wrong')
+        bad.wait()
+        assert not bad.successful()
+        try:
+            bad.get()
+        except ValueError:
+            pass
+        else:
+            assert False, 'wrong key accepted'
+    finally:
+        shutil.rmtree(tempdir)
+
+def _unpicklable():
+    return threading.Lock()
+
+def test_process_pool():
+    """
+    Databases survive the trip back from a worker process.
+    """
+    from multiprocessing import Pool
+    password = 'REINDEER FLOTILLA'
+    tempdir = tempfile.mkdtemp()
+    kdb_path = os.path.join(tempdir, 'test_aio.kdb')
+    pool = Pool(1)
+    try:
+        db = keepass.kpdb.Database()
+        db.add_entry(path='Secrets', title='Gonk', username='foo', password='bar')
+        db.write(kdb_path, password)
+        db2 = aio.open_database(kdb_path, password, pool).get(60)
+        assert db2.entries[0].password == 'bar'
+        assert db2.encode_payload() == db.encode_payload()
+
+        # a save in another process leaves the database knowing the file
+        db2.add_entry(path='Secrets', title='Mine', username='me', password='pw')
+        assert aio.save(db2, kdb_path, password, pool).get(60) is None
+        db2.write(kdb_path, password, merge=None)
+
+        # and merges a changed file into the database itself
+        other = keepass.kpdb.Database(kdb_path, password)
+        other.add_entry(path='Secrets', title='Theirs', username='them', password='pw')
+        other.write(kdb_path)
+        db2.add_entry(path='Secrets', title='Ours', username='us', password='pw')
+        assert aio.save(db2, kdb_path, password, pool).get(60) is None
+        titles = ['Gonk', 'Mine', 'Ours', 'Theirs']
+        assert sorted(e.title for e in db2.entries) == titles
+        db3 = keepass.kpdb.Database(kdb_path, password)
+        assert sorted(e.title for e in db3.entries) == titles
+
+        # a result which does not pickle still completes the task
+        done = threading.Event()
+        bad = aio._submit(pool, _unpicklable, ())
+        bad.add_done_callback(lambda pending: done.set())
+        done.wait(60)
+        assert bad.ready() and not bad.successful()
+        try:
+            bad.get()
+        except RuntimeError:
+            pass
+        else:
+            assert False, 'returned an unpicklable result'
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(tempdir)
@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+
+import keepass.kpdb
+from keepass.attachment import Attachment
+
+def test_round_trip():
+    """
+    Attachments survive a write and read and are views after reading.
+    """
+    password = 'REINDEER FLOTILLA'
+    data = ''.join(chr(ind % 251) for ind in range(200000))
+    tempdir = tempfile.mkdtemp()
+    kdb_path = os.path.join(tempdir, 'test_attachment.kdb')
+    try:
+        db = keepass.kpdb.Database()
+        db.add_entry(path='Secrets', title='Gonk', username='foo', password='bar')
+        ent = db.entries[0]
+        ent.binary_data = Attachment(data)
+        ent.binary_desc = 'data.bin'
+        ent.update_order()
+        assert (14, len(data)) in ent.order
+        db.write(kdb_path, password)
+
+        db2 = keepass.kpdb.Database(kdb_path, password)
+        ent2 = db2.entries[0]
+        assert isinstance(ent2.binary_data, Attachment)
+        assert not ent2.binary_data.spilled()
+        assert ent2.binary_desc == 'data.bin'
+        assert str(ent2.binary_data) == data
+
+        db2.spill_attachments(threshold=1000, directory=tempdir)
+        assert ent2.binary_data.spilled()
+        reader = ent2.binary_data.open()
+        reader.seek(100001)
+        assert reader.read(50) == data[100001:100051]
+        assert ent2.binary_data == data
+        assert db2.encode_payload() == db.encode_payload()
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_from_file():
+    tempdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tempdir, 'data.bin')
+        with open(path, 'wb') as fp:
+            fp.write('hello world')
+        att = Attachment.from_file(path)
+        assert len(att) == 11
+        assert att.open().read(5) == 'hello'
+    finally:
+        shutil.rmtree(tempdir)
@@ -0,0 +1,60 @@
+import tempfile
+import shutil
+import os
+
+import keepass.kpdb
+from keepass import cache, stats
+from keepass.attachment import Attachment
+
+def test_cache():
+    tempdir = tempfile.mkdtemp()
+    kdb_path = os.path.join(tempdir, 'cache.kdb')
+    try:
+        db = keepass.kpdb.Database()
+        db.add_entry(path='Secrets', title='Gonk', username='foo', password='bar')
+        db.entries[0].binary_desc = 'data.bin'
+        db.entries[0].binary_data = Attachment('x' * 5000)
+        db.entries[0].update_order()
+        db.write(kdb_path, 'secret')
+
+        st = stats.Stats()
+        first = cache.open_database(kdb_path, 'secret', stats=st)
+        assert st.phases
+        second = cache.open_database(kdb_path, 'secret')
+        assert first is not second and first.entries[0] is not second.entries[0]
+        assert first.stats is st and second.stats is None
+        assert cache.size() == os.path.getsize(kdb_path)
+
+        # changing a copy leaves the cached database alone
+        first.update_entry('Gonk', 'foo', '', new_password='changed')
+        assert cache.open_database(kdb_path, 'secret').entries[0].password == 'bar'
+
+        # so does spilling the attachments of a copy
+        first.spill_attachments(threshold=1000, directory=tempdir)
+        assert first.entries[0].binary_data.spilled()
+        cached = cache.open_database(kdb_path, 'secret').entries[0].binary_data
+        assert not cached.spilled() and str(cached) == 'x' * 5000
+
+        try:
+            cache.open_database(kdb_path, 'wrong')
+        except ValueError:
+            pass
+        else:
+            assert False, 'opened with the wrong key'
+
+        # a rewritten file is read again
+        first.write(kdb_path, 'secret')
+        assert cache.open_database(kdb_path, 'secret').entries[0].password == 'changed'
+        assert cache.size() == os.path.getsize(kdb_path)
+
+        budget = cache.budget
+        cache.budget = 0
+        try:
+            cache.clear()
+            cache.open_database(kdb_path, 'secret')
+            assert cache.size() == 0
+        finally:
+            cache.budget = budget
+    finally:
+        cache.clear()
+        shutil.rmtree(tempdir)
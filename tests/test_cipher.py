@@ -0,0 +1,68 @@
+import os
+
+import keepass.kpdb
+from keepass import cipher
+
+def test_backends():
+    key, iv = os.urandom(32), os.urandom(16)
+    data = os.urandom(1000)
+    for classes in cipher.backends.values():
+        for cls in classes:
+            if not cls.available(): continue
+            encrypted = cipher.encrypt(cls.name, key, iv, data)
+            assert len(encrypted) == 1008
+            assert cipher.decrypt(cls.name, key, iv, encrypted, chunk=64) == data
+    try:
+        cipher.backend('ArcFour')
+    except ValueError:
+        pass
+    else:
+        assert False, 'ArcFour has no backend'
+
+def test_backend_classes():
+    """
+    Every registered backend encrypts and decrypts a block itself.
+    """
+    key, iv = os.urandom(32), os.urandom(16)
+    block = os.urandom(cipher.BLOCK)
+    for classes in cipher.backends.values():
+        for cls in classes:
+            assert callable(getattr(cls, 'encrypt', None))
+            assert callable(getattr(cls, 'decrypt_into', None))
+            if not cls.available(): continue
+            encrypted = cls(key, iv).encrypt(block)
+            assert len(encrypted) == cipher.BLOCK and encrypted != block
+            out = bytearray(cipher.BLOCK)
+            cls(key, iv).decrypt_into(memoryview(encrypted), memoryview(out))
+            assert str(out) == block
+    try:
+        cipher.register(8, cipher.Backend)
+    except ValueError:
+        pass
+    else:
+        assert False, 'registered a backend without methods'
+    assert cipher.Backend not in cipher.backends[8]
+
+def test_register():
+    """
+    A file flagged with another cipher goes through its backend.
+    """
+    class Reversed(cipher.CryptoAES):
+        'AES with the key reversed, standing in for another cipher'
+        name = 'TwoFish'
+        def __init__(self, key, iv):
+            cipher.CryptoAES.__init__(self, key[::-1], iv)
+    cipher.register(8, Reversed, first=True)
+    try:
+        db = keepass.kpdb.Database()
+        db.header.key_enc_rounds = 10
+        db.header.flags = 1 | 8
+        db.add_entry(path='Secrets', title='Gonk', username='foo', password='bar')
+        data = db.to_bytes('secret')
+        db2 = keepass.kpdb.Database.from_bytes(data, 'secret')
+        assert db2.header.encryption_type() == 'TwoFish'
+        assert db2.entries[0].password == 'bar'
+        plain = cipher.decrypt('Rijndael', db2.finalkey, db2.header.encryption_iv, data[124:])
+        assert plain != db2.encode_payload()
+    finally:
+        cipher.backends[8].remove(Reversed)
@@ -4,3 +4,110 @@ def test_parse_args():
     main = cli.Cli(['-a', '-b', '-c', 'open', '-a', '-b', '-c', 'foo'])
     assert main.command_line == [['general', ['-a', '-b', '-c']], 
                                  ['open', ['-a', '-b', '-c', 'foo']]]
+
+def test_lazy_imports():
+    """
+    Parsing the command line does not import the crypto modules.
+    """
+    import os, sys, subprocess
+    import keepass
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(keepass.__file__))
+    code = ("import sys; from keepass import cli; "
+            "cli.Cli(['open', '-m', 'key', 'file.kdb', 'dump']); "
+            "print(sorted(m for m in sys.modules if m.startswith('Crypto')))")
+    out = subprocess.check_output([sys.executable, '-c', code], env=env)
+    assert out.strip() == '[]'
+
+def test_batch():
+    """
+    Run a script of commands, saving once at the end.
+    """
+    import os, shutil, tempfile
+    import keepass.kpdb
+    tempdir = tempfile.mkdtemp()
+    try:
+        first = os.path.join(tempdir, 'first.kdb')
+        second = os.path.join(tempdir, 'second.kdb')
+        script = os.path.join(tempdir, 'script.txt')
+        keepass.kpdb.Database().write(first, 'key')
+        with open(script, 'w') as fp:
+            fp.write('# provision\n'
+                     'open -m key %s\n'
+                     'entry -p "Web Sites" -t site alice s3cret\n'
+                     'entry -p "Web Sites" bob hunter2 find bob\n'
+                     'save -m new %s\n' % (first, second))
+        main = cli.Cli(['batch', '-f', script])
+        main()
+        db = keepass.kpdb.Database(second, 'new')
+        assert sorted(e.username for e in db.entries) == ['alice', 'bob']
+        assert [g.group_name for g in db.groups] == ['Web Sites']
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_fsck_repair():
+    """
+    A file whose hierarchy can not be built opens and is repaired.
+    """
+    import os, shutil, tempfile
+    import keepass.kpdb
+    tempdir = tempfile.mkdtemp()
+    try:
+        for damage in ('level', 'orphan'):
+            bad = os.path.join(tempdir, '%s.kdb' % damage)
+            fixed = os.path.join(tempdir, '%s-fixed.kdb' % damage)
+            db = keepass.kpdb.Database()
+            db.add_entry(path='Top/Sub', title='title', username='user', password='pw')
+            if damage == 'level':
+                db.groups[1].level = 3
+            else:
+                db.entries[0].groupid = 999
+            db.write(bad, 'key')
+            cli.Cli(['open', '-A', '-m', 'key', bad, 'fsck', '-r',
+                     'save', '-m', 'key', fixed])()
+            db = keepass.kpdb.Database(fixed, 'key')
+            assert db.check() == []
+            db.hierarchy()
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_batch_switch():
+    """
+    A save deferred in a batch writes the database as it was given even
+    when it is changed or another is opened later.
+    """
+    import os, shutil, tempfile
+    import keepass.kpdb
+    tempdir = tempfile.mkdtemp()
+    try:
+        first = os.path.join(tempdir, 'a.kdb')
+        second = os.path.join(tempdir, 'b.kdb')
+        third = os.path.join(tempdir, 'c.kdb')
+        script = os.path.join(tempdir, 'script.txt')
+        keepass.kpdb.Database().write(first, 'key')
+        other = keepass.kpdb.Database()
+        other.add_entry('Web', 'beta', 'beta', 'pw')
+        other.write(second, 'key')
+        with open(script, 'w') as fp:
+            fp.write('open -m key %s\n'
+                     'entry -p Web alpha pw\n'
+                     'save -m key %s\n'
+                     'open -m key %s\n'
+                     'find beta\n' % (first, first, second))
+        cli.Cli(['batch', '-f', script])()
+        db = keepass.kpdb.Database(first, 'key')
+        assert [e.username for e in db.entries] == ['alpha']
+        db = keepass.kpdb.Database(second, 'key')
+        assert [e.username for e in db.entries] == ['beta']
+
+        # a save writes the database as it was at its line
+        with open(script, 'w') as fp:
+            fp.write('open -m key %s\n'
+                     'entry -p Web before pw\n'
+                     'save -m key %s\n'
+                     'entry -p Web after pw\n' % (first, third))
+        cli.Cli(['batch', '-f', script])()
+        db = keepass.kpdb.Database(third, 'key')
+        assert sorted(e.username for e in db.entries) == ['alpha', 'before']
+    finally:
+        shutil.rmtree(tempdir)
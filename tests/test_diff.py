@@ -0,0 +1,70 @@
+import tempfile
+import shutil
+import json
+import os
+
+import keepass.kpdb
+from keepass import diff, cli
+
+def make_db():
+    db = keepass.kpdb.Database()
+    db.add_entry(path='Web', title='shop', username='alice', password='one')
+    db.add_entry(path='Web', title='mail', username='alice', password='two')
+    db.add_entry(path='Old', title='gone', username='bob', password='three')
+    return db
+
+def test_diff():
+    old = make_db()
+    new = keepass.kpdb.Database.from_bytes(old.to_bytes('key'), 'key')
+    assert not diff.diff(old, new)
+    new.update_entry('shop', 'alice', '', new_password='changed')
+    new.remove_entry('bob', '')
+    new.add_entry(path='Web/Shops', title='store', username='carol', password='four')
+    changes = diff.diff(old, new)
+    assert [n.password for o,n in changes.entries_changed] == ['changed']
+    assert [e.title for e in changes.entries_removed] == ['gone']
+    assert [e.title for e in changes.entries_added] == ['store']
+    assert [g.group_name for g in changes.groups_added] == ['Shops']
+
+    diff.apply(old, changes)
+    assert not diff.diff(old, new)
+
+def test_diff_spec():
+    db = make_db()
+    shop = [ent for ent in db.entries if ent.title == 'shop'][0]
+    spec = {'groups': ['Web/Shops'],
+            'entries': [{'path': 'Web', 'title': 'shop', 'username': 'alice',
+                         'password': u'new'},
+                        {'path': 'Web', 'title': 'mail', 'username': 'alice'},
+                        {'path': 'Web/Shops', 'title': 'store', 'username': 'carol'}]}
+    changes = diff.diff_spec(db, spec, prune=True)
+    plan = diff.describe(db, changes)
+    assert '~ entry /Web/shop (alice): password' in plan
+    assert '+ entry /Web/Shops/store (carol)' in plan
+    assert '- group /Old' in plan and '- entry /Old/gone (bob)' in plan
+    assert not [line for line in plan if 'mail' in line]
+
+    diff.apply(db, changes)
+    assert [ent.title for ent in db.entries] == ['shop', 'mail', 'store']
+    assert db.entries[0].uuid == shop.uuid and db.entries[0].password == 'new'
+    assert [(g.group_name, g.level) for g in db.groups] == [('Web', 0), ('Shops', 1)]
+    assert not db.check()
+    assert not diff.diff_spec(db, spec, prune=True)
+
+def test_apply_command():
+    tempdir = tempfile.mkdtemp()
+    try:
+        kdb_path = os.path.join(tempdir, 'apply.kdb')
+        spec_path = os.path.join(tempdir, 'spec.json')
+        make_db().write(kdb_path, 'key')
+        with open(spec_path, 'w') as fp:
+            json.dump({'entries': [{'path': 'Web', 'title': 'new',
+                                    'username': 'dave', 'password': 'five'}]}, fp)
+        cli.Cli(['open', '-m', 'key', kdb_path, 'apply', '-n', spec_path,
+                 'save', kdb_path])()
+        assert len(keepass.kpdb.Database(kdb_path, 'key').entries) == 3
+        cli.Cli(['open', '-m', 'key', kdb_path, 'apply', spec_path,
+                 'save', kdb_path])()
+        assert len(keepass.kpdb.Database(kdb_path, 'key').entries) == 4
+    finally:
+        shutil.rmtree(tempdir)
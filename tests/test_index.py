@@ -0,0 +1,33 @@
+import datetime
+
+import keepass.kpdb
+from keepass import index
+from keepass import infoblock as ib
+
+def test_pack_time():
+    dec,enc = ib.date_de()
+    for when in [datetime.datetime(2012, 1, 31, 23, 59, 1),
+                 datetime.datetime(2999, 12, 28, 23, 59, 59)]:
+        assert index.pack_time(when) == index.packed_key(enc(when))
+    assert index.pack_time(datetime.datetime(2012, 2, 1)) > \
+        index.pack_time(datetime.datetime(2012, 1, 31, 23, 59, 59))
+
+def test_time_queries():
+    now = datetime.datetime(2026, 10, 1, 12, 0, 0)
+    db = keepass.kpdb.Database()
+    for days in range(5):
+        db.add_entry(path='Secrets', title='e%d' % days, username='foo', password='bar')
+        db.entries[-1].expiration_time = now + datetime.timedelta(days=days * 10)
+    # building the index after the fact, later changes update it
+    assert [e.title for e in db.expiring(datetime.timedelta(days=25), now)] == ['e0', 'e1', 'e2']
+
+    assert len(db.changed_since(now)) == 5
+    db.add_entry(path='Secrets', title='new', username='foo', password='bar')
+    assert len(db.changed_since(now)) == 6
+    assert db.expiring(datetime.timedelta(days=25), now)[-1].title == 'e2'
+
+    db.entries[0].expiration_time = now + datetime.timedelta(days=100)
+    db.update_entry('e0', 'foo', '', new_password='changed')
+    assert [e.title for e in db.expiring(datetime.timedelta(days=25), now)] == ['e1', 'e2']
+    db.remove_entry('foo', '')
+    assert db.expiring(datetime.timedelta(days=365), now) == []
@@ -26,3 +26,267 @@ def test_write():
         
     finally:
         shutil.rmtree(tempdir)
+
+def test_open_many():
+    """
+    Open several files in worker processes, one of them broken.
+    """
+    password = 'REINDEER FLOTILLA'
+    tempdir = tempfile.mkdtemp()
+    try:
+        paths = []
+        for count in range(3):
+            db = keepass.kpdb.Database()
+            for ind in range(count + 1):
+                db.add_entry(path='Secrets', title='Gonk%d' % ind, username='foo', password='bar')
+            paths.append(os.path.join(tempdir, 'test%d.kdb' % count))
+            db.write(paths[-1], password)
+        paths.append(os.path.join(tempdir, 'missing.kdb'))
+
+        results = list(keepass.kpdb.open_many(paths, password, workers=2))
+        assert [r[0] for r in results] == paths
+        for count, (path, db, error) in enumerate(results[:3]):
+            assert error is None
+            assert len(db.entries) == count + 1
+        assert results[3][1] is None and 'IOError' in results[3][2]
+
+        summaries = list(keepass.kpdb.open_many(paths[:1], lambda p: password, 1, True))
+        assert summaries[0][1]['nentries'] == 1
+
+        keys = {paths[0]: password, paths[2]: password}
+        results = list(keepass.kpdb.open_many(paths[:3], keys.__getitem__, workers=2))
+        assert [r[0] for r in results] == paths[:3]
+        assert results[1][1] is None and 'KeyError' in results[1][2]
+        assert len(results[2][1].entries) == 3
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_merge():
+    """
+    Merge two databases sharing some entries.
+    """
+    import datetime
+    ours = keepass.kpdb.Database()
+    ours.add_entry(path='Team/Web', title='site', username='foo', password='old')
+    ours.add_entry(path='Mine', title='mine', username='me', password='x')
+    theirs = keepass.kpdb.Database()
+    theirs.add_entry(path='Team/Db', title='db', username='dba', password='y')
+    theirs.entries.append(keepass.kpdb.copy(ours.entries[0]))
+    theirs.entries[-1].groupid = theirs.groups[0].groupid
+    theirs.entries[-1].password = 'new'
+    theirs.entries[-1].last_mod_time += datetime.timedelta(seconds=10)
+
+    merged = keepass.kpdb.copy(ours)
+    merged.groups = list(ours.groups)
+    merged.entries = list(ours.entries)
+    merged.merge(theirs, 'ours')
+    assert len(merged.entries) == 3
+    assert sorted(merged.group_paths().values()) == \
+        [['Mine'], ['Team'], ['Team', 'Db'], ['Team', 'Web']]
+    assert [e.password for e in merged.entries if e.title == 'site'] == ['old']
+
+    ours.merge(theirs)
+    assert len(ours.entries) == 3
+    site = [e for e in ours.entries if e.title == 'site'][0]
+    assert site.password == 'new'
+    assert ours.group_paths()[site.groupid] == ['Team']
+    assert len(set(g.groupid for g in ours.groups)) == len(ours.groups) == 4
+
+def test_concurrent_write():
+    """
+    Two writers started from the same file both keep their changes.
+    """
+    tempdir = tempfile.mkdtemp()
+    kdb_path = os.path.join(tempdir, 'shared.kdb')
+    try:
+        db = keepass.kpdb.Database()
+        db.add_entry(path='Secrets', title='Gonk', username='foo', password='bar')
+        db.write(kdb_path, 'secret')
+
+        first = keepass.kpdb.Database(kdb_path, 'secret')
+        second = keepass.kpdb.Database(kdb_path, 'secret')
+        first.add_entry(path='Secrets', title='first', username='one', password='1')
+        first.write(kdb_path)
+        second.add_entry(path='Other', title='second', username='two', password='2')
+        try:
+            second.write(kdb_path, merge=None)
+        except keepass.kpdb.WriteConflict:
+            pass
+        else:
+            assert False, 'overwrote a changed file'
+        second.write(kdb_path)
+
+        db = keepass.kpdb.Database(kdb_path, 'secret')
+        assert sorted(e.title for e in db.entries) == ['Gonk', 'first', 'second']
+
+        # a removal is kept, both changing the master key
+        third = keepass.kpdb.Database(kdb_path, 'secret')
+        fourth = keepass.kpdb.Database(kdb_path, 'secret')
+        third.remove_entry('foo', '')
+        third.write(kdb_path, 'changed')
+        fourth.add_entry(path='Secrets', title='new', username='three', password='3')
+        fourth.write(kdb_path, 'changed')
+
+        db = keepass.kpdb.Database(kdb_path, 'changed')
+        assert sorted(e.title for e in db.entries) == ['first', 'new', 'second']
+
+        # and so is one by the writer saving last
+        fifth = keepass.kpdb.Database(kdb_path, 'changed')
+        sixth = keepass.kpdb.Database(kdb_path, 'changed')
+        fifth.add_entry(path='Secrets', title='extra', username='four', password='4')
+        fifth.write(kdb_path)
+        sixth.remove_entry('one', '')
+        sixth.write(kdb_path)
+
+        db = keepass.kpdb.Database(kdb_path, 'changed')
+        assert sorted(e.title for e in db.entries) == ['extra', 'new', 'second']
+        assert sorted(os.listdir(tempdir)) == ['shared.kdb']
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_parse_parallel():
+    """
+    Decoding in worker processes gives the same records as in order.
+    """
+    db = keepass.kpdb.Database()
+    for ind in range(50):
+        db.add_entry(path='Secrets/Sub%d' % (ind % 4), title='title%d' % ind,
+                     username='user%d' % ind, password='pass%d' % ind, notes='n' * ind)
+    db.entries[3].binary_desc = 'data.bin'
+    db.entries[3].binary_data = 'attached\0data'
+    db.entries[3].update_order()
+    db.header.ngroups = len(db.groups)
+    db.header.nentries = len(db.entries)
+    payload = db.encode_payload()
+
+    serial = keepass.kpdb.Database()
+    serial.header = db.header
+    serial.parallel_threshold = None
+    serial.parse_payload(payload)
+    parallel = keepass.kpdb.Database()
+    parallel.header = db.header
+    parallel.parallel_threshold = 0
+    parallel.parallel_workers = 3
+    parallel.parse_payload(payload)
+
+    assert len(parallel.groups) == len(db.groups)
+    assert len(parallel.entries) == len(db.entries)
+    for mine,theirs in zip(serial.groups + serial.entries,
+                           parallel.groups + parallel.entries):
+        assert mine.order == theirs.order
+        assert mine.fields() == theirs.fields()
+    assert str(parallel.entries[3].binary_data) == 'attached\0data'
+
+    # only the main thread forks, and one worker does not
+    import threading
+    used = []
+    thread = threading.Thread(target=lambda: used.append(parallel._use_parallel(len(payload))))
+    thread.start()
+    thread.join()
+    assert used == [False] and parallel._use_parallel(len(payload))
+    parallel.parallel_workers = 1
+    assert not parallel._use_parallel(len(payload))
+
+def test_key_progress():
+    """
+    The key transformation reports progress and can be cancelled.
+    """
+    import threading
+    db = keepass.kpdb.Database()
+    hdr = db.header
+    finalkey = db.final_key('secret', hdr.master_seed, hdr.master_seed2, 1000)
+
+    calls = []
+    db.key_chunk = 300
+    db.progress = lambda done, total, left: calls.append((done, total))
+    assert db.final_key('secret', hdr.master_seed, hdr.master_seed2, 1000) == finalkey
+    assert calls == [(300, 1000), (600, 1000), (900, 1000), (1000, 1000)]
+
+    db.cancel = threading.Event()
+    db.progress = lambda done, total, left: db.cancel.set()
+    try:
+        db.final_key('secret', hdr.master_seed, hdr.master_seed2, 1000)
+    except keepass.kpdb.Cancelled:
+        pass
+    else:
+        assert False, 'not cancelled'
+
+def test_check():
+    """
+    Structural problems are found and repaired.
+    """
+    import datetime
+    db = keepass.kpdb.Database()
+    for ind in range(4):
+        db.add_entry(path='Top/Sub%d' % ind, title='title%d' % ind,
+                     username='user%d' % ind, password='pass%d' % ind)
+    assert db.check() == []
+
+    db.groups[2].level = 4
+    db.groups[3].groupid = db.groups[1].groupid
+    db.entries[0].groupid = 12345
+    db.entries[1].uuid = db.entries[2].uuid
+    db.entries[2].title = 'a longer title'
+    db.entries[3].expiration_time = datetime.datetime(9999, 1, 1)
+    kinds = sorted(kind for kind,message in db.check())
+    assert kinds == ['date', 'duplicate-groupid', 'duplicate-uuid', 'level',
+                     'orphan', 'orphan', 'size'], kinds
+
+    db.check(repair=True)
+    assert db.check() == []
+    assert db.groups[-1].group_name == 'Recovered'
+    db.hierarchy()
+
+def test_duplicates():
+    """
+    Duplicate entries and reused passwords are found and merged.
+    """
+    db = keepass.kpdb.Database()
+    db.add_entry(path='One', title='mail', username='alice', password='secret')
+    db.add_entry(path='Two', title='mail', username='alice', password='secret')
+    db.add_entry(path='One', title='bank', username='bob', password='secret')
+    db.add_entry(path='One', title='shop', username='carol', password='other')
+    db.add_entry(path='One', title='mail', username='alice', password='secret')
+
+    dups = db.find_duplicates()
+    assert [[e.title for e in bucket] for bucket in dups] == [['mail'] * 3]
+    reused = db.find_reused_passwords()
+    assert [len(bucket) for bucket in reused] == [4]
+
+    removed = db.merge_duplicates()
+    assert len(removed) == 1 and len(db.entries) == 4
+    assert len(db.find_duplicates()[0]) == 2     # the one in another group stays
+
+def test_bytes():
+    """
+    Move a database through memory without files.
+    """
+    import io
+    db = keepass.kpdb.Database()
+    db.header.key_enc_rounds = 10
+    db.add_entry(path='Secrets', title='Gonk', username='foo', password='bar')
+    data = db.to_bytes('secret')
+
+    for buf in (data, bytearray(data), memoryview(data)):
+        db2 = keepass.kpdb.Database.from_bytes(buf, 'secret')
+        assert [ent.title for ent in db2.entries] == ['Gonk']
+        assert isinstance(db2.entries[0].password, str)
+
+    out = io.BytesIO()
+    header,finalkey = db.to_fileobj(out, 'secret')
+    out.seek(0)
+    db2 = keepass.kpdb.Database.from_fileobj(out, 'secret')
+    assert db2.header.contents_hash == header.contents_hash
+
+    tempdir = tempfile.mkdtemp()
+    kdb_path = os.path.join(tempdir, 'bytes.kdb')
+    try:
+        with open(kdb_path, 'wb') as fp:
+            fp.write('junk')
+            db.to_fileobj(fp, 'secret')
+        with open(kdb_path, 'rb') as fp:
+            fp.seek(4)
+            db2 = keepass.kpdb.Database.from_fileobj(fp, 'secret')
+        assert db2.entries[0].password == 'bar'
+    finally:
+        shutil.rmtree(tempdir)
@@ -0,0 +1,141 @@
+import tempfile
+import shutil
+import os
+
+import keepass.kpdb
+from keepass import journal
+
+def test_journal():
+    tempdir = tempfile.mkdtemp()
+    kdb_path = os.path.join(tempdir, 'journal.kdb')
+    jnl_path = journal.journal_name(kdb_path)
+    try:
+        db = keepass.kpdb.Database()
+        for ind in range(5):
+            db.add_entry(path='Secrets', title='title%d' % ind, username='user%d' % ind,
+                         password='pass%d' % ind)
+        db.write(kdb_path, 'secret')
+        base = open(kdb_path, 'rb').read()
+
+        jdb = journal.JournaledDatabase(kdb_path, 'secret')
+        assert jdb.commit() == 0 and not os.path.exists(jnl_path)
+        jdb.update_entry('title1', 'user1', '', new_password='changed')
+        jdb.add_entry(path='Secrets/New', title='added', username='new', password='pw')
+        jdb.remove_entry('user3', '')
+        assert jdb.commit() == 4        # groups, two entries and a removal
+        assert open(kdb_path, 'rb').read() == base
+
+        jdb = journal.JournaledDatabase(kdb_path, 'secret')
+        passwords = dict((e.title, e.password) for e in jdb.entries)
+        assert passwords['title1'] == 'changed' and passwords['added'] == 'pw'
+        assert 'title3' not in passwords
+        assert [g.group_name for g in jdb.groups] == ['Secrets', 'New']
+
+        # changes to a copy are not committed with the original
+        from keepass import cache
+        snap = cache.view(jdb)
+        snap.update_entry('title4', 'user4', '', new_password='copied')
+        jdb.update_entry('title2', 'user2', '', new_password='later')
+        assert jdb.commit() == 1
+        passwords = dict((e.title, e.password)
+                         for e in journal.JournaledDatabase(kdb_path, 'secret').entries)
+        assert passwords['title2'] == 'later' and passwords['title4'] == 'pass4'
+
+        # a wrong key does not verify, a torn last record is ignored
+        with open(jnl_path, 'ab') as fp:
+            fp.write('\x40\0\0\0partial')
+        try:
+            journal.JournaledDatabase(kdb_path, 'wrong')
+        except ValueError:
+            pass
+        else:
+            assert False, 'opened with the wrong key'
+        jdb = journal.JournaledDatabase(kdb_path, 'secret', threshold=0)
+        assert len(jdb.entries) == 5
+
+        # past the threshold the journal is folded into a standard file
+        jdb.update_entry('title0', 'user0', '', new_password='again')
+        jdb.commit()
+        assert not os.path.exists(jnl_path)
+        db = keepass.kpdb.Database(kdb_path, 'secret')
+        assert sorted(e.title for e in db.entries) == ['added', 'title0', 'title1',
+                                                       'title2', 'title4']
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_journal_recovery():
+    tempdir = tempfile.mkdtemp()
+    kdb_path = os.path.join(tempdir, 'journal.kdb')
+    jnl_path = journal.journal_name(kdb_path)
+    try:
+        db = keepass.kpdb.Database()
+        for ind in range(5):
+            db.add_entry(path='Secrets', title='title%d' % ind, username='user%d' % ind,
+                         password='pass%d' % ind)
+        db.write(kdb_path, 'secret')
+
+        # a commit encodes only the entries changed
+        jdb = journal.JournaledDatabase(kdb_path, 'secret')
+        digest = journal._digest
+        encoded = []
+        journal._digest = lambda info: encoded.append(info) or digest(info)
+        try:
+            jdb.update_entry('title1', 'user1', '', new_password='changed')
+            assert jdb.commit() == 1 and len(encoded) == 1
+            ent = jdb.entries[2]
+            ent.notes = 'in place'
+            ent.update_order()
+            jdb.changed([ent])
+            assert jdb.commit() == 1 and len(encoded) == 2
+        finally:
+            journal._digest = digest
+
+        # an interrupted compaction: the base not written, then written
+        os.rename(jnl_path, journal.compacted_name(kdb_path))
+        jdb = journal.JournaledDatabase(kdb_path, 'secret')
+        assert os.path.exists(jnl_path)
+        assert dict((e.title, e.notes) for e in jdb.entries)['title2'] == 'in place'
+        keepass.kpdb.Database.write(jdb, kdb_path)
+        os.rename(jnl_path, journal.compacted_name(kdb_path))
+        jdb = journal.JournaledDatabase(kdb_path, 'secret')
+        assert not journal.exists(kdb_path)
+
+        # a commit over another writer's commit is refused, not chained
+        jdb.remove_entry('user0', '')
+        jdb.commit()
+        other = journal.JournaledDatabase(kdb_path, 'secret')
+        other.update_entry('title1', 'user1', '', new_password='other')
+        jdb.update_entry('title1', 'user1', '', new_password='ours')
+        other.commit()
+        size = os.path.getsize(jnl_path)
+        for method in (jdb.commit, jdb.compact):
+            try:
+                method()
+            except keepass.kpdb.WriteConflict:
+                pass
+            else:
+                assert False, 'committed over another writer'
+        assert os.path.getsize(jnl_path) == size
+        jdb = journal.JournaledDatabase(kdb_path, 'secret')
+        assert dict((e.title, e.password) for e in jdb.entries)['title1'] == 'other'
+
+        # writing to the base file compacts the journal into it
+        jdb.write(kdb_path)
+        assert not journal.exists(kdb_path)
+        jdb = journal.JournaledDatabase(kdb_path, 'secret')
+        assert len(jdb.entries) == 4
+
+        # a base rewritten by another program keeps the journal
+        jdb.remove_entry('user4', '')
+        jdb.commit()
+        db = keepass.kpdb.Database(kdb_path, 'secret')
+        db.write(kdb_path)
+        try:
+            journal.JournaledDatabase(kdb_path, 'secret')
+        except ValueError:
+            pass
+        else:
+            assert False, 'opened over a journal of another base'
+        assert os.path.exists(jnl_path)
+    finally:
+        shutil.rmtree(tempdir)
@@ -0,0 +1,63 @@
+import tempfile
+import shutil
+import os
+
+import keepass.kpdb
+from keepass import lazy
+
+def test_open_lazy():
+    tempdir = tempfile.mkdtemp()
+    kdb_path = os.path.join(tempdir, 'lazy.kdb')
+    try:
+        db = keepass.kpdb.Database()
+        for ind in range(20):
+            db.add_entry(path='Secrets/Sub%d' % (ind % 3), title='title%d' % ind,
+                         username='user%d' % ind, password='pass%d' % ind,
+                         notes='x' * (ind * 7))
+        db.write(kdb_path, 'secret', index=True)
+        assert os.path.isfile(lazy.sidecar_name(kdb_path))
+
+        ldb = keepass.kpdb.Database.open_lazy(kdb_path, 'secret', verify='demand')
+        assert len(ldb) == 20
+        assert ldb.verified is None
+        found = ldb.find('title13')
+        assert len(found) == 1 and found[0].password == 'pass13'
+        uuid = [e.uuid for e in db.entries if e.title == 'title5'][0]
+        assert ldb.entry(uuid).username == 'user5'
+        assert ldb.group('Secrets/Sub1').group_name == 'Sub1'
+        assert sorted(e.title for e in ldb.entries_in(['Secrets', 'Sub2']))[0] == 'title11'
+        assert ldb.verify() and ldb.verified
+
+        # records are not read from a file rewritten since it was opened
+        ldb = keepass.kpdb.Database.open_lazy(kdb_path, 'secret', verify='demand')
+        db.write(kdb_path, 'secret')
+        try:
+            ldb.entry(uuid)
+        except ValueError:
+            pass
+        else:
+            assert False, 'read a rewritten file'
+
+        # a plain write keeps an existing index current, replacing it
+        # rather than writing over it
+        sidecar = os.stat(lazy.sidecar_name(kdb_path))
+        db.update_entry('title13', 'user13', '', new_password='changed')
+        db.write(kdb_path, 'secret')
+        assert os.stat(lazy.sidecar_name(kdb_path)).st_ino != sidecar.st_ino
+        assert not [name for name in os.listdir(tempdir) if name.endswith('.tmp')]
+        ldb = keepass.kpdb.Database.open_lazy(kdb_path, 'secret', verify='now')
+        assert ldb.find('title13')[0].password == 'changed'
+
+        # an index left from an earlier write, or a wrong key, is refused
+        index = open(lazy.sidecar_name(kdb_path), 'rb').read()
+        db.write(kdb_path, 'secret', index=False)
+        open(lazy.sidecar_name(kdb_path), 'wb').write(index)
+        for key in ['secret', 'wrong']:
+            try:
+                keepass.kpdb.Database.open_lazy(kdb_path, key)
+            except ValueError:
+                pass
+            else:
+                assert False, 'stale index accepted'
+    finally:
+        shutil.rmtree(tempdir)
@@ -0,0 +1,60 @@
+import threading
+import time
+
+import keepass.kpdb
+from keepass import locking
+
+def test_rwlock():
+    lock = locking.RWLock()
+    inside = []
+    def read():
+        with lock.reading():
+            inside.append(1)
+            time.sleep(0.2)
+            inside.pop()
+    readers = [threading.Thread(target=read) for ind in range(3)]
+    for thread in readers: thread.start()
+    time.sleep(0.1)
+    assert len(inside) == 3     # readers share the lock
+    with lock.writing():
+        assert not inside       # the writer waited for them all
+    for thread in readers: thread.join()
+
+def test_locked_database():
+    shared = locking.LockedDatabase(keepass.kpdb.Database())
+    def add(first):
+        for ind in range(first, first + 20):
+            shared.add_entry('Web', 'title%d' % ind, 'user%d' % ind, 'secret')
+    writers = [threading.Thread(target=add, args=(first,)) for first in (0, 100, 200)]
+    for thread in writers: thread.start()
+    for thread in writers: thread.join()
+    assert len(shared.search('title')) == 60
+    data = shared.to_bytes('key')
+    assert len(keepass.kpdb.Database.from_bytes(data, 'key').entries) == 60
+
+    snap = shared.snapshot()
+    with shared.writing() as db:
+        db.remove_group('Web')
+    assert len(snap.entries) == 60
+    with shared.reading() as db:
+        assert not db.entries
+
+def test_locked_write():
+    """
+    Saving over a file changed meanwhile merges it in.
+    """
+    import os, shutil, tempfile
+    tempdir = tempfile.mkdtemp()
+    path = os.path.join(tempdir, 'shared.kdb')
+    try:
+        keepass.kpdb.Database().write(path, 'key')
+        shared = locking.LockedDatabase(keepass.kpdb.Database(path, 'key'))
+        other = keepass.kpdb.Database(path, 'key')
+        other.add_entry('Web', 'other', 'user', 'secret')
+        other.write(path)
+        shared.add_entry('Web', 'ours', 'user', 'secret')
+        shared.write(path)
+        db = keepass.kpdb.Database(path, 'key')
+        assert sorted(e.title for e in db.entries) == ['other', 'ours']
+    finally:
+        shutil.rmtree(tempdir)
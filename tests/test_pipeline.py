@@ -0,0 +1,53 @@
+import tempfile
+import shutil
+import os
+
+import keepass.kpdb
+from keepass import pipeline
+from keepass.attachment import Attachment
+
+def read(path, masterkey, chunk):
+    db = keepass.kpdb.Database(masterkey=masterkey)
+    with open(path, 'rb') as fp:
+        pipeline.read(db, fp, os.path.getsize(path), chunk=chunk, depth=2)
+    return db
+
+def test_pipeline():
+    tempdir = tempfile.mkdtemp()
+    kdb_path = os.path.join(tempdir, 'pipeline.kdb')
+    try:
+        db = keepass.kpdb.Database()
+        db.header.key_enc_rounds = 10
+        for ind in range(50):
+            db.add_entry(path='Group%d' % (ind % 5), title='title%d' % ind,
+                         username='user', password='secret%d' % ind)
+        db.entries[7].binary_desc = 'blob'
+        db.entries[7].binary_data = Attachment(os.urandom(5000))
+        db.entries[7].update_order()
+        db.write(kdb_path, 'key')
+        expected = keepass.kpdb.Database(kdb_path, 'key')
+
+        for chunk in (16, 100, 1 << 20):
+            got = read(kdb_path, 'key', chunk)
+            assert [g.encode() for g in got.groups] == [g.encode() for g in expected.groups]
+            assert [e.encode() for e in got.entries] == [e.encode() for e in expected.entries]
+
+        try:
+            read(kdb_path, 'wrong', 64)
+        except ValueError:
+            pass
+        else:
+            assert False, 'read with the wrong key'
+
+        with open(kdb_path, 'rb') as fp:
+            data = fp.read()
+        with open(kdb_path, 'wb') as fp:
+            fp.write(data[:-32])
+        try:
+            read(kdb_path, 'key', 64)
+        except ValueError:
+            pass
+        else:
+            assert False, 'read a truncated file'
+    finally:
+        shutil.rmtree(tempdir)
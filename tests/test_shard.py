@@ -0,0 +1,44 @@
+import tempfile
+import shutil
+import os
+
+import keepass.kpdb
+from keepass import shard
+
+def test_shard():
+    tempdir = tempfile.mkdtemp()
+    manifest = os.path.join(tempdir, 'vault.kdb')
+    try:
+        db = keepass.kpdb.Database(masterkey='secret')
+        db.header.key_enc_rounds = 100
+        for ind in range(6):
+            db.add_entry(path='Top%d/Sub' % (ind % 3), title='title%d' % ind,
+                         username='user%d' % ind, password='pass%d' % ind)
+        vault = shard.shard(db, manifest)
+        assert sorted(os.listdir(tempdir)) == sorted(
+            ['vault.kdb', 'vault.0.kdb', 'vault.1.kdb', 'vault.2.kdb'])
+
+        vault = shard.ShardedDatabase(manifest, 'secret')
+        assert list(vault.shards) == ['Top0', 'Top1', 'Top2']
+        vault.add_entry('Top1/Other', 'new', 'user', 'pw')
+        assert [s.db is not None for s in vault.shards.values()] == [False, True, False]
+        before = dict((name, os.path.getmtime(os.path.join(tempdir, s.filename)))
+                      for name,s in vault.shards.items())
+        os.utime(os.path.join(tempdir, 'vault.1.kdb'), (0, 0))
+        vault.write()
+        assert os.path.getmtime(os.path.join(tempdir, 'vault.1.kdb')) != 0
+        assert os.path.getmtime(os.path.join(tempdir, 'vault.0.kdb')) == before['Top0']
+
+        vault = shard.ShardedDatabase(manifest, 'secret')
+        assert vault.update_entry('title4', 'user4', '', new_password='changed') == 1
+        assert [s.dirty for s in vault.shards.values()] == [False, True, False]
+        assert sorted(e.title for e in vault.search('title')) == \
+            ['title%d' % ind for ind in range(6)]
+        assert [n.name() for n in vault.hierarchy().nodes] == ['Top0', 'Top1', 'Top2']
+
+        whole = vault.unshard()
+        assert len(whole.entries) == 7
+        assert sorted(g.group_name for g in whole.groups if g.level == 0) == \
+            ['Top0', 'Top1', 'Top2']
+    finally:
+        shutil.rmtree(tempdir)
@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+
+import keepass.kpdb
+from keepass import stats
+
+def test_phases():
+    """
+    Reading and writing record their phases.
+    """
+    password = 'REINDEER FLOTILLA'
+    tempdir = tempfile.mkdtemp()
+    kdb_path = os.path.join(tempdir, 'test_stats.kdb')
+    seen = []
+    try:
+        db = keepass.kpdb.Database()
+        db.add_entry(path='Secrets', title='Gonk', username='foo', password='bar')
+        db.stats = stats.Stats(callback=lambda phase: seen.append(phase.name))
+        db.write(kdb_path, password)
+        assert seen == ['hash', 'final_key', 'encrypt']
+
+        st = stats.Stats()
+        db2 = keepass.kpdb.Database(kdb_path, password, stats=st)
+        db2.hierarchy()
+        names = [tot[0] for tot in st.totals()]
+        assert names == ['read', 'final_key', 'decrypt', 'hash', 'parse', 'hierarchy']
+        assert st.totals()[0][3] == os.path.getsize(kdb_path)
+        assert 'final_key' in str(st)
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_memory():
+    """
+    A phase allocating memory records the growth of the peak.
+    """
+    st = stats.Stats(memory=True)
+    with st.phase('allocate'):
+        data = bytearray(64 << 20)
+    del data
+    assert st.phases[0].peak >= 32 << 20
+    assert st.totals()[0][4] == st.phases[0].peak
@@ -0,0 +1,74 @@
+import tempfile
+import shutil
+import time
+import os
+
+import keepass.kpdb
+from keepass import watch
+
+def test_watch():
+    tempdir = tempfile.mkdtemp()
+    kdb_path = os.path.join(tempdir, 'watch.kdb')
+    try:
+        db = keepass.kpdb.Database()
+        db.add_entry(path='Secrets', title='Gonk', username='foo', password='bar')
+        db.add_entry(path='Secrets', title='Keep', username='foo', password='bar')
+        db.write(kdb_path, 'secret')
+
+        watcher = watch.Watcher(kdb_path, 'secret', interval=0.05)
+        seen = []
+        watcher.subscribe(seen.append)
+        kept = [ent for ent in watcher.db.entries if ent.title == 'Keep'][0]
+        index = watcher.db.time_index('last_mod_time')
+        assert watcher.check() is None
+
+        # the same contents written again are not read
+        db.write(kdb_path, 'secret')
+        assert watcher.check() is None and not seen
+
+        db.update_entry('Gonk', 'foo', '', new_password='changed')
+        db.add_entry(path='Other', title='New', username='baz', password='qux')
+        db.write(kdb_path, 'secret')
+        changes = watcher.check()
+        assert seen == [changes]
+        assert [ent.title for ent in changes.entries_added] == ['New']
+        assert [new.password for old,new in changes.entries_changed] == ['changed']
+        assert not changes.entries_removed
+        assert [grp.group_name for grp in changes.groups_added] == ['Other']
+        assert kept in watcher.db.entries
+        assert watcher.db.time_index('last_mod_time') is index
+        assert len(index) == 3
+
+        # a file which can not be read yet is read again, even if its
+        # stat() is the same by then
+        db.update_entry('Keep', 'foo', '', new_password='later')
+        data = db.to_bytes('secret')
+        with open(kdb_path, 'wb') as fp:
+            fp.write(data[:-1] + chr(ord(data[-1]) ^ 1))
+        stat = os.stat(kdb_path)
+        try:
+            watcher.check()
+        except ValueError:
+            pass
+        else:
+            assert False, 'read a damaged file'
+        with open(kdb_path, 'r+b') as fp:
+            fp.write(data)
+        os.utime(kdb_path, (stat.st_atime, stat.st_mtime))
+        changes = watcher.check()
+        assert [new.password for old,new in changes.entries_changed] == ['later']
+
+        # the background thread notices a removal
+        watcher.start()
+        try:
+            db.remove_entry('baz', '')
+            db.write(kdb_path, 'secret')
+            deadline = time.time() + 10
+            while len(seen) < 2 and time.time() < deadline:
+                time.sleep(0.05)
+        finally:
+            watcher.stop()
+        assert [ent.title for ent in seen[-1].entries_removed] == ['New']
+        assert len(watcher.db.time_index('last_mod_time')) == 2
+    finally:
+        shutil.rmtree(tempdir)